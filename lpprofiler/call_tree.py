@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#  This file is part of the LPprofiler profiling tool.                       #
+#        Copyright (C) 2017  EDF SA                                          #
+#                                                                            #
+#  LPprofiler is free software: you can redistribute it and/or modify        #
+#  it under the terms of the GNU General Public License as published by      #
+#  the Free Software Foundation, either version 3 of the License, or         #
+#  (at your option) any later version.                                       #
+#                                                                            #
+#  LPprofiler is distributed in the hope that it will be useful,             #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of            #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the             #
+#  GNU General Public License for more details.                              #
+#                                                                            #
+#  You should have received a copy of the GNU General Public License         #
+#  along with LPprofiler.  If not, see <http://www.gnu.org/licenses/>.       #
+#                                                                            #
+############################################################################## 
+
+from array import array
+
+ROOT_FRAME='[root]'
+
+# Separator between frames of a call path in reports
+PATH_SEPARATOR=' > '
+
+
+class CallTree :
+    """ Trie of sampled call paths with inclusive and exclusive sample counts.
+    Frames are interned once and nodes are stored in arrays, the children of all
+    nodes being found in a single (parent node,frame) -> node dictionary. """
+
+    def __init__(self):
+        # Interned frame names (symbol @ binary)
+        self.frames=[]
+        self._frame_ids={}
+
+        # Node 0 is the root, parents are always created before their children
+        self.parents=array('i',[-1])
+        self.node_frames=array('I',[self._intern(ROOT_FRAME)])
+        self.inclusive=array('d',[0])
+        self.exclusive=array('d',[0])
+        self.children={}
+
+    def _intern(self,frame):
+        frame_id=self._frame_ids.get(frame)
+        if frame_id is None:
+            frame_id=len(self.frames)
+            self._frame_ids[frame]=frame_id
+            self.frames.append(frame)
+        return frame_id
+
+    def _child(self,node,frame_id):
+        child=self.children.get((node,frame_id))
+        if child is None:
+            child=len(self.parents)
+            self.children[(node,frame_id)]=child
+            self.parents.append(node)
+            self.node_frames.append(frame_id)
+            self.inclusive.append(0)
+            self.exclusive.append(0)
+        return child
+
+    def __len__(self):
+        """ Number of nodes, root excluded """
+        return len(self.parents)-1
+
+    def get_total(self):
+        """ Number of samples added to the tree """
+        return self.inclusive[0]
+
+    def add_path(self,frames,count=1):
+        """ Add count samples of a call path given from the outermost caller to the sampled frame """
+        node=0
+        self.inclusive[0]+=count
+        for frame in frames:
+            node=self._child(node,self._intern(frame))
+            self.inclusive[node]+=count
+        self.exclusive[node]+=count
+
+    def merge(self,other):
+        """ Add the counts of another call tree (another rank) to this one """
+        frame_ids=array('I',(self._intern(frame) for frame in other.frames))
+        nodes=array('i',[0])
+        self.inclusive[0]+=other.inclusive[0]
+        self.exclusive[0]+=other.exclusive[0]
+        for other_node in range(1,len(other.parents)):
+            node=self._child(nodes[other.parents[other_node]],frame_ids[other.node_frames[other_node]])
+            nodes.append(node)
+            self.inclusive[node]+=other.inclusive[other_node]
+            self.exclusive[node]+=other.exclusive[other_node]
+
+    def get_path(self,node):
+        """ Frames from the outermost caller to node """
+        path=[]
+        while node>0:
+            path.append(self.get_frame(node))
+            node=self.parents[node]
+        path.reverse()
+        return path
+
+    def get_child(self,node,frame):
+        """ Node of frame called from node or None """
+        return self.children.get((node,self._frame_ids.get(frame)))
+
+    def get_children(self):
+        """ List of the children of each node """
+        children=[[] for node in self.parents]
+        for (parent,frame_id),child in self.children.items():
+            children[parent].append(child)
+        return children
+
+    def get_frame(self,node):
+        return self.frames[self.node_frames[node]]
+
+    def find(self,frames):
+        """ Node of a call path or None """
+        node=0
+        for frame in frames:
+            node=self.get_child(node,frame)
+            if node is None:
+                return None
+        return node
+
+    def get_top_paths(self,nb_paths=20):
+        """ Return the nb_paths call paths with the most inclusive samples as
+        (frames,inclusive,exclusive). A caller that only passes all its samples on
+        to a single callee is reported through the longer path of the callee. """
+
+        # A node is hidden when one of its children carries all of its samples
+        forwarded=bytearray(len(self.parents))
+        for (parent,frame_id),child in self.children.items():
+            if self.inclusive[child]==self.inclusive[parent]:
+                forwarded[parent]=1
+
+        nodes=[node for node in range(1,len(self.parents)) if not forwarded[node]]
+        nodes.sort(key=lambda node:(-self.inclusive[node],node))
+
+        return [(self.get_path(node),self.inclusive[node],self.exclusive[node])
+                for node in nodes[:nb_paths]]
+
+    def get_callers(self,frame):
+        """ Return {caller frame: inclusive samples} of a frame over all its call paths.
+        Samples of recursive calls are counted once, at the outermost call. """
+        frame_id=self._frame_ids.get(frame)
+        callers={}
+        if frame_id is None:
+            return callers
+        for node in range(1,len(self.parents)):
+            if self.node_frames[node]!=frame_id or self._has_ancestor_frame(node,frame_id):
+                continue
+            parent=self.parents[node]
+            caller=self.frames[self.node_frames[parent]]
+            callers[caller]=callers.get(caller,0)+self.inclusive[node]
+        return callers
+
+    def _has_ancestor_frame(self,node,frame_id):
+        node=self.parents[node]
+        while node>0:
+            if self.node_frames[node]==frame_id:
+                return True
+            node=self.parents[node]
+        return False
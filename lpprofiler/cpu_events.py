@@ -0,0 +1,340 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#  This file is part of the LPprofiler profiling tool.                       #
+#        Copyright (C) 2017  EDF SA                                          #
+#                                                                            #
+#  LPprofiler is free software: you can redistribute it and/or modify        #
+#  it under the terms of the GNU General Public License as published by      #
+#  the Free Software Foundation, either version 3 of the License, or         #
+#  (at your option) any later version.                                       #
+#                                                                            #
+#  LPprofiler is distributed in the hope that it will be useful,             #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of            #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the             #
+#  GNU General Public License for more details.                              #
+#                                                                            #
+#  You should have received a copy of the GNU General Public License         #
+#  along with LPprofiler.  If not, see <http://www.gnu.org/licenses/>.       #
+#                                                                            #
+############################################################################## 
+
+import collections
+
+CpuInfo=collections.namedtuple('CpuInfo',['vendor','family','model','model_name','implementer','part'])
+
+DEFAULT_CPUINFO='/proc/cpuinfo'
+
+# Counter profiles that can be selected on the command line
+PROFILES=['default','topdown','memory','flops','cache','tlb']
+
+# Software events are not counted by the PMU and are never grouped
+SOFTWARE_EVENTS=['task-clock','cpu-clock']
+
+# Events counted by fixed counters (topdown metrics are read from the slots counter),
+# they do not take a programmable counter in a group
+FIXED_EVENTS=['instructions','cycles','ref-cycles','slots','topdown-retiring','topdown-bad-spec',
+              'topdown-fe-bound','topdown-be-bound','topdown-heavy-ops','topdown-br-mispredict',
+              'topdown-fetch-lat','topdown-mem-bound']
+
+# Microarchitectures of Intel family 6 models
+INTEL_MODELS={
+    'intel-haswell':[0x3c,0x3f,0x45,0x46],
+    'intel-broadwell':[0x3d,0x47,0x4f,0x56],
+    'intel-skylake':[0x4e,0x5e,0x55,0x8e,0x9e,0xa5,0xa6],
+    'intel-icelake':[0x6a,0x6c,0x7d,0x7e,0x8c,0x8d],
+    'intel-sapphirerapids':[0x8f,0xcf,0xad,0xae],
+}
+
+# Microarchitectures of ARM (implementer,part)
+ARM_PARTS={
+    (0x41,0xd0c):'arm-neoverse-n1',
+    (0x41,0xd40):'arm-neoverse-v1',
+    (0x41,0xd49):'arm-neoverse-n2',
+    (0x41,0xd4f):'arm-neoverse-v2',
+    (0x46,0x001):'fujitsu-a64fx',
+}
+
+# SVE vector length of ARM microarchitectures, in bits
+SVE_VECTOR_BITS={'arm-neoverse-v1':256,'arm-neoverse-n2':128,'arm-neoverse-v2':128,'fujitsu-a64fx':512}
+
+# Number of programmable counters available to one hardware thread
+PMU_COUNTERS={'intel':4,'amd':6,'arm':6,'fujitsu':8,'generic':4}
+
+
+def read_cpuinfo(cpuinfo_path=DEFAULT_CPUINFO):
+    """ Read identification fields of the first processor of a /proc/cpuinfo file """
+    fields={}
+    try:
+        with open(cpuinfo_path,'r') as cf:
+            for line in cf:
+                if not line.strip():
+                    # Only the first processor is read, nodes are homogeneous
+                    if fields:
+                        break
+                    continue
+                key,sep,value=line.partition(':')
+                if sep:
+                    fields.setdefault(key.strip(),value.strip())
+    except OSError:
+        pass
+
+    def _int(key):
+        try:
+            return int(fields.get(key,''),0)
+        except ValueError:
+            return None
+
+    return CpuInfo(vendor=fields.get('vendor_id',''),family=_int('cpu family'),model=_int('model'),
+                   model_name=fields.get('model name',''),
+                   implementer=_int('CPU implementer'),part=_int('CPU part'))
+
+
+def get_microarchitecture(cpu_info):
+    """ Return the microarchitecture name of a CPU, 'generic' if it is not known """
+    if cpu_info.vendor=='GenuineIntel' and cpu_info.family==6:
+        for uarch,models in INTEL_MODELS.items():
+            if cpu_info.model in models:
+                return uarch
+        return 'intel'
+    if cpu_info.vendor in ('AuthenticAMD','HygonGenuine'):
+        if cpu_info.family==0x17:
+            return 'amd-zen'
+        if cpu_info.family==0x19:
+            if cpu_info.model is not None and (0x10<=cpu_info.model<=0x1f or 0x60<=cpu_info.model<=0xaf):
+                return 'amd-zen4'
+            return 'amd-zen3'
+        if cpu_info.family==0x1a:
+            # Zen 5 keeps the events of Zen 4 used here
+            return 'amd-zen4'
+        return 'amd'
+    if cpu_info.implementer is not None:
+        return ARM_PARTS.get((cpu_info.implementer,cpu_info.part),'arm')
+    return 'generic'
+
+
+def _vendor(uarch):
+    return uarch.split('-')[0]
+
+
+# Events of each profile and microarchitecture (or vendor, or generic) as lists of groups.
+# Events of a group are counted at the same time so that their ratios are exact even when perf
+# multiplexes groups. Formulas are (metric name,expression) evaluated by the derived metrics registry.
+PROFILE_EVENTS={
+    'default':{
+        'generic':([['instructions','cycles'],['task-clock'],['cpu-clock']],[]),
+    },
+    'topdown':{
+        # Skylake issues 4 uops per cycle, slots are computed from the fixed cycles counter so that
+        # the group fits in the 4 programmable counters
+        'intel-skylake':([['cycles','topdown-slots-issued','topdown-slots-retired',
+                           'topdown-fetch-bubbles','topdown-recovery-bubbles'],
+                          ['cycles','cycle_activity.stalls_mem_any']],
+                         [('frontend bound (%)','topdown_fetch_bubbles / (4 * cycles) * 100'),
+                          ('bad speculation (%)','(topdown_slots_issued - topdown_slots_retired + topdown_recovery_bubbles)'
+                           ' / (4 * cycles) * 100'),
+                          ('retiring (%)','topdown_slots_retired / (4 * cycles) * 100'),
+                          ('backend bound (%)','100 - frontend_bound - bad_speculation - retiring'),
+                          ('memory bound (%)','min(cycle_activity_stalls_mem_any / cycles * 100, backend_bound)'),
+                          ('core bound (%)','backend_bound - memory_bound')]),
+        'intel-icelake':([['slots','topdown-retiring','topdown-bad-spec','topdown-fe-bound','topdown-be-bound'],
+                          ['cycles','cycle_activity.stalls_mem_any']],
+                         [('frontend bound (%)','topdown_fe_bound / slots * 100'),
+                          ('bad speculation (%)','topdown_bad_spec / slots * 100'),
+                          ('retiring (%)','topdown_retiring / slots * 100'),
+                          ('backend bound (%)','topdown_be_bound / slots * 100'),
+                          ('memory bound (%)','min(cycle_activity_stalls_mem_any / cycles * 100, backend_bound)'),
+                          ('core bound (%)','backend_bound - memory_bound')]),
+        'intel-sapphirerapids':([['slots','topdown-retiring','topdown-bad-spec','topdown-fe-bound','topdown-be-bound',
+                                  'topdown-mem-bound']],
+                                [('frontend bound (%)','topdown_fe_bound / slots * 100'),
+                                 ('bad speculation (%)','topdown_bad_spec / slots * 100'),
+                                 ('retiring (%)','topdown_retiring / slots * 100'),
+                                 ('backend bound (%)','topdown_be_bound / slots * 100'),
+                                 ('memory bound (%)','topdown_mem_bound / slots * 100'),
+                                 ('core bound (%)','backend_bound - memory_bound')]),
+        # Zen 4 dispatches 6 ops per cycle
+        'amd-zen4':([['ls_not_halted_cyc','de_no_dispatch_per_slot.no_ops_from_frontend',
+                      'de_no_dispatch_per_slot.backend_stalls','ex_ret_ops','de_src_op_disp.all'],
+                     ['ex_no_retire.load_not_complete','ex_no_retire.not_complete']],
+                    [('frontend bound (%)','de_no_dispatch_per_slot_no_ops_from_frontend / (6 * ls_not_halted_cyc) * 100'),
+                     ('backend bound (%)','de_no_dispatch_per_slot_backend_stalls / (6 * ls_not_halted_cyc) * 100'),
+                     ('bad speculation (%)','(de_src_op_disp_all - ex_ret_ops) / (6 * ls_not_halted_cyc) * 100'),
+                     ('retiring (%)','ex_ret_ops / (6 * ls_not_halted_cyc) * 100'),
+                     ('memory bound (%)','backend_bound * ex_no_retire_load_not_complete / ex_no_retire_not_complete'),
+                     ('core bound (%)','backend_bound - memory_bound')]),
+        'arm':([['cpu_cycles','stall_frontend','stall_backend']],
+               [('frontend bound (%)','stall_frontend / cpu_cycles * 100'),
+                ('backend bound (%)','stall_backend / cpu_cycles * 100')]),
+        'arm-neoverse-v1':([['cpu_cycles','stall_frontend','stall_backend','stall_backend_mem']],
+                           [('frontend bound (%)','stall_frontend / cpu_cycles * 100'),
+                            ('backend bound (%)','stall_backend / cpu_cycles * 100'),
+                            ('memory bound (%)','stall_backend_mem / cpu_cycles * 100'),
+                            ('core bound (%)','backend_bound - memory_bound')]),
+        'generic':([['cycles','stalled-cycles-frontend','stalled-cycles-backend']],
+                   [('frontend bound (%)','stalled_cycles_frontend / cycles * 100'),
+                    ('backend bound (%)','stalled_cycles_backend / cycles * 100')]),
+    },
+    'memory':{
+        # Cache lines (64 bytes) read from or written to memory by the profiled process
+        'intel':([['LLC-load-misses','LLC-store-misses']],
+                 [('memory bandwidth (GB/s)','(LLC_load_misses + LLC_store_misses) * 64 / elapsed_time / 1e9')]),
+        'amd-zen':([['ls_refills_from_sys.ls_mabresp_lcl_dram','ls_refills_from_sys.ls_mabresp_rmt_dram']],
+                   [('memory bandwidth (GB/s)','(ls_refills_from_sys_ls_mabresp_lcl_dram + ls_refills_from_sys_ls_mabresp_rmt_dram)'
+                     ' * 64 / elapsed_time / 1e9')]),
+        'amd-zen3':([['ls_refills_from_sys.ls_mabresp_lcl_dram','ls_refills_from_sys.ls_mabresp_rmt_dram']],
+                    [('memory bandwidth (GB/s)','(ls_refills_from_sys_ls_mabresp_lcl_dram + ls_refills_from_sys_ls_mabresp_rmt_dram)'
+                      ' * 64 / elapsed_time / 1e9')]),
+        'amd-zen4':([['ls_dmnd_fills_from_sys.dram_io_near','ls_dmnd_fills_from_sys.dram_io_far']],
+                    [('memory bandwidth (GB/s)','(ls_dmnd_fills_from_sys_dram_io_near + ls_dmnd_fills_from_sys_dram_io_far)'
+                      ' * 64 / elapsed_time / 1e9')]),
+        'arm':([['ll_cache_miss_rd','mem_access']],
+               [('memory bandwidth (GB/s)','ll_cache_miss_rd * 64 / elapsed_time / 1e9')]),
+        'generic':([['cache-misses']],
+                   [('memory bandwidth (GB/s)','cache_misses * 64 / elapsed_time / 1e9')]),
+    },
+    'flops':{
+        'intel':([['fp_arith_inst_retired.scalar_double','fp_arith_inst_retired.128b_packed_double',
+                   'fp_arith_inst_retired.256b_packed_double','fp_arith_inst_retired.512b_packed_double'],
+                  ['fp_arith_inst_retired.scalar_single','fp_arith_inst_retired.128b_packed_single',
+                   'fp_arith_inst_retired.256b_packed_single','fp_arith_inst_retired.512b_packed_single']],
+                 [('DP GFLOPS','(fp_arith_inst_retired_scalar_double + 2 * fp_arith_inst_retired_128b_packed_double'
+                   ' + 4 * fp_arith_inst_retired_256b_packed_double + 8 * fp_arith_inst_retired_512b_packed_double)'
+                   ' / elapsed_time / 1e9'),
+                  ('SP GFLOPS','(fp_arith_inst_retired_scalar_single + 4 * fp_arith_inst_retired_128b_packed_single'
+                   ' + 8 * fp_arith_inst_retired_256b_packed_single + 16 * fp_arith_inst_retired_512b_packed_single)'
+                   ' / elapsed_time / 1e9')]),
+        # No floating point arithmetic counters before Broadwell, no 512 bits vectors before Skylake
+        'intel-haswell':([],[]),
+        'intel-broadwell':([['fp_arith_inst_retired.scalar_double','fp_arith_inst_retired.128b_packed_double',
+                             'fp_arith_inst_retired.256b_packed_double'],
+                            ['fp_arith_inst_retired.scalar_single','fp_arith_inst_retired.128b_packed_single',
+                             'fp_arith_inst_retired.256b_packed_single']],
+                           [('DP GFLOPS','(fp_arith_inst_retired_scalar_double + 2 * fp_arith_inst_retired_128b_packed_double'
+                             ' + 4 * fp_arith_inst_retired_256b_packed_double) / elapsed_time / 1e9'),
+                            ('SP GFLOPS','(fp_arith_inst_retired_scalar_single + 4 * fp_arith_inst_retired_128b_packed_single'
+                             ' + 8 * fp_arith_inst_retired_256b_packed_single) / elapsed_time / 1e9')]),
+        'amd':([['fp_ret_sse_avx_ops.all']],
+               [('GFLOPS','fp_ret_sse_avx_ops_all / elapsed_time / 1e9')]),
+        'arm':([['vfp_spec','ase_spec']],
+               [('vector ops (%)','ase_spec / (vfp_spec + ase_spec) * 100')]),
+        'arm-neoverse-v1':([['fp_scale_ops_spec','fp_fixed_ops_spec']],
+                           [('GFLOPS','(fp_scale_ops_spec * 2 + fp_fixed_ops_spec) / elapsed_time / 1e9')]),
+        'arm-neoverse-v2':([['fp_scale_ops_spec','fp_fixed_ops_spec']],
+                           [('GFLOPS','(fp_scale_ops_spec * 2 + fp_fixed_ops_spec) / elapsed_time / 1e9')]),
+        'generic':([],[]),
+    },
+    'cache':{
+        'intel':([['L1-dcache-loads','L1-dcache-load-misses'],['LLC-loads','LLC-load-misses']],
+                 [('L1 miss (%)','L1_dcache_load_misses / L1_dcache_loads * 100'),
+                  ('LLC miss (%)','LLC_load_misses / LLC_loads * 100')]),
+        'generic':([['L1-dcache-loads','L1-dcache-load-misses'],['cache-references','cache-misses']],
+                   [('L1 miss (%)','L1_dcache_load_misses / L1_dcache_loads * 100'),
+                    ('cache miss (%)','cache_misses / cache_references * 100')]),
+    },
+    'tlb':{
+        'generic':([['dTLB-loads','dTLB-load-misses'],['iTLB-load-misses']],
+                   [('dTLB miss (%)','dTLB_load_misses / dTLB_loads * 100')]),
+    },
+}
+
+# Cycles with a page walk in progress of each Intel microarchitecture, (DTLB_LOAD_MISSES,ITLB_MISSES)
+# WALK_DURATION before Skylake and WALK_ACTIVE (WALK_PENDING with cmask=1) since. Models without a
+# known encoding do not count walk cycles.
+INTEL_TLB_WALK_EVENTS={
+    'intel-haswell':('event=0x08,umask=0x10','event=0x85,umask=0x10'),
+    'intel-broadwell':('event=0x08,umask=0x10','event=0x85,umask=0x10'),
+    'intel-skylake':('event=0x08,umask=0x10,cmask=1','event=0x85,umask=0x10,cmask=1'),
+    'intel-icelake':('event=0x08,umask=0x10,cmask=1','event=0x85,umask=0x10,cmask=1'),
+    'intel-sapphirerapids':('event=0x12,umask=0x10,cmask=1','event=0x11,umask=0x10,cmask=1'),
+}
+# Walk cycles are divided by the core cycles (CPU_CLK_UNHALTED.THREAD) of their own group,
+# cycles of the default group may have been counted during other time slices.
+INTEL_TLB_FORMULA=('cycles spent due to TLBmiss (%)','(dTLBmiss_cycles + iTLBmiss_cycles) / TLBgroup_cycles * 100')
+for _uarch,(_dtlb_walk,_itlb_walk) in INTEL_TLB_WALK_EVENTS.items():
+    _tlb_group=['cpu/event=0x3c,umask=0x00,name=TLBgroup_cycles/',
+                'cpu/{},name=dTLBmiss_cycles/'.format(_dtlb_walk),
+                'cpu/{},name=iTLBmiss_cycles/'.format(_itlb_walk)]
+    PROFILE_EVENTS['default'][_uarch]=(PROFILE_EVENTS['default']['generic'][0]+[_tlb_group],
+                                       [INTEL_TLB_FORMULA])
+    PROFILE_EVENTS['tlb'][_uarch]=([_tlb_group,['dTLB-loads','dTLB-load-misses']],
+                                   [('dTLB miss (%)','dTLB_load_misses / dTLB_loads * 100')])
+
+
+def event_name(event):
+    """ Name under which perf stat reports an event """
+    if '/' in event and 'name=' in event:
+        return event.split('name=')[1].split(',')[0].rstrip('/')
+    return event
+
+
+class CounterSet :
+    """ Event groups and derived metrics formulas of the selected profiles for one microarchitecture """
+
+    def __init__(self,cpu_info,profiles=['default']):
+        self.uarch=get_microarchitecture(cpu_info)
+        self.nb_counters=PMU_COUNTERS.get(_vendor(self.uarch),PMU_COUNTERS['generic'])
+
+        self.groups=[]
+        self.formulas=[]
+        # Events only read to compute the derived metrics of a profile
+        self.raw_events=[]
+        counted_events=set()
+        for profile in profiles:
+            if profile not in PROFILE_EVENTS:
+                raise ValueError("unknown counter profile {}, choose from {}".format(profile,','.join(PROFILES)))
+            groups,formulas=self._get_profile_events(profile)
+            for group in groups:
+                # Groups already counted by a previous profile are not counted twice, events shared
+                # with other groups are kept so that ratios of a group are exact.
+                if all(event in counted_events for event in group):
+                    continue
+                counted_events.update(group)
+                self.groups.extend(self._split_group(group))
+                if profile!='default':
+                    self.raw_events.extend(event_name(event) for event in group
+                                           if event_name(event) not in self.raw_events)
+            self.formulas.extend(formulas)
+
+        default_events=[event_name(event) for group in self._get_profile_events('default')[0] for event in group]
+        self.raw_events=[event for event in self.raw_events if event not in default_events]
+
+    def _get_profile_events(self,profile):
+        """ Events of profile for the microarchitecture, else for its vendor, else generic ones """
+        profile_events=PROFILE_EVENTS[profile]
+        for key in (self.uarch,_vendor(self.uarch),'generic'):
+            if key in profile_events:
+                return profile_events[key]
+        return [],[]
+
+    def _split_group(self,group):
+        """ Split a group in groups that fit in the programmable counters, software events are left alone """
+        groups=[[event] for event in group if event in SOFTWARE_EVENTS]
+        pmu_events=[event for event in group if event not in SOFTWARE_EVENTS]
+
+        current=[]
+        nb_used=0
+        for event in pmu_events:
+            needed=0 if event in FIXED_EVENTS else 1
+            if nb_used+needed>self.nb_counters:
+                groups.append(current)
+                current=[]
+                nb_used=0
+            current.append(event)
+            nb_used+=needed
+        if current:
+            groups.append(current)
+        return groups
+
+    def get_events(self):
+        """ Names of all counted events as reported by perf stat """
+        return [event_name(event) for group in self.groups for event in group]
+
+    def get_event_option(self):
+        """ perf stat -e argument, groups are written {event,event} """
+        event_groups=[]
+        for group in self.groups:
+            if len(group)>1:
+                event_groups.append('{'+','.join(group)+'}')
+            else:
+                event_groups.append(group[0])
+        return '"{}"'.format(','.join(event_groups))
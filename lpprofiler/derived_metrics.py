@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#  This file is part of the LPprofiler profiling tool.                       #
+#        Copyright (C) 2017  EDF SA                                          #
+#                                                                            #
+#  LPprofiler is free software: you can redistribute it and/or modify        #
+#  it under the terms of the GNU General Public License as published by      #
+#  the Free Software Foundation, either version 3 of the License, or         #
+#  (at your option) any later version.                                       #
+#                                                                            #
+#  LPprofiler is distributed in the hope that it will be useful,             #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of            #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the             #
+#  GNU General Public License for more details.                              #
+#                                                                            #
+#  You should have received a copy of the GNU General Public License         #
+#  along with LPprofiler.  If not, see <http://www.gnu.org/licenses/>.       #
+#                                                                            #
+############################################################################## 
+
+import ast, math, re
+
+# Formulas computed by default, metrics are named after perf events with sequences of
+# characters not allowed in identifiers replaced by '_' (task-clock -> task_clock).
+DEFAULT_FORMULAS=[
+    ('ins-per-cycle','instructions / cycles'),
+    # task-clock is counted in milliseconds
+    ('GHz','cycles / (task_clock * 1e6)'),
+    ('CPUs-utilized','task_clock / (elapsed_time * 1000)'),
+    ('cycles spent due to TLBmiss (%)','(dTLBmiss_cycles + iTLBmiss_cycles) / cycles * 100'),
+]
+
+# Functions that can be called in formulas
+FORMULA_FUNCTIONS={'min':min,'max':max,'abs':abs,'sqrt':math.sqrt,'log':math.log,'exp':math.exp}
+
+FORMULA_NODES=(ast.Expression,ast.BinOp,ast.UnaryOp,ast.Call,ast.Name,ast.Load,
+               ast.Add,ast.Sub,ast.Mult,ast.Div,ast.Mod,ast.USub,ast.UAdd)
+
+
+def identifier(metric_name):
+    """ Name of a metric in formulas (ex: 'frontend bound (%)' -> frontend_bound) """
+    return re.sub(r'\W+','_',metric_name).strip('_')
+
+
+class Formula :
+    """ Arithmetic expression over metrics evaluated for many ranks (or intervals) at once """
+
+    def __init__(self,name,expression):
+        self.name=name
+        self.expression=expression
+
+        try:
+            tree=ast.parse(expression.strip(),mode='eval')
+        except SyntaxError as e:
+            raise ValueError("invalid formula {}: {}".format(name,e))
+
+        # Only arithmetic is allowed, formulas may come from user files
+        self.variables=[]
+        for node in ast.walk(tree):
+            if isinstance(node,ast.Call):
+                if not isinstance(node.func,ast.Name) or node.func.id not in FORMULA_FUNCTIONS or node.keywords:
+                    raise ValueError("invalid formula {}: unknown function".format(name))
+            elif isinstance(node,ast.Name):
+                if node.id not in FORMULA_FUNCTIONS and node.id not in self.variables:
+                    self.variables.append(node.id)
+            elif isinstance(node,ast.Constant if hasattr(ast,'Constant') else ast.Num):
+                if not isinstance(getattr(node,'value',getattr(node,'n',None)),(int,float)):
+                    raise ValueError("invalid formula {}: only numbers are allowed".format(name))
+            elif not isinstance(node,FORMULA_NODES):
+                raise ValueError("invalid formula {}: {} is not allowed".format(name,type(node).__name__))
+
+        # Formula is compiled once into a function of one value of each variable
+        namespace={'__builtins__':{}}
+        namespace.update(FORMULA_FUNCTIONS)
+        self.function=eval(compile('lambda {}: ({})'.format(','.join(self.variables),expression.strip()),
+                                   '<formula {}>'.format(name),'eval'),namespace)
+
+    def evaluate(self,columns):
+        """ Evaluate formula over columns (dictionnary variable -> sequence of values).
+        Return the list of results, NaN where a value is missing or the formula is undefined,
+        or None if a variable has no column. """
+        if any(variable not in columns for variable in self.variables):
+            return None
+        variable_columns=[columns[variable] for variable in self.variables]
+
+        try:
+            results=[float(result) for result in map(self.function,*variable_columns)]
+        except (ArithmeticError,ValueError):
+            # Only undefined values (division by zero...) are NaN
+            results=[self._evaluate_values(values) for values in zip(*variable_columns)]
+
+        # Missing values are NaN, even where the formula does not propagate them (min, max)
+        for values in variable_columns:
+            if any(math.isnan(value) for value in values):
+                results=[float("nan") if math.isnan(value) else result for result,value in zip(results,values)]
+        return results
+
+    def _evaluate_values(self,values):
+        try:
+            return float(self.function(*values))
+        except (ArithmeticError,ValueError):
+            return float("nan")
+
+
+class DerivedMetricsRegistry :
+    """ Ordered list of formulas, a formula can use metrics computed by previous ones """
+
+    def __init__(self,formulas=DEFAULT_FORMULAS):
+        self.formulas=[]
+        # (metric type,metric name) of metrics added by evaluate()
+        self.computed_metrics=set()
+        for name,expression in formulas:
+            self.add_formula(name,expression)
+
+    def add_formula(self,name,expression):
+        """ Add a formula, or replace the formula of a metric keeping its evaluation order """
+        formula=Formula(name,expression)
+        for iformula,previous_formula in enumerate(self.formulas):
+            if previous_formula.name==name:
+                self.formulas[iformula]=formula
+                return
+        self.formulas.append(formula)
+
+    def load_file(self,formulas_file):
+        """ Add formulas of a file with one '<metric name> = <expression>' per line, # starts a comment """
+        with open(formulas_file,'r') as ff:
+            for line_number,line in enumerate(ff,1):
+                line=line.split('#')[0].strip()
+                if not line:
+                    continue
+                name,equal,expression=line.partition('=')
+                if not equal or not name.strip():
+                    raise ValueError("{}:{}: expected '<metric name> = <expression>'".format(formulas_file,line_number))
+                self.add_formula(name.strip(),expression)
+
+    def evaluate_columns(self,columns):
+        """ Evaluate formulas over columns (dictionnary metric name -> sequence of values), return
+        the dictionnary metric name -> list of values of computed metrics.
+        A formula named after one of the columns is rejected with ValueError. """
+        for formula in self.formulas:
+            if formula.name in columns:
+                raise ValueError("formula {} has the name of an existing metric".format(formula.name))
+
+        variables={identifier(name):values for name,values in columns.items()}
+        results={}
+        for formula in self.formulas:
+            values=formula.evaluate(variables)
+            if values is None:
+                continue
+            results[formula.name]=values
+            variables[identifier(formula.name)]=values
+        return results
+
+    def evaluate(self,metrics_manager,metric_type,ranks,source_types=None):
+        """ Add metrics computed from metrics of source_types (default is metric_type) for all ranks """
+        # Metrics computed by a previous evaluation are computed again from scratch
+        for formula in self.formulas:
+            if (metric_type,formula.name) in self.computed_metrics:
+                metrics_manager.remove_metric(metric_type,formula.name)
+
+        columns={}
+        for source_type in (source_types or [metric_type]):
+            for metric_name in metrics_manager.get_metric_names(source_type):
+                columns.setdefault(metric_name,metrics_manager.get_metric_array(source_type,metric_name,ranks))
+
+        for metric_name,values in self.evaluate_columns(columns).items():
+            self.computed_metrics.add((metric_type,metric_name))
+            for rank,value in zip(ranks,values):
+                if not math.isnan(value):
+                    metrics_manager.add_metric(rank,metric_type,metric_name,value)
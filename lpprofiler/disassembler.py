@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#  This file is part of the LPprofiler profiling tool.                       #
+#        Copyright (C) 2017  EDF SA                                          #
+#                                                                            #
+#  LPprofiler is free software: you can redistribute it and/or modify        #
+#  it under the terms of the GNU General Public License as published by      #
+#  the Free Software Foundation, either version 3 of the License, or         #
+#  (at your option) any later version.                                       #
+#                                                                            #
+#  LPprofiler is distributed in the hope that it will be useful,             #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of            #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the             #
+#  GNU General Public License for more details.                              #
+#                                                                            #
+#  You should have received a copy of the GNU General Public License         #
+#  along with LPprofiler.  If not, see <http://www.gnu.org/licenses/>.       #
+#                                                                            #
+##############################################################################
+
+from subprocess import Popen,PIPE,DEVNULL
+from array import array
+import lpprofiler.disassembly_cache as discache
+import lpprofiler.isa_classifier as isacl
+import bisect, io, re, struct
+
+# Longest x86 instruction is 15 bytes, an address further than that from the
+# closest preceding instruction start lies outside of any disassembled section.
+MAX_INS_LENGTH=16
+
+INS_LINE_RE=re.compile(r"^\s*([0-9a-f]+):\s+(\S+)\s*(.*)")
+SYM_LINE_RE=re.compile(r"^([0-9a-f]+) <(.+)>:\s*$")
+# Symbol version suffixes (foo@@GLIBC_2.2.5) are not shown by perf, plt stubs are
+SYM_VERSION_RE=re.compile(r"@@?(?!plt$)[^@]*$")
+
+ET_DYN=3
+
+UNKNOWN_FORM=(None,'unknown','')
+
+# ELF machines of the ISAs known by the instruction classifier
+ELF_MACHINES={3:isacl.ISA_X86_64,62:isacl.ISA_X86_64,183:isacl.ISA_AARCH64}
+
+
+def is_position_independent(binary_path):
+    """ True for shared libraries and PIE executables whose addresses are relative to their load address """
+    try:
+        with open(binary_path,'rb') as f:
+            elf_header=f.read(18)
+    except OSError:
+        return False
+    if len(elf_header)<18 or elf_header[:4]!=b'\x7fELF':
+        return False
+    endian='<' if elf_header[5]==1 else '>'
+    return struct.unpack_from(endian+'H',elf_header,16)[0]==ET_DYN
+
+
+def get_isa(binary_path):
+    """ Instruction set of an ELF binary, None if it is not known """
+    try:
+        with open(binary_path,'rb') as f:
+            elf_header=f.read(20)
+    except OSError:
+        return None
+    if len(elf_header)<20 or elf_header[:4]!=b'\x7fELF':
+        return None
+    endian='<' if elf_header[5]==1 else '>'
+    return ELF_MACHINES.get(struct.unpack_from(endian+'H',elf_header,18)[0])
+
+
+class DisassemblyTable :
+    """ Sorted address -> instruction and address -> symbol tables of one binary """
+
+    def __init__(self,isa=None):
+        self.isa=isa
+
+        # Instruction start addresses and interned mnemonic ids, sorted by address
+        self.ins_addresses=array('Q')
+        self.ins_ids=array('I')
+        self.mnemonics=[]
+        self._mnemonic_ids={}
+
+        # Interned vector register class of each instruction (xmm, v0.2d...), used to
+        # classify vector instructions whose mnemonic does not tell the vector length.
+        self.ins_registers=array('B')
+        self.register_classes=['']
+        self._register_ids={'':0}
+
+        # Symbol start addresses and names, sorted by address
+        self.sym_addresses=array('Q')
+        self.sym_names=[]
+
+    def _intern(self,mnemonic):
+        ins_id=self._mnemonic_ids.get(mnemonic)
+        if ins_id is None:
+            ins_id=len(self.mnemonics)
+            self._mnemonic_ids[mnemonic]=ins_id
+            self.mnemonics.append(mnemonic)
+        return ins_id
+
+    def _intern_register(self,register_class):
+        register_id=self._register_ids.get(register_class)
+        if register_id is None:
+            register_id=len(self.register_classes)
+            self._register_ids[register_class]=register_id
+            self.register_classes.append(register_class)
+        return register_id
+
+    def add_instruction(self,address,mnemonic,register_class=''):
+        self.ins_addresses.append(address)
+        self.ins_ids.append(self._intern(mnemonic))
+        self.ins_registers.append(self._intern_register(register_class))
+
+    def add_symbol(self,address,name):
+        self.sym_addresses.append(address)
+        self.sym_names.append(name)
+
+    def sort(self):
+        """ Sort tables by address, objdump output is only sorted within a section """
+        if any(a>b for a,b in zip(self.ins_addresses,self.ins_addresses[1:])):
+            order=sorted(range(len(self.ins_addresses)),key=self.ins_addresses.__getitem__)
+            self.ins_addresses=array('Q',(self.ins_addresses[i] for i in order))
+            self.ins_ids=array('I',(self.ins_ids[i] for i in order))
+            self.ins_registers=array('B',(self.ins_registers[i] for i in order))
+        if any(a>b for a,b in zip(self.sym_addresses,self.sym_addresses[1:])):
+            order=sorted(range(len(self.sym_addresses)),key=self.sym_addresses.__getitem__)
+            self.sym_addresses=array('Q',(self.sym_addresses[i] for i in order))
+            self.sym_names=[self.sym_names[i] for i in order]
+
+    def get_state(self):
+        """ Picklable state of the table, used by the persistent disassembly cache """
+        return {'isa':self.isa,
+                'ins_addresses':self.ins_addresses.tobytes(),
+                'ins_ids':self.ins_ids.tobytes(),
+                'mnemonics':self.mnemonics,
+                'ins_registers':self.ins_registers.tobytes(),
+                'register_classes':self.register_classes,
+                'sym_addresses':self.sym_addresses.tobytes(),
+                'sym_names':self.sym_names}
+
+    @classmethod
+    def from_state(cls,state):
+        """ Rebuild a table from get_state() output """
+        table=cls(state['isa'])
+        table.ins_addresses.frombytes(state['ins_addresses'])
+        table.ins_ids.frombytes(state['ins_ids'])
+        table.mnemonics=state['mnemonics']
+        table._mnemonic_ids={mnemonic:ins_id for ins_id,mnemonic in enumerate(table.mnemonics)}
+        table.ins_registers.frombytes(state['ins_registers'])
+        table.register_classes=state['register_classes']
+        table._register_ids={register_class:register_id
+                             for register_id,register_class in enumerate(table.register_classes)}
+        table.sym_addresses.frombytes(state['sym_addresses'])
+        table.sym_names=state['sym_names']
+        return table
+
+    def _lookup_ins_index(self,address):
+        idx=bisect.bisect_right(self.ins_addresses,address)-1
+        if idx<0 or address-self.ins_addresses[idx]>=MAX_INS_LENGTH:
+            return None
+        return idx
+
+    def lookup_ins(self,address):
+        """ Return the mnemonic of the instruction containing address or None """
+        idx=self._lookup_ins_index(address)
+        if idx is None:
+            return None
+        return self.mnemonics[self.ins_ids[idx]]
+
+    def lookup_form(self,address):
+        """ Return (isa,mnemonic,register class) of the instruction containing address or None """
+        idx=self._lookup_ins_index(address)
+        if idx is None:
+            return None
+        return (self.isa,self.mnemonics[self.ins_ids[idx]],self.register_classes[self.ins_registers[idx]])
+
+    def lookup_sym(self,address):
+        """ Return the name of the symbol containing address or None """
+        idx=bisect.bisect_right(self.sym_addresses,address)-1
+        if idx<0:
+            return None
+        # Symbol sizes are not known, the last one ends with the last instruction
+        if self.ins_addresses and address-self.ins_addresses[-1]>=MAX_INS_LENGTH:
+            return None
+        return self.sym_names[idx]
+
+
+class Disassembler :
+    """ Disassemble each binary once with objdump and resolve addresses with a binary search
+    in the resulting tables. Tables are shared between runs through an optional
+    persistent cache. """
+
+    def __init__(self,cache=None):
+        self.tables={}
+        self.cache=cache
+
+    def get_table(self,binary_path):
+        """ Return disassembly table of binary_path, disassembling it on first call """
+        if binary_path not in self.tables:
+            self.tables[binary_path]=self._load_table(binary_path)
+        return self.tables[binary_path]
+
+    def _load_table(self,binary_path):
+        """ Get table from persistent cache or disassemble binary and fill the cache """
+        if not self.cache:
+            return self._disassemble(binary_path)
+
+        try:
+            key=discache.get_binary_key(binary_path)
+        except OSError:
+            return self._disassemble(binary_path)
+
+        state=self.cache.load(key)
+        if state is not None:
+            return DisassemblyTable.from_state(state)
+
+        table=self._disassemble(binary_path)
+        self.cache.store(key,table.get_state())
+        return table
+
+    def get_asm_ins(self,binary_path,address):
+        """ Get assembler instruction from a binary path and an address relative to the binary """
+        return self.get_asm_form(binary_path,address)[1]
+
+    def get_asm_form(self,binary_path,address):
+        """ Get (isa,mnemonic,register class) of the instruction at an address relative to the binary """
+        form=self.get_table(binary_path).lookup_form(address)
+        if form is None:
+            return UNKNOWN_FORM
+        return form
+
+    def _disassemble(self,binary_path):
+        """ Run objdump once on the whole binary and parse its output line by line """
+        table=DisassemblyTable(get_isa(binary_path))
+
+        objdump_cmd=['objdump','-d','-w','-C','--no-show-raw-insn',binary_path]
+        objdump_process=Popen(objdump_cmd,stdout=PIPE,stderr=DEVNULL)
+
+        for line in io.TextIOWrapper(objdump_process.stdout,encoding='utf-8',errors='replace'):
+            m=INS_LINE_RE.match(line)
+            if m:
+                table.add_instruction(int(m.group(1),16),m.group(2),isacl.get_register_class(table.isa,m.group(3)))
+                continue
+            m=SYM_LINE_RE.match(line)
+            if m:
+                table.add_symbol(int(m.group(1),16),SYM_VERSION_RE.sub('',m.group(2)))
+
+        objdump_process.wait()
+        table.sort()
+
+        return table
@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#  This file is part of the LPprofiler profiling tool.                       #
+#        Copyright (C) 2017  EDF SA                                          #
+#                                                                            #
+#  LPprofiler is free software: you can redistribute it and/or modify        #
+#  it under the terms of the GNU General Public License as published by      #
+#  the Free Software Foundation, either version 3 of the License, or         #
+#  (at your option) any later version.                                       #
+#                                                                            #
+#  LPprofiler is distributed in the hope that it will be useful,             #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of            #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the             #
+#  GNU General Public License for more details.                              #
+#                                                                            #
+#  You should have received a copy of the GNU General Public License         #
+#  along with LPprofiler.  If not, see <http://www.gnu.org/licenses/>.       #
+#                                                                            #
+##############################################################################
+
+import os, struct, pickle, zlib, hashlib, tempfile, binascii, mmap, time
+
+# Bump when the layout of cached entries changes, older entries are then ignored
+CACHE_FORMAT_VERSION=3
+
+CACHE_SUFFIX='.lpdis'
+TMP_PREFIX='.tmp_'
+# Temporary files older than this (seconds) were left by killed writers
+STALE_TMP_AGE=3600
+
+DEFAULT_CACHE_SIZE=1024*1024*1024
+
+PT_NOTE=4
+SHT_NOTE=7
+NT_GNU_BUILD_ID=3
+
+
+def default_cache_dir():
+    """ Cache directory used when none is given on the command line """
+    if os.environ.get('LPPROF_CACHE_DIR'):
+        return os.environ.get('LPPROF_CACHE_DIR')
+    if os.environ.get('XDG_CACHE_HOME'):
+        return os.path.join(os.environ.get('XDG_CACHE_HOME'),'lpprof')
+    return os.path.join(os.path.expanduser('~'),'.cache','lpprof')
+
+
+def _iter_notes(data,offset,size,align,endian):
+    """ Yield (name,type,desc) of each note found in data[offset:offset+size] """
+    end=offset+size
+    while offset+12<=end:
+        namesz,descsz,note_type=struct.unpack_from(endian+'III',data,offset)
+        offset+=12
+        name=bytes(data[offset:offset+namesz])
+        offset+=(namesz+align-1)//align*align
+        desc=bytes(data[offset:offset+descsz])
+        offset+=(descsz+align-1)//align*align
+        yield name,note_type,desc
+
+
+def get_build_id(binary_path):
+    """ Read GNU build-id of an ELF file, return None if binary has no build-id """
+    try:
+        with open(binary_path,'rb') as f:
+            # Only headers and notes are read, the binary is not loaded in memory
+            data=mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+    except (OSError,ValueError):
+        return None
+
+    try:
+        return _read_build_id(data)
+    finally:
+        data.close()
+
+
+def _read_build_id(data):
+    """ Walk ELF program headers (or section headers) of data to find the build-id note """
+    if len(data)<64 or data[:4]!=b'\x7fELF':
+        return None
+
+    elf_class=data[4]
+    endian='<' if data[5]==1 else '>'
+
+    if elf_class==2:
+        (e_phoff,e_shoff)=struct.unpack_from(endian+'QQ',data,32)
+        (e_phentsize,e_phnum,e_shentsize,e_shnum)=struct.unpack_from(endian+'HHHH',data,54)
+    else:
+        (e_phoff,e_shoff)=struct.unpack_from(endian+'II',data,28)
+        (e_phentsize,e_phnum,e_shentsize,e_shnum)=struct.unpack_from(endian+'HHHH',data,42)
+
+    note_areas=[]
+    try:
+        for iph in range(e_phnum):
+            ph_offset=e_phoff+iph*e_phentsize
+            if elf_class==2:
+                p_type,p_flags,p_offset,p_vaddr,p_paddr,p_filesz,p_memsz,p_align=\
+                    struct.unpack_from(endian+'IIQQQQQQ',data,ph_offset)
+            else:
+                p_type,p_offset,p_vaddr,p_paddr,p_filesz,p_memsz,p_flags,p_align=\
+                    struct.unpack_from(endian+'IIIIIIII',data,ph_offset)
+            if p_type==PT_NOTE:
+                note_areas.append((p_offset,p_filesz,p_align))
+
+        # Relocatable objects have no program headers, notes are only found in sections
+        if not note_areas:
+            for ish in range(e_shnum):
+                sh_offset=e_shoff+ish*e_shentsize
+                if elf_class==2:
+                    sh_name,sh_type,sh_flags,sh_addr,s_offset,s_size,sh_link,sh_info,s_align=\
+                        struct.unpack_from(endian+'IIQQQQIIQ',data,sh_offset)
+                else:
+                    sh_name,sh_type,sh_flags,sh_addr,s_offset,s_size,sh_link,sh_info,s_align=\
+                        struct.unpack_from(endian+'IIIIIIIII',data,sh_offset)
+                if sh_type==SHT_NOTE:
+                    note_areas.append((s_offset,s_size,s_align))
+
+        for offset,size,align in note_areas:
+            align=8 if align==8 else 4
+            for name,note_type,desc in _iter_notes(data,offset,size,align,endian):
+                if note_type==NT_GNU_BUILD_ID and name.rstrip(b'\0')==b'GNU':
+                    return binascii.hexlify(desc).decode('ascii')
+    except struct.error:
+        return None
+
+    return None
+
+
+def get_binary_key(binary_path):
+    """ Cache key of a binary: its build-id, or its path, mtime and size if it has none """
+    build_id=get_build_id(binary_path)
+    if build_id:
+        return 'buildid-'+build_id
+
+    st=os.stat(binary_path)
+    path_hash=hashlib.sha1(os.path.abspath(binary_path).encode('utf-8')).hexdigest()
+    return 'path-{}-{}-{}'.format(path_hash,int(st.st_mtime),st.st_size)
+
+
+class DisassemblyCache :
+    """ Persistent on-disk cache of disassembly tables shared by lpprof processes.
+    Entries are written atomically so that concurrent readers never see partial files.
+    Least recently used entries are evicted when the cache exceeds max_size bytes. """
+
+    def __init__(self,cache_dir=None,max_size=DEFAULT_CACHE_SIZE):
+
+        if cache_dir:
+            self.cache_dir=cache_dir
+        else:
+            self.cache_dir=default_cache_dir()
+
+        self.max_size=max_size
+        # Size of cached entries, computed by the first eviction and then kept up to date
+        # by store(). Other processes sharing the directory are only seen on eviction.
+        self.size=None
+
+        try:
+            os.makedirs(self.cache_dir,exist_ok=True)
+        except OSError:
+            # Cache is an optimization only, lpprof works without it
+            self.cache_dir=None
+
+    def _entry_path(self,key):
+        return os.path.join(self.cache_dir,key+CACHE_SUFFIX)
+
+    def load(self,key):
+        """ Return the state stored for key or None """
+        if not self.cache_dir:
+            return None
+
+        entry_path=self._entry_path(key)
+        try:
+            with open(entry_path,'rb') as f:
+                version,state=pickle.loads(zlib.decompress(f.read()))
+        except (OSError,EOFError,ValueError,TypeError,zlib.error,pickle.UnpicklingError):
+            return None
+
+        if version!=CACHE_FORMAT_VERSION:
+            return None
+
+        # Entry modification time is used as last access time for LRU eviction
+        try:
+            os.utime(entry_path)
+        except OSError:
+            pass
+
+        return state
+
+    def store(self,key,state):
+        """ Atomically write state for key and evict least recently used entries """
+        if not self.cache_dir:
+            return
+
+        payload=zlib.compress(pickle.dumps((CACHE_FORMAT_VERSION,state),pickle.HIGHEST_PROTOCOL),1)
+        if len(payload)>self.max_size:
+            return
+
+        entry_path=self._entry_path(key)
+        try:
+            old_size=os.stat(entry_path).st_size
+        except OSError:
+            old_size=0
+
+        try:
+            fd,tmp_path=tempfile.mkstemp(dir=self.cache_dir,prefix=TMP_PREFIX)
+        except OSError:
+            return
+        try:
+            with os.fdopen(fd,'wb') as f:
+                f.write(payload)
+            os.replace(tmp_path,entry_path)
+        except OSError:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return
+
+        if self.size is not None:
+            self.size+=len(payload)-old_size
+        if self.size is None or self.size>self.max_size:
+            self.evict()
+
+    def evict(self):
+        """ Remove least recently used entries until cache size is below max_size,
+        and temporary files left by interrupted stores """
+        entries=[]
+        total_size=0
+        now=time.time()
+        try:
+            for entry_name in os.listdir(self.cache_dir):
+                entry_path=os.path.join(self.cache_dir,entry_name)
+                if entry_name.endswith(CACHE_SUFFIX):
+                    try:
+                        st=os.stat(entry_path)
+                    except OSError:
+                        continue
+                    entries.append((st.st_mtime,st.st_size,entry_path))
+                    total_size+=st.st_size
+                elif entry_name.startswith(TMP_PREFIX):
+                    try:
+                        if now-os.stat(entry_path).st_mtime>STALE_TMP_AGE:
+                            os.remove(entry_path)
+                    except OSError:
+                        pass
+        except OSError:
+            return
+
+        for mtime,size,path in sorted(entries):
+            if total_size<=self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total_size-=size
+
+        self.size=total_size
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#  This file is part of the LPprofiler profiling tool.                       #
+#        Copyright (C) 2017  EDF SA                                          #
+#                                                                            #
+#  LPprofiler is free software: you can redistribute it and/or modify        #
+#  it under the terms of the GNU General Public License as published by      #
+#  the Free Software Foundation, either version 3 of the License, or         #
+#  (at your option) any later version.                                       #
+#                                                                            #
+#  LPprofiler is distributed in the hope that it will be useful,             #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of            #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the             #
+#  GNU General Public License for more details.                              #
+#                                                                            #
+#  You should have received a copy of the GNU General Public License         #
+#  along with LPprofiler.  If not, see <http://www.gnu.org/licenses/>.       #
+#                                                                            #
+############################################################################## 
+
+from html import escape
+import lpprofiler.call_tree as calltree
+import zlib
+
+# Folded stacks: frames from the outermost caller separated by ';', then the number of samples
+FOLDED_SEPARATOR=';'
+
+SVG_WIDTH=1200
+SVG_PADDING=10
+FRAME_HEIGHT=16
+FONT_SIZE=12
+FONT_WIDTH=0.59
+# Frames narrower than this (in pixels) are not drawn
+MIN_FRAME_WIDTH=0.1
+
+
+def iter_folded(call_tree):
+    """ Yield one folded stack line per call path ending in sampled frames """
+    for node in range(1,len(call_tree)+1):
+        if call_tree.exclusive[node]:
+            frames=[frame.replace(FOLDED_SEPARATOR,',') for frame in call_tree.get_path(node)]
+            yield "{} {:.15g}\n".format(FOLDED_SEPARATOR.join(frames),call_tree.exclusive[node])
+
+
+def write_folded(call_tree,folded_path):
+    """ Write folded stacks of a call tree, the format of stackcollapse-perf.pl """
+    with open(folded_path,'w') as folded_file:
+        folded_file.writelines(iter_folded(call_tree))
+
+
+def read_folded(folded_path,call_tree=None):
+    """ Add stacks of a folded stacks file to call_tree (a new one by default) and return it """
+    if call_tree is None:
+        call_tree=calltree.CallTree()
+    with open(folded_path) as folded_file:
+        for line in folded_file:
+            stack,_,count=line.rstrip('\n').rpartition(' ')
+            try:
+                count=float(count)
+            except ValueError:
+                continue
+            if stack:
+                call_tree.add_path(stack.split(FOLDED_SEPARATOR),count)
+    return call_tree
+
+
+def _frame_color(frame):
+    """ Warm color of a frame, the same frame has the same color in every graph """
+    h=zlib.crc32(frame.encode('utf-8','replace'))
+    return "rgb({},{},{})".format(205+(h&0xff)*50//255,((h>>8)&0xff)*230//255,((h>>16)&0xff)*55//255)
+
+
+def _delta_color(delta):
+    """ Red for frames with more samples than in the base graph, blue for fewer,
+    delta is the difference of samples relative to the largest difference """
+    fade=int(210*(1-min(abs(delta),1)))
+    if delta>0:
+        return "rgb(255,{0},{0})".format(fade)
+    if delta<0:
+        return "rgb({0},{0},255)".format(fade)
+    return "rgb(250,250,250)"
+
+
+def _frame_label(frame,width):
+    """ Frame name truncated to the width of its rectangle """
+    nb_chars=int((width-6)/(FONT_SIZE*FONT_WIDTH))
+    if nb_chars<3:
+        return ''
+    if len(frame)>nb_chars:
+        return frame[:nb_chars-2]+'..'
+    return frame
+
+
+def write_svg(call_tree,svg_path,title="Flame Graph",base_tree=None):
+    """ Render a call tree as a flame graph: callers below callees, frames of a same
+    caller sorted by name and frame widths proportional to inclusive samples.
+    With base_tree, frames are colored by their difference of samples with the same
+    call path of base_tree, scaled to the total samples of call_tree (differential flame graph). """
+
+    total_samples=call_tree.get_total()
+    children=call_tree.get_children()
+    for node_children in children:
+        node_children.sort(key=call_tree.get_frame)
+
+    # Nodes in drawing order with their depth, x position and node of the same path in base_tree
+    scale=(SVG_WIDTH-2*SVG_PADDING)/total_samples if total_samples else 0
+    base_scale=None
+    if base_tree is not None and base_tree.get_total():
+        base_scale=total_samples/base_tree.get_total()
+    frames=[]
+    stack=[(0,0,SVG_PADDING,0 if base_scale else None)]
+    while stack:
+        node,depth,x,base_node=stack.pop()
+        width=call_tree.inclusive[node]*scale
+        if width<MIN_FRAME_WIDTH:
+            continue
+        delta=None
+        if base_tree is not None:
+            base_samples=base_tree.inclusive[base_node]*base_scale if base_node is not None else 0
+            delta=call_tree.inclusive[node]-base_samples
+        frames.append((node,depth,x,width,delta))
+
+        child_x=x
+        child_stack=[]
+        for child in children[node]:
+            base_child=None
+            if base_node is not None:
+                base_child=base_tree.get_child(base_node,call_tree.get_frame(child))
+            child_stack.append((child,depth+1,child_x,base_child))
+            child_x+=call_tree.inclusive[child]*scale
+        stack.extend(reversed(child_stack))
+
+    max_depth=max((depth for node,depth,x,width,delta in frames),default=0)
+    max_delta=max((abs(delta) for node,depth,x,width,delta in frames if delta is not None),default=0)
+    height=(max_depth+1)*FRAME_HEIGHT+3*FONT_SIZE+2*SVG_PADDING
+
+    with open(svg_path,'w') as svg_file:
+        svg_file.write('<?xml version="1.0" standalone="no"?>\n')
+        svg_file.write('<svg version="1.1" width="{}" height="{}" xmlns="http://www.w3.org/2000/svg">\n'
+                       .format(SVG_WIDTH,height))
+        svg_file.write('<rect x="0" y="0" width="{}" height="{}" fill="rgb(248,248,248)"/>\n'
+                       .format(SVG_WIDTH,height))
+        svg_file.write('<text x="{}" y="{}" font-size="{}" font-family="Verdana" text-anchor="middle">{}</text>\n'
+                       .format(SVG_WIDTH//2,SVG_PADDING+FONT_SIZE,FONT_SIZE+5,escape(title)))
+
+        for node,depth,x,width,delta in frames:
+            frame=call_tree.get_frame(node) if node else 'all'
+            y=height-SVG_PADDING-(depth+1)*FRAME_HEIGHT
+            if delta is None:
+                color=_frame_color(frame)
+                info="{} ({:.15g} samples, {:.2f}%)".format(
+                    frame,call_tree.inclusive[node],call_tree.inclusive[node]/total_samples*100)
+            else:
+                color=_delta_color(delta/max_delta if max_delta else 0)
+                info="{} ({:.15g} samples, {:.2f}%, {:+.4g})".format(
+                    frame,call_tree.inclusive[node],call_tree.inclusive[node]/total_samples*100,delta)
+            svg_file.write('<g><title>{}</title><rect x="{:.1f}" y="{}" width="{:.1f}" height="{}" '
+                           'fill="{}" rx="2" ry="2"/>'.format(escape(info),x,y,width,FRAME_HEIGHT-1,color))
+            label=_frame_label(frame,width)
+            if label:
+                svg_file.write('<text x="{:.1f}" y="{}" font-size="{}" font-family="Verdana">{}</text>'
+                               .format(x+3,y+FRAME_HEIGHT-4,FONT_SIZE,escape(label)))
+            svg_file.write('</g>\n')
+
+        svg_file.write('</svg>\n')
@@ -0,0 +1,350 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#  This file is part of the LPprofiler profiling tool.                       #
+#        Copyright (C) 2017  EDF SA                                          #
+#                                                                            #
+#  LPprofiler is free software: you can redistribute it and/or modify        #
+#  it under the terms of the GNU General Public License as published by      #
+#  the Free Software Foundation, either version 3 of the License, or         #
+#  (at your option) any later version.                                       #
+#                                                                            #
+#  LPprofiler is distributed in the hope that it will be useful,             #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of            #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the             #
+#  GNU General Public License for more details.                              #
+#                                                                            #
+#  You should have received a copy of the GNU General Public License         #
+#  along with LPprofiler.  If not, see <http://www.gnu.org/licenses/>.       #
+#                                                                            #
+############################################################################## 
+
+from subprocess import Popen,PIPE,TimeoutExpired
+import ctypes, ctypes.util, json, os, selectors, signal, socket, struct, sys, time
+
+# Processes launched by slurm keep the name of slurmstepd until they exec the application
+PRE_EXEC_COMM='slurmstepd'
+
+# Used only when exec or exit events are not available (no netlink proc connector or pidfd)
+FALLBACK_POLL_INTERVAL=0.1
+
+# perf processes are given this long to write their outputs once interrupted
+STOP_TIMEOUT=30
+
+# Exit status of perf commands interrupted by SIGINT, directly or through a shell
+STOPPED_STATUSES=(0,-signal.SIGINT,128+signal.SIGINT)
+
+# Netlink proc connector, see linux/cn_proc.h
+NETLINK_CONNECTOR=11
+CN_IDX_PROC=1
+CN_VAL_PROC=1
+PROC_CN_MCAST_LISTEN=1
+PROC_EVENT_EXEC=0x2
+NLMSG_DONE=3
+NLMSG_HEADER=struct.Struct('=IHHII')
+CN_MSG_HEADER=struct.Struct('=IIIIHH')
+PROC_EVENT_HEADER=struct.Struct('=IIQ')
+PROC_EVENT_PIDS=struct.Struct('=ii')
+
+IN_CREATE=0x100
+IN_MOVED_TO=0x80
+INOTIFY_EVENT_HEADER=struct.Struct('=iIII')
+
+
+def _read_comm(pid):
+    """ Command name of pid, None if it has exited """
+    try:
+        with open('/proc/{}/comm'.format(pid)) as comm_file:
+            return comm_file.read().rstrip('\n')
+    except OSError:
+        return None
+
+
+class ExecEvents :
+    """ Exec events of all processes from the netlink proc connector, needs CAP_NET_ADMIN """
+
+    def __init__(self):
+        self.sock=socket.socket(socket.AF_NETLINK,socket.SOCK_DGRAM,NETLINK_CONNECTOR)
+        try:
+            self.sock.bind((os.getpid(),CN_IDX_PROC))
+            op=struct.pack('=I',PROC_CN_MCAST_LISTEN)
+            cn_msg=CN_MSG_HEADER.pack(CN_IDX_PROC,CN_VAL_PROC,0,0,len(op),0)+op
+            self.sock.send(NLMSG_HEADER.pack(NLMSG_HEADER.size+len(cn_msg),NLMSG_DONE,0,0,os.getpid())+cn_msg)
+        except OSError:
+            self.sock.close()
+            raise
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def read_pids(self):
+        """ Pids of the processes that exec'd since the previous read """
+        data=self.sock.recv(65536)
+        pids=[]
+        offset=0
+        while offset+NLMSG_HEADER.size<=len(data):
+            msg_len=NLMSG_HEADER.unpack_from(data,offset)[0]
+            event_offset=offset+NLMSG_HEADER.size+CN_MSG_HEADER.size
+            if msg_len<NLMSG_HEADER.size or event_offset+PROC_EVENT_HEADER.size+PROC_EVENT_PIDS.size>len(data):
+                break
+            what=PROC_EVENT_HEADER.unpack_from(data,event_offset)[0]
+            if what==PROC_EVENT_EXEC:
+                pids.append(PROC_EVENT_PIDS.unpack_from(data,event_offset+PROC_EVENT_HEADER.size)[1])
+            offset+=(msg_len+3)&~3
+        return pids
+
+    def close(self):
+        self.sock.close()
+
+
+class FileCreation :
+    """ Wait for the creation of a file with inotify on its directory """
+
+    def __init__(self,path):
+        self.path=path
+        libc=ctypes.CDLL(ctypes.util.find_library('c'),use_errno=True)
+        self.fd=libc.inotify_init1(os.O_NONBLOCK|os.O_CLOEXEC)
+        if self.fd<0:
+            raise OSError(ctypes.get_errno(),'inotify_init1 failed')
+        if libc.inotify_add_watch(self.fd,os.path.dirname(os.path.abspath(path)).encode(),IN_CREATE|IN_MOVED_TO)<0:
+            errno=ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno,'inotify_add_watch failed')
+
+    def fileno(self):
+        return self.fd
+
+    def read_created(self):
+        """ True once the file was created """
+        try:
+            data=os.read(self.fd,65536)
+        except BlockingIOError:
+            data=b''
+        name=os.path.basename(self.path).encode()
+        offset=0
+        while offset+INOTIFY_EVENT_HEADER.size<=len(data):
+            wd,mask,cookie,name_len=INOTIFY_EVENT_HEADER.unpack_from(data,offset)
+            offset+=INOTIFY_EVENT_HEADER.size
+            if data[offset:offset+name_len].rstrip(b'\0')==name:
+                return True
+            offset+=name_len
+        return False
+
+    def close(self):
+        os.close(self.fd)
+
+
+class ProfiledTask :
+    """ A pid of the host and the perf command profiling it """
+
+    def __init__(self,rank,pid,cmd):
+        self.rank=rank
+        self.pid=pid
+        self.cmd=cmd
+        self.pidfd=None
+        self.perf_process=None
+
+
+class HostAgent :
+    """ Profile all the pids of a host from a single process. Each pid is profiled once it
+    exec'd the application and its perf commands are interrupted when it exits or when the
+    job_done file is created. Exec and exit events come from the netlink proc connector and
+    pidfds so that the agent sleeps until something happens. Events are reported to out as
+    JSON lines. """
+
+    def __init__(self,tasks,job_done=None,pre_exec_comm=PRE_EXEC_COMM,out=None):
+        self.tasks=[ProfiledTask(task['rank'],task['pid'],task['cmd']) for task in tasks]
+        self.job_done=job_done
+        self.pre_exec_comm=pre_exec_comm
+        self.out=out if out is not None else sys.stdout
+
+        self.selector=selectors.DefaultSelector()
+        self.waiting_exec={}
+        self.running={}
+        self.exec_events=None
+        self.file_creation=None
+        self.polled=False
+
+    def _report(self,event,task=None,**fields):
+        message={'event':event}
+        if task:
+            message.update(rank=task.rank,pid=task.pid)
+        message.update(fields)
+        self.out.write(json.dumps(message)+'\n')
+        self.out.flush()
+
+    def _fall_back_to_polling(self,reason):
+        """ Check pids and files every FALLBACK_POLL_INTERVAL, reported once per agent """
+        if not self.polled:
+            self.polled=True
+            self._report('polling',reason=reason,interval=FALLBACK_POLL_INTERVAL)
+
+    def _open_events(self):
+        try:
+            self.exec_events=ExecEvents()
+            self.selector.register(self.exec_events,selectors.EVENT_READ,'exec')
+        except OSError as e:
+            self.exec_events=None
+            self._fall_back_to_polling('no exec events, netlink proc connector needs CAP_NET_ADMIN ({})'.format(e))
+
+        if self.job_done:
+            try:
+                self.file_creation=FileCreation(self.job_done)
+                self.selector.register(self.file_creation,selectors.EVENT_READ,'job_done')
+            except (OSError,AttributeError) as e:
+                self.file_creation=None
+                self._fall_back_to_polling('no inotify on {} ({})'.format(os.path.dirname(self.job_done),e))
+
+    def _watch_exit(self,task):
+        try:
+            task.pidfd=os.pidfd_open(task.pid)
+        except ProcessLookupError:
+            return False
+        except (OSError,AttributeError) as e:
+            self._fall_back_to_polling('no exit events, pidfd_open needs Linux 5.3 and Python 3.9 ({})'.format(e))
+            return True
+        self.selector.register(task.pidfd,selectors.EVENT_READ,task)
+        return True
+
+    def _start(self,task):
+        """ Profile task whose pid runs the application """
+        self.waiting_exec.pop(task.pid,None)
+        try:
+            # perf messages must not be mixed with the events written to stdout
+            task.perf_process=Popen(task.cmd,shell=True,start_new_session=True,stdout=sys.stderr.fileno())
+        except OSError as e:
+            self._report('error',task,message=str(e))
+            self._close_task(task)
+            return
+        self.running[task.pid]=task
+        self._report('started',task)
+
+    def _stop(self,task,reason):
+        """ Interrupt perf commands of task, they write their outputs and exit """
+        self.running.pop(task.pid,None)
+        self.waiting_exec.pop(task.pid,None)
+        if task.perf_process:
+            try:
+                os.killpg(task.perf_process.pid,signal.SIGINT)
+            except ProcessLookupError:
+                pass
+        self._close_task(task)
+        self._report('stopping',task,reason=reason)
+
+    def _close_task(self,task):
+        if task.pidfd is not None:
+            self.selector.unregister(task.pidfd)
+            os.close(task.pidfd)
+            task.pidfd=None
+
+    def _is_started(self,task):
+        comm=_read_comm(task.pid)
+        return comm is not None and comm!=self.pre_exec_comm
+
+    def _poll(self):
+        """ Fallback checks when events are not available """
+        for task in list(self.waiting_exec.values()):
+            if _read_comm(task.pid) is None:
+                self._stop(task,'exit')
+            elif self._is_started(task):
+                self._start(task)
+        for task in list(self.running.values()):
+            if task.pidfd is None and _read_comm(task.pid) is None:
+                self._stop(task,'exit')
+        if self.job_done and self.file_creation is None and os.path.exists(self.job_done):
+            self._stop_all('job_done')
+
+    def _stop_all(self,reason):
+        for task in list(self.waiting_exec.values())+list(self.running.values()):
+            self._stop(task,reason)
+
+    def run(self):
+        """ Profile tasks until all pids exited or the job is done, return the number of perf commands that failed """
+        self._open_events()
+
+        # Exec events are listened to before the names are checked so that none is missed
+        for task in self.tasks:
+            if not self._watch_exit(task):
+                self._report('stopping',task,reason='exit')
+                continue
+            if self._is_started(task):
+                self._start(task)
+            else:
+                self.waiting_exec[task.pid]=task
+
+        if self.job_done and os.path.exists(self.job_done):
+            self._stop_all('job_done')
+
+        while self.waiting_exec or self.running:
+            timeout=FALLBACK_POLL_INTERVAL if self.polled else None
+            for key,mask in self.selector.select(timeout):
+                if key.data=='exec':
+                    for pid in self.exec_events.read_pids():
+                        task=self.waiting_exec.get(pid)
+                        if task and self._is_started(task):
+                            self._start(task)
+                elif key.data=='job_done':
+                    if self.file_creation.read_created():
+                        self._stop_all('job_done')
+                elif key.data.pid in self.waiting_exec or key.data.pid in self.running:
+                    self._stop(key.data,'exit')
+            if self.polled:
+                self._poll()
+
+        nb_failed=self._wait_perf()
+        self._close()
+        self._report('done',failed=nb_failed)
+        return nb_failed
+
+    def _wait_perf(self):
+        nb_failed=0
+        for task in self.tasks:
+            if task.perf_process:
+                try:
+                    status=task.perf_process.wait(STOP_TIMEOUT)
+                except TimeoutExpired:
+                    os.killpg(task.perf_process.pid,signal.SIGKILL)
+                    status=task.perf_process.wait()
+                self._report('stopped',task,status=status)
+                if status not in STOPPED_STATUSES:
+                    nb_failed+=1
+        return nb_failed
+
+    def _close(self):
+        if self.exec_events:
+            self.exec_events.close()
+        if self.file_creation:
+            self.file_creation.close()
+        self.selector.close()
+
+
+def write_tasks(tasks_file,tasks,job_done=None):
+    """ Write the tasks of a host agent: dicts with rank, pid and cmd keys """
+    with open(tasks_file,'w') as f:
+        json.dump({'job_done':job_done,'tasks':tasks},f)
+
+
+def run_agent(tasks_file,out=None):
+    """ Run the host agent of a tasks file written by write_tasks """
+    with open(tasks_file) as f:
+        agent_conf=json.load(f)
+    return HostAgent(agent_conf['tasks'],agent_conf.get('job_done'),out=out).run()
+
+
+def start_agent(agent_cmd):
+    """ Start an agent command, its events are read with read_agent_events() """
+    return Popen(agent_cmd,shell=True,stdout=PIPE,universal_newlines=True)
+
+
+def read_agent_events(agent_process):
+    """ Yield the events reported by an agent until it exits """
+    for line in agent_process.stdout:
+        try:
+            yield json.loads(line)
+        except ValueError:
+            # Lines written by perf commands
+            print(line,end='')
+    agent_process.stdout.close()
+    agent_process.wait()
+    if agent_process.returncode!=0:
+        yield {'event':'error','message':'agent exited with status {}'.format(agent_process.returncode)}
+
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#  This file is part of the LPprofiler profiling tool.                       #
+#        Copyright (C) 2017  EDF SA                                          #
+#                                                                            #
+#  LPprofiler is free software: you can redistribute it and/or modify        #
+#  it under the terms of the GNU General Public License as published by      #
+#  the Free Software Foundation, either version 3 of the License, or         #
+#  (at your option) any later version.                                       #
+#                                                                            #
+#  LPprofiler is distributed in the hope that it will be useful,             #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of            #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the             #
+#  GNU General Public License for more details.                              #
+#                                                                            #
+#  You should have received a copy of the GNU General Public License         #
+#  along with LPprofiler.  If not, see <http://www.gnu.org/licenses/>.       #
+#                                                                            #
+############################################################################## 
+
+from collections import namedtuple
+import re
+
+ISA_X86_64='x86_64'
+ISA_AARCH64='aarch64'
+
+# Narrowest SVE implementation, vector length of SVE instructions on unknown CPUs
+DEFAULT_SVE_VECTOR_BITS=128
+
+InstructionClass=namedtuple('InstructionClass',['category','element','element_bits','vector_bits','fma','flops'])
+
+OTHER_INSTRUCTION=InstructionClass('other',None,0,0,False,0)
+
+# Floating point element types by suffix (x86 ps/pd/sh...) or register (aarch64 d0, v0.4s, z0.h...)
+ELEMENTS={'h':('half',16),'s':('single',32),'d':('double',64),'x':('x87',80)}
+
+# Vector register classes: (register width in bits, None for SVE scalable registers, element letter)
+REGISTER_CLASSES={'xmm':(128,None),'ymm':(256,None),'zmm':(512,None),
+                  '4h':(64,'h'),'8h':(128,'h'),'2s':(64,'s'),'4s':(128,'s'),'1d':(64,'d'),'2d':(128,'d'),
+                  '8b':(64,'b'),'16b':(128,'b'),
+                  'z.b':(None,'b'),'z.h':(None,'h'),'z.s':(None,'s'),'z.d':(None,'d')}
+
+X86_REGISTER_RE=re.compile(r"%([xyz]mm)\d")
+X86_REGISTER_WIDTHS=['xmm','ymm','zmm']
+AARCH64_REGISTER_RE=re.compile(r"^([hsd])\d+\b|\bv\d+\.(\d+[bhsd])\b|\bz\d+\.([bhsd])\b")
+
+# Rules of each ISA: (mnemonic regex, category, fma, default element), applied in order.
+# Regex groups "shape" (p for packed, s for scalar) and "element" (an ELEMENTS letter) give
+# the shape and element of x86 instructions, aarch64 ones are given by their registers.
+X86_64_RULES=[
+    (r"^vf(?:n?m(?:add|sub)|maddsub|msubadd)(?:132|213|231)?(?P<shape>[ps])(?P<element>[hsd])$",'fp',True,None),
+    (r"^v?dp(?P<shape>p)(?P<element>[sd])$",'fp',True,None),
+    (r"^v?(?:add|sub|mul|div|sqrt|min|max|addsub|hadd|hsub|rcp|rsqrt|rcp14|rsqrt14|scalef)"
+     r"(?P<shape>[ps])(?P<element>[hsd])$",'fp',False,None),
+    (r"^f(?:add|sub|subr|mul|div|divr)p?[sl]?$|^fsqrt$",'fp',False,'x'),
+    (r"^v?p(?:add|sub|mul|madd|maddubs|sad|avg|min|max|abs|sign|and|andn|or|xor|sll|srl|sra|"
+     r"cmpeq|cmpgt|dpbusd|dpwssd)",'simd_int',False,None),
+]
+
+AARCH64_RULES=[
+    (r"^(?:fmla|fmls|fnmla|fnmls|fmad|fmsb|fnmad|fnmsb|fmadd|fmsub|fnmadd|fnmsub)$",'fp',True,None),
+    (r"^(?:fadd|fsub|fsubr|fmul|fmulx|fdiv|fdivr|fsqrt|fmin|fmax|fminnm|fmaxnm|fabd|faddp|"
+     r"frecpe|frecps|frsqrte|frsqrts)$",'fp',False,None),
+    (r"^(?:add|sub|mul|mla|mls|sqadd|uqadd|sqsub|uqsub|abs|neg|smax|smin|umax|umin|addp|"
+     r"saddl|uaddl|smull|umull|smlal|umlal|sdot|udot|and|orr|eor|bic|shl|sshr|ushr|cmeq|cmgt|cmge)$",
+     'simd_int',False,None),
+]
+
+ISA_RULES={ISA_X86_64:X86_64_RULES,ISA_AARCH64:AARCH64_RULES}
+
+
+def get_register_class(isa,operands):
+    """ Vector or floating point register class of an instruction from its objdump operands:
+    widest x86 vector register, or first aarch64 scalar FP, NEON or SVE register. '' if none. """
+    if isa==ISA_X86_64:
+        widths=X86_REGISTER_RE.findall(operands)
+        if not widths:
+            return ''
+        return max(widths,key=X86_REGISTER_WIDTHS.index)
+    if isa!=ISA_AARCH64:
+        return ''
+    m=AARCH64_REGISTER_RE.search(operands)
+    if not m:
+        return ''
+    if m.group(1):
+        return m.group(1)
+    if m.group(2):
+        return m.group(2)
+    return 'z.'+m.group(3)
+
+
+class IsaClassifier :
+    """ Classify instructions (isa,mnemonic,register class) with the rules of their ISA.
+    Each instruction form is classified once, later calls are dictionary lookups. """
+
+    def __init__(self,sve_vector_bits=DEFAULT_SVE_VECTOR_BITS,rules=None):
+        self.sve_vector_bits=sve_vector_bits
+        self.rules={}
+        for isa,isa_rules in (rules if rules is not None else ISA_RULES).items():
+            self.add_rules(isa,isa_rules)
+        self.classes={}
+
+    def add_rules(self,isa,rules):
+        """ Add (mnemonic regex, category, fma, default element) rules, tried before the rules already known """
+        self.rules[isa]=[(re.compile(regex),category,fma,element)
+                         for regex,category,fma,element in rules]+self.rules.get(isa,[])
+        self.classes={}
+
+    def classify(self,isa,mnemonic,register_class=''):
+        """ Return the InstructionClass of an instruction """
+        form=(isa,mnemonic,register_class)
+        instruction_class=self.classes.get(form)
+        if instruction_class is None:
+            instruction_class=self.classes[form]=self._classify(isa,mnemonic,register_class)
+        return instruction_class
+
+    def _classify(self,isa,mnemonic,register_class):
+        register_bits,register_element=REGISTER_CLASSES.get(register_class,(0,None))
+        if register_class.startswith('z.'):
+            register_bits=self.sve_vector_bits
+        elif register_class in ELEMENTS:
+            # aarch64 scalar floating point register
+            register_element=register_class
+
+        for regex,category,fma,default_element in self.rules.get(isa,[]):
+            m=regex.match(mnemonic)
+            if not m:
+                continue
+            groups=m.groupdict()
+
+            if category!='fp':
+                # Integer instructions on general purpose registers are not SIMD
+                if not register_bits:
+                    continue
+                return InstructionClass(category,None,0,register_bits,fma,0)
+
+            element=groups.get('element') or register_element or default_element
+            if element not in ELEMENTS:
+                continue
+            element_name,element_bits=ELEMENTS[element]
+            packed=groups.get('shape')=='p' if 'shape' in groups else register_bits>0
+            vector_bits=max(register_bits or 128,element_bits) if packed else element_bits
+            flops=vector_bits//element_bits*(2 if fma else 1)
+            return InstructionClass(category,element_name,element_bits,vector_bits,fma,flops)
+
+        return OTHER_INSTRUCTION
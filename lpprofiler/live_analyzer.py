@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#  This file is part of the LPprofiler profiling tool.                       #
+#        Copyright (C) 2017  EDF SA                                          #
+#                                                                            #
+#  LPprofiler is free software: you can redistribute it and/or modify        #
+#  it under the terms of the GNU General Public License as published by      #
+#  the Free Software Foundation, either version 3 of the License, or         #
+#  (at your option) any later version.                                       #
+#                                                                            #
+#  LPprofiler is distributed in the hope that it will be useful,             #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of            #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the             #
+#  GNU General Public License for more details.                              #
+#                                                                            #
+#  You should have received a copy of the GNU General Public License         #
+#  along with LPprofiler.  If not, see <http://www.gnu.org/licenses/>.       #
+#                                                                            #
+############################################################################## 
+
+import lpprofiler.perf_hwcounters_profiler as php
+import os, re, threading, time
+
+LIVE_REPORT='LPprof_live_report'
+
+# Number of symbols and instructions shown in the live report
+NB_TOP=10
+
+# perf record --switch-output renames each finished chunk <output>.<timestamp>
+CHUNK_SUFFIX_RE=re.compile(r"^\.\d+$")
+
+
+def get_chunks(output_file):
+    """ Finished chunks written by perf record --switch-output for output_file, oldest first """
+    directory,name=os.path.split(output_file)
+    try:
+        entries=os.listdir(directory or '.')
+    except OSError:
+        return []
+    return [os.path.join(directory,entry) for entry in sorted(entries)
+            if entry.startswith(name) and CHUNK_SUFFIX_RE.match(entry[len(name):])]
+
+
+class StatsTail :
+    """ Read the lines appended to a perf stat output file since the previous read """
+
+    def __init__(self,stats_file):
+        self.stats_file=stats_file
+        self.offset=0
+        self.partial_line=''
+
+    def read_lines(self):
+        """ Return new complete lines """
+        try:
+            with open(self.stats_file,'r') as sf:
+                sf.seek(self.offset)
+                data=sf.read()
+                self.offset=sf.tell()
+        except OSError:
+            return []
+        lines=(self.partial_line+data).split('\n')
+        # Last line is still being written by perf stat
+        self.partial_line=lines.pop()
+        return lines
+
+
+class LiveAnalyzer :
+    """ Analyze perf record chunks and perf stat intervals while the profiled job runs and write
+    a rolling report of the top symbols, instructions and hardware counters metrics every interval
+    seconds. Chunks are removed once analyzed so that the whole perf.data is never stored. """
+
+    def __init__(self,samples_profiler,hwc_profiler,traces_directory,ranks=None,interval=10,nb_top=NB_TOP):
+        self.samples_profiler=samples_profiler
+        self.metrics_manager=samples_profiler.metrics_manager
+        self.sample_files=samples_profiler.get_rank_files(ranks)
+        self.stats_tails=[(rank,StatsTail(stats_file)) for stats_file,rank in hwc_profiler.get_rank_files(ranks)]
+        self.registry=hwc_profiler.derived_metrics
+        self.time_series={}
+
+        self.report_path=os.path.join(traces_directory,LIVE_REPORT)
+        self.interval=interval
+        self.nb_top=nb_top
+        self.nb_chunks=0
+        self.start_time=time.time()
+
+        self._stop_event=threading.Event()
+        self._thread=None
+
+    def start(self):
+        """ Start analyzing in a background thread """
+        self.start_time=time.time()
+        self._thread=threading.Thread(target=self._run,name='lpprof-live')
+        self._thread.daemon=True
+        self._thread.start()
+
+    def stop(self):
+        """ Analyze the last chunks once the profiled job is done and finish the analysis of each rank """
+        if self._thread:
+            self._stop_event.set()
+            self._thread.join()
+            self._thread=None
+        else:
+            self._finish()
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            self.update()
+        self._finish()
+
+    def _finish(self):
+        # Last chunk is written when perf record exits
+        self.update()
+        for output_file,rank in self.sample_files:
+            self.samples_profiler.finish_chunks(rank)
+
+    def update(self):
+        """ Analyze new chunks and intervals and rewrite the live report """
+        self.analyze_chunks()
+        self.read_stats()
+        self.write_report()
+
+    def analyze_chunks(self):
+        for output_file,rank in self.sample_files:
+            for chunk_file in get_chunks(output_file):
+                self.samples_profiler.analyze_chunk(chunk_file,rank)
+                self.nb_chunks+=1
+                try:
+                    os.remove(chunk_file)
+                except OSError:
+                    pass
+
+    def read_stats(self):
+        for rank,stats_tail in self.stats_tails:
+            lines=stats_tail.read_lines()
+            if lines:
+                self.time_series[rank]=php.parse_perf_stat_lines(lines,self.time_series.get(rank))
+
+    def _get_top_lines(self,metric_type,title):
+        totals={metric_name:self.metrics_manager.get_metric_sum(metric_type,metric_name)
+                for metric_name in self.metrics_manager.get_metric_names(metric_type)}
+        total=sum(totals.values())
+        if not total:
+            return []
+        lines=[title+" (samples of all ranks):\n"]
+        for metric_name,count in sorted(totals.items(),key=lambda name_count:(-name_count[1],name_count[0]))[:self.nb_top]:
+            lines.append("  {:.5g}%".format(count/total*100).ljust(15)+metric_name+"\n")
+        lines.append("\n")
+        return lines
+
+    def _get_hwc_lines(self):
+        """ Derived metrics of the last interval of each rank, average and lowest rank """
+        ranks_values={metric_name:[] for metric_name in php.INTERVAL_METRICS}
+        for rank,time_series in self.time_series.items():
+            timestamps,metrics=php.interval_metrics(time_series,1,self.registry)
+            for metric_name,values in metrics.items():
+                values=[value for value in values if value is not None]
+                if values:
+                    ranks_values[metric_name].append((values[-1],rank))
+
+        if not any(ranks_values.values()):
+            return []
+        lines=["hwc metrics (last interval, avg / min over ranks):\n"]
+        for metric_name in php.INTERVAL_METRICS:
+            values=ranks_values[metric_name]
+            if values:
+                avg=sum(value for value,rank in values)/len(values)
+                lines.append("  {}".format(metric_name).ljust(30)+
+                             "{:.4g} / {:.4g} (rank: {})\n".format(avg,*min(values)))
+        lines.append("\n")
+        return lines
+
+    def write_report(self):
+        """ Replace the live report, readers never see a partial report """
+        lines=["lpprof live report: {:.0f} s, {} chunks analyzed\n\n".format(time.time()-self.start_time,
+                                                                           self.nb_chunks)]
+        lines+=self._get_top_lines('sym','top symbols')
+        lines+=self._get_top_lines('asm','top instructions')
+        lines+=self._get_hwc_lines()
+
+        tmp_path=self.report_path+'.tmp'
+        try:
+            with open(tmp_path,'w') as report_file:
+                report_file.writelines(lines)
+            os.replace(tmp_path,self.report_path)
+        except OSError:
+            pass
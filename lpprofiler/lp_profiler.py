@@ -23,7 +23,18 @@ import lpprofiler.perf_samples_profiler as psp
 import lpprofiler.metrics_manager as metm
 import lpprofiler.perf_hwcounters_profiler as php
 import lpprofiler.valgrind_memory_profiler as vmp
+import lpprofiler.node_analysis as nodan
+import lpprofiler.call_tree as calltree
+import lpprofiler.flame_graph as flame
+import lpprofiler.source_lines as srcl
+import lpprofiler.live_analyzer as live
+import lpprofiler.trace_staging as staging
+import lpprofiler.host_agent as hostagent
+import lpprofiler.rendezvous as rdv
+import lpprofiler.sampling_budget as budget
+import lpprofiler.report_writer as repw
 import sys, os, stat, re, datetime
+from collections import OrderedDict
 #from jinja2 import Template
 
 
@@ -42,11 +53,16 @@ class LpProfiler :
         # Binary to profile
         self.binary=binary
 
+        self.profiling_args=profiling_args
+
         # Profiling options (TODO: should be customizable at launch )
         self.profiling_flavours=["asm_prof","hwcounters_prof"]
 
         self.global_metrics={}
 
+        # Buffered text report, only open while report() runs
+        self.text_report=None
+
         # Sample Manager ( Avg,Min,Max and count per rank)
         self.metrics_manager=metm.MetricsManager()
 
@@ -69,6 +85,14 @@ class LpProfiler :
             os.mkdir(self.traces_directory)
                                                     
         
+        # Ranks write their traces to node-local storage, only summaries and
+        # archives of the traces are collected in the traces directory
+        self.stage_directory=None
+        traces_directory=self.traces_directory
+        if 'stage_dir' in profiling_args:
+            self.stage_directory=staging.get_stage_directory(self.traces_directory,profiling_args)
+            traces_directory=self.stage_directory
+
         # Build profilers
         trace_samples=[]
         trace_hwc=[]
@@ -76,21 +100,26 @@ class LpProfiler :
         output_hwc=[]
         if (self.launcher)and('srun' in self.launcher):
             slurm_ntasks=self._get_slurm_ntasks()
-            trace_samples=["{}/perf.data_%t".format(self.traces_directory)]
-            trace_hwc=["{}/perf.stats_%t".format(self.traces_directory)]
+            trace_samples=["{}/perf.data_%t".format(traces_directory)]
+            trace_hwc=["{}/perf.stats_%t".format(traces_directory)]
             for rank in range(0,slurm_ntasks):
                 if (not self.ranks_to_profile) or (rank in self.ranks_to_profile):
-                    output_samples.append("{}/perf.data_{}".format(self.traces_directory,rank))
-                    output_hwc.append("{}/perf.stats_{}".format(self.traces_directory,rank))
+                    output_samples.append("{}/perf.data_{}".format(traces_directory,rank))
+                    output_hwc.append("{}/perf.stats_{}".format(traces_directory,rank))
         elif (self.launcher=='std'):
-            trace_samples=["{}/perf.data".format(self.traces_directory)]
-            trace_hwc=["{}/perf.stats".format(self.traces_directory)]
+            if self.stage_directory:
+                # Staged traces are collected as those of rank 0
+                trace_samples=["{}/perf.data_0".format(traces_directory)]
+                trace_hwc=["{}/perf.stats_0".format(traces_directory)]
+            else:
+                trace_samples=["{}/perf.data".format(traces_directory)]
+                trace_hwc=["{}/perf.stats".format(traces_directory)]
         elif (self.pids_to_profile):
             # Ranks are attributed according to the position of the pid in the input pid list
             for rank in range(0,len(self.pids_to_profile)):
                 if (not self.ranks_to_profile) or (rank in self.ranks_to_profile):
-                    trace_samples.append("{}/perf.data_{}".format(self.traces_directory,rank))
-                    trace_hwc.append("{}/perf.stats_{}".format(self.traces_directory,rank))
+                    trace_samples.append("{}/perf.data_{}".format(traces_directory,rank))
+                    trace_hwc.append("{}/perf.stats_{}".format(traces_directory,rank))
 
         self.profilers=[
             php.PerfHWcountersProfiler(self.metrics_manager,trace_hwc,output_hwc,profiling_args),\
@@ -107,6 +136,9 @@ class LpProfiler :
         
         run_cmd+=self.binary
 
+        if self.stage_directory:
+            run_cmd=staging.get_staged_cmd(run_cmd,self.stage_directory,self.traces_directory,0,self.profiling_args)
+
         return [run_cmd]
 
 
@@ -186,7 +218,11 @@ class LpProfiler :
         self._print_slurm_conf(slurm_ntasks)
         
         with open("{}/profile_cmd.sh".format(self.traces_directory),"w") as f_cmd:
-            f_cmd.write(profile_cmd.replace('%t','$1')+self.binary)
+            profile_cmd=profile_cmd.replace('%t','$1')+self.binary
+            if self.stage_directory:
+                profile_cmd=staging.get_staged_cmd(profile_cmd,self.stage_directory,self.traces_directory,
+                                                   '$1',self.profiling_args)
+            f_cmd.write(profile_cmd)
 
 
         st = os.stat("{}/profile_cmd.sh".format(self.traces_directory))
@@ -215,10 +251,15 @@ class LpProfiler :
                     run_cmd+=prof.get_profile_cmd(pid_num,irank)
                     
                 # Wait for tasks to start before starting perf (needed for spank plugin)
-                run_cmd='bash -c "proc_name="slurmstepd"; while [[ "\${proc_name:0:10}" == slurmstepd ]]; '+'do proc_name=\$(ps -p {} --no-headers -o comm); done;"; '.format(pid_num)+run_cmd
+                run_cmd='bash -c "proc_name="{}"; while [[ "\${{proc_name:0:10}}" == {} ]]; '.format(hostagent.PRE_EXEC_COMM,hostagent.PRE_EXEC_COMM)+\
+                    'do sleep {}; proc_name=\$(ps -p {} --no-headers -o comm); done;"; '.format(hostagent.FALLBACK_POLL_INTERVAL,pid_num)+run_cmd
                 # Wait for job to finish
                 run_cmd+='bash -c "while [ ! -e {}/job_done ] && [ -e /proc/{} ]; do sleep 2; done"'.format(os.path.abspath("."),pid_num)
 
+                if self.stage_directory:
+                    run_cmd=staging.get_staged_cmd(run_cmd,self.stage_directory,self.traces_directory,
+                                                   rank,self.profiling_args)
+
                 # If an hostname is given prefix command by a ssh call
                 if (len(pid.split(':'))>1):
                     run_cmd="ssh {} '{}'".format(pid_host,run_cmd)
@@ -232,9 +273,91 @@ class LpProfiler :
         return run_cmds
 
 
+    def _get_profiled_ranks(self):
+        """ Profiled ranks in order, trace files are indexed by the position of the rank in this list """
+        return [rank for rank in range(len(self.pids_to_profile))
+                if (not self.ranks_to_profile) or (rank in self.ranks_to_profile)]
+
+    def _get_agent_cmd(self,host,ranks,profiled_ranks):
+        """ Write the tasks of the agent profiling ranks of host and return its command """
+        tasks=[]
+        for rank in ranks:
+            pid_num=int(self.pids_to_profile[rank].split(':')[-1])
+            profile_cmd=''
+            for prof in self.profilers :
+                profile_cmd+=prof.get_profile_cmd(pid_num,profiled_ranks.index(rank))
+            # perf commands run until the agent interrupts them
+            tasks.append({'rank':rank,'pid':pid_num,'cmd':profile_cmd.rstrip()})
+
+        tasks_file=os.path.abspath("{}/agent_tasks_{}".format(self.traces_directory,host))
+        hostagent.write_tasks(tasks_file,tasks,os.path.abspath("job_done"))
+
+        agent_cmd="{} --agent {}".format(self.profiling_args.get("lpprof_cmd","lpprof"),tasks_file)
+        if not nodan.is_local_host(host):
+            agent_cmd="ssh {} '{}'".format(host,agent_cmd)
+        return agent_cmd
+
+    def _agent_run_cmd(self):
+        """ Profile the pids of each host with a single lpprof agent, return (host,agent command) of each host """
+        profiled_ranks=self._get_profiled_ranks()
+        return [(host,self._get_agent_cmd(host,ranks,profiled_ranks))
+                for host,ranks in self._get_hosts_ranks().items()]
+
+    def _log_agent_events(self,pf,host,events):
+        for event in events:
+            pf.write("{} {}\n".format(host,event))
+            if event['event']=='error':
+                print("Profiling agent of {}: {}".format(host,event.get('message')))
+            elif event['event']=='polling':
+                print("Profiling agent of {}: {}, polling every {} s".format(host,event['reason'],event['interval']))
+            elif event['event']=='done' and event['failed']:
+                print("Profiling agent of {}: {} perf commands failed".format(host,event['failed']))
+
+    def _run_agents(self):
+        """ Run host agents and log the events they report """
+        if self.profiling_args.get('rendezvous'):
+            self._run_rendezvous()
+            return
+
+        agent_cmds=self._agent_run_cmd()
+        with open("{}/perf_cmds".format(self.traces_directory),"a") as pf:
+            pf.write("Profiling agents :\n")
+            for host,agent_cmd in agent_cmds:
+                pf.write(agent_cmd+'\n')
+
+            agent_processes=[(host,hostagent.start_agent(agent_cmd)) for host,agent_cmd in agent_cmds]
+            for host,agent_process in agent_processes:
+                self._log_agent_events(pf,host,hostagent.read_agent_events(agent_process))
+
+    def _run_rendezvous(self):
+        """ Wait for tasks to register and start the agent of each host as soon as all its tasks registered """
+        server=rdv.RendezvousServer(self.profiling_args['rendezvous'])
+        profiled_ranks=self._get_profiled_ranks()
+        agent_processes=[]
+        with open("{}/perf_cmds".format(self.traces_directory),"a") as pf:
+            pf.write("Profiling agents :\n")
+            try:
+                for host,ranks_pids in server.iter_hosts(len(self.pids_to_profile),
+                                                         self.profiling_args.get('rendezvous_timeout',rdv.REGISTRATION_TIMEOUT)):
+                    for rank,pid in ranks_pids.items():
+                        if rank<len(self.pids_to_profile):
+                            self.pids_to_profile[rank]="{}:{}".format(host,pid)
+                    ranks=sorted(rank for rank in ranks_pids if rank in profiled_ranks)
+                    if ranks:
+                        agent_cmd=self._get_agent_cmd(host,ranks,profiled_ranks)
+                        pf.write(agent_cmd+'\n')
+                        agent_processes.append((host,hostagent.start_agent(agent_cmd)))
+            finally:
+                server.close()
+
+            for host,agent_process in agent_processes:
+                self._log_agent_events(pf,host,hostagent.read_agent_events(agent_process))
+
     def _lp_log(self,msg):
-        if msg:
-            with open("{}/LPprof_perf_report".format(self.traces_directory),"a") as logf:
+        if self.text_report:
+            self.text_report.write(msg)
+        elif msg:
+            with open(repw.get_report_path(self.traces_directory),"a") as logf:
                 logf.write(msg)
         
     def run(self):
@@ -242,7 +365,11 @@ class LpProfiler :
 
         prof_cmds=[]
         # Execute profiling possibly with parallel launcher.
-        if self.launcher and ('srun' in self.launcher):
+        use_agents=self.pids_to_profile and self.profiling_args.get('host_agents')
+        if use_agents:
+            # Host agents are run below, once the live analyzer is started
+            pass
+        elif self.launcher and ('srun' in self.launcher):
             prof_cmds=self._slurm_run_cmd()
         elif (self.launcher=='std'):
             prof_cmds=self._std_run_cmd()
@@ -252,6 +379,17 @@ class LpProfiler :
             self._lp_log("Unsupported launcher: \n"+self.launcher)
             exit
 
+        # Samples are analyzed while the job runs, chunk by chunk
+        live_analyzer=None
+        if self.profiling_args.get('live'):
+            live_analyzer=live.LiveAnalyzer(self.profilers[1],self.profilers[0],self.traces_directory,
+                                            self.ranks_to_profile,self.profiling_args['live'])
+            live_analyzer.start()
+            print("Writing lpprof live report to : {}/{}".format(self.traces_directory,live.LIVE_REPORT))
+
+        if use_agents:
+            self._run_agents()
+
         # Launch profiling commands 
         prof_processes=[]
         for p_cmd in prof_cmds:
@@ -267,21 +405,107 @@ class LpProfiler :
         for p_process in prof_processes:
             p_process.communicate()
 
+        if live_analyzer:
+            live_analyzer.stop()
+            self._analyze_live()
+            return
+
+        self.analyze()
+
+    def _get_hosts_ranks(self):
+        """ Return hosts and the ranks they run, in rank order """
+        hosts_ranks=OrderedDict()
+        for rank,pid in enumerate(self.pids_to_profile):
+            if pid is None:
+                # Task did not register to the rendezvous server
+                continue
+            if (not self.ranks_to_profile) or (rank in self.ranks_to_profile):
+                if len(pid.split(':'))>1:
+                    pid_host=pid.split(':')[0]
+                else:
+                    pid_host='localhost'
+                hosts_ranks.setdefault(pid_host,[]).append(rank)
+        return hosts_ranks
+
+    def _analyze_distributed(self):
+        """ Analyze ranks on the hosts they ran on and merge the summaries sent back by each host """
+        hosts_ranks=self._get_hosts_ranks()
+
+        for host,ranks,node_metrics in nodan.run_node_analyses(hosts_ranks,self.traces_directory,
+                                                               self.profiling_args):
+            if node_metrics is None:
+                print("Analysis failed on {}, analyzing ranks {} locally".format(host,ranks))
+                for prof in self.profilers :
+                    prof.analyze_ranks([(output_file,rank) for output_file,rank
+                                        in prof.get_rank_files(self.ranks_to_profile) if rank in ranks])
+            else:
+                self.metrics_manager.merge(node_metrics)
+
+        all_ranks=sorted(rank for ranks in hosts_ranks.values() for rank in ranks)
+        for prof in self.profilers :
+            prof.finalize(all_ranks)
+
+    def _analyze_live(self):
+        """ Samples were analyzed by the live analyzer, only hardware counters are left """
+        hwc_profiler=self.profilers[0]
+        hwc_profiler.analyze_ranks(hwc_profiler.get_rank_files(self.ranks_to_profile))
+        for prof in self.profilers :
+            prof.finalize([rank for output_file,rank in prof.get_rank_files(self.ranks_to_profile)])
+
+    def _analyze_staged(self):
+        """ Merge the summaries collected by each rank from its node-local traces """
+        ranks=[rank for output_file,rank in self.profilers[1].get_rank_files(self.ranks_to_profile)]
+        for rank in ranks:
+            rank_metrics=staging.read_summary(self.traces_directory,rank)
+            if rank_metrics is not None:
+                self.metrics_manager.merge(rank_metrics)
 
-        # Calls to analyze
         for prof in self.profilers :
-            prof.analyze(self.ranks_to_profile)
+            prof.finalize(ranks)
+
+    def analyze(self):
+        """ Analyze profiling outputs """
+        if self.stage_directory:
+            self._analyze_staged()
+        elif self.profiling_args.get('distributed_analysis') and self.pids_to_profile:
+            self._analyze_distributed()
+        else:
+            # Calls to analyze
+            for prof in self.profilers :
+                prof.analyze(self.ranks_to_profile)
 
 
     def report(self):
         """ Print profiling reports """
 
-        print("Writing lpprof performance summary to : {}/LPprof_perf_report".format(self.traces_directory))
+        report_formats=self.profiling_args.get('report_formats',repw.DEFAULT_REPORT_FORMATS)
+
+        if 'text' in report_formats:
+            print("Writing lpprof performance summary to : {}".format(repw.get_report_path(self.traces_directory)))
+            self.text_report=repw.TextReport(repw.get_report_path(self.traces_directory))
+            try:
+                self._report_text()
+            finally:
+                self.text_report.close()
+                self.text_report=None
+
+        for report_format in report_formats:
+            if report_format!='text':
+                print("Writing lpprof {} report to : {}".format(
+                    report_format,repw.get_report_path(self.traces_directory,report_format)))
+        repw.write_reports(self.metrics_manager,self.traces_directory,report_formats,
+                           REPORT_METRIC_TYPES,MAX_REPORT_CALL_PATHS)
+
+        if self.profiling_args.get('flame_graph') or self.profiling_args.get('flame_diff'):
+            self._write_flame_graphs()
+
+    def _report_text(self):
+        """ Print metrics tables and the other sections of the text report """
 
         self._lp_log("\n")
 
         # Print hardware counters
-        for metric_type in ['hwc','vectorization','asm','sym']:
+        for metric_type in REPORT_METRIC_TYPES:
 
             if not self.metrics_manager.get_metric_names_sorted(metric_type):
                 continue
@@ -297,28 +521,302 @@ class LpProfiler :
             self._lp_log("\n")
             self._lp_log("  ".ljust(160,"-"))
             self._lp_log("\n")
-            metric_unit=''
-            if metric_type in ['asm','sym','vectorization']:
-                metric_unit='%'
-            
+
             for metric_name in self.metrics_manager.get_metric_names_sorted(metric_type):
 
+                metric_unit=repw.get_metric_unit(metric_type,metric_name)
+                metric_min,min_rank=self.metrics_manager.get_metric_min(metric_type,metric_name)
+                metric_max,max_rank=self.metrics_manager.get_metric_max(metric_type,metric_name)
                 
                 self._lp_log("  {} ".format(metric_name).ljust(60))
-                self._lp_log("{:.5g}{}".format(
-                    self.metrics_manager.get_metric_min(metric_type,metric_name)[0],metric_unit).ljust(10))
-                self._lp_log("    (rank: {})".format(
-                    self.metrics_manager.get_metric_min(metric_type,metric_name)[1]).ljust(30))
-                self._lp_log("{:.5g}{}".format(
-                    self.metrics_manager.get_metric_max(metric_type,metric_name)[0],metric_unit).ljust(10))
-                self._lp_log("    (rank: {})".format(
-                    self.metrics_manager.get_metric_max(metric_type,metric_name)[1]).ljust(30))
+                self._lp_log("{:.5g}{}".format(metric_min,metric_unit).ljust(10))
+                self._lp_log("    (rank: {})".format(min_rank).ljust(30))
+                self._lp_log("{:.5g}{}".format(metric_max,metric_unit).ljust(10))
+                self._lp_log("    (rank: {})".format(max_rank).ljust(30))
                 self._lp_log("{:.5g}{}".format(
                     self.metrics_manager.get_metric_avg(metric_type,metric_name),metric_unit).ljust(40))
                 self._lp_log("\n")
 
             self._lp_log("\n\n")
+
+            if len(self.metrics_manager.ranks)>1:
+                self._report_distribution(metric_type)
+
+            if metric_type=='hwc':
+                self._report_time_series()
+
+        self._report_call_paths()
+        self._report_source_lines()
+        self._report_sampling_budget()
         self._lp_log("\n")
+
+    def _report_time_series(self):
+        """ Print derived hardware counters metrics of each interval, min and avg over ranks """
+
+        all_time_series=[self.metrics_manager.get_time_series(rank) for rank in self.metrics_manager.ranks]
+        ranks_time_series=[(rank,time_series) for rank,time_series
+                           in zip(self.metrics_manager.ranks,all_time_series) if time_series]
+        nb_intervals=max((len(time_series.timestamps) for rank,time_series in ranks_time_series),default=0)
+        if nb_intervals<2:
+            return
+
+        # Consecutive intervals are grouped to keep the table short
+        step=-(-nb_intervals//MAX_REPORT_INTERVALS)
+        timestamps=[]
+        ranks_metrics=[]
+        registry=None
+        for prof in self.profilers :
+            if isinstance(prof,php.PerfHWcountersProfiler):
+                registry=prof.derived_metrics
+        for rank,time_series in ranks_time_series:
+            rank_timestamps,rank_metrics=php.interval_metrics(time_series,step,registry)
+            if len(rank_timestamps)>len(timestamps):
+                timestamps=rank_timestamps
+            ranks_metrics.append((rank,rank_metrics))
+
+        title="hwc metrics over time:"
+        self._lp_log(title+"\n")
+        self._lp_log("".ljust(len(title),"-"))
+        self._lp_log("\n\n")
+        self._lp_log("  time (s)".ljust(20))
+        for metric_name in php.INTERVAL_METRICS:
+            self._lp_log("{} avg / min".format(metric_name).ljust(40))
+        self._lp_log("\n")
+        self._lp_log("  ".ljust(140,"-"))
+        self._lp_log("\n")
+
+        for igroup,timestamp in enumerate(timestamps):
+            self._lp_log("  {:.5g}".format(timestamp).ljust(20))
+            for metric_name in php.INTERVAL_METRICS:
+                values=[(metrics[metric_name][igroup],rank) for rank,metrics in ranks_metrics
+                        if igroup<len(metrics[metric_name]) and metrics[metric_name][igroup] is not None]
+                if values:
+                    avg=sum(value for value,rank in values)/len(values)
+                    self._lp_log("{:.4g} / {:.4g} (rank: {})".format(avg,*min(values)).ljust(40))
+                else:
+                    self._lp_log("-".ljust(40))
+            self._lp_log("\n")
+
+        self._lp_log("\n\n")
+
+    def _report_call_paths(self):
+        """ Print call paths with the most inclusive samples over all ranks """
+
+        call_tree=self.metrics_manager.get_merged_call_tree()
+        total_samples=call_tree.get_total()
+        if not total_samples:
+            return
+
+        title="call paths (samples of all ranks):"
+        self._lp_log(title+"\n")
+        self._lp_log("".ljust(len(title),"-"))
+        self._lp_log("\n\n")
+        self._lp_log("  inclusive".ljust(15))
+        self._lp_log("exclusive".ljust(15))
+        self._lp_log("call path")
+        self._lp_log("\n")
+        self._lp_log("  ".ljust(160,"-"))
+        self._lp_log("\n")
+
+        for frames,inclusive,exclusive in call_tree.get_top_paths(MAX_REPORT_CALL_PATHS):
+            # Outermost callers of deep paths are elided
+            if len(frames)>MAX_REPORT_PATH_FRAMES:
+                frames=['...']+frames[-MAX_REPORT_PATH_FRAMES:]
+            self._lp_log("  {:.5g}%".format(inclusive/total_samples*100).ljust(15))
+            self._lp_log("{:.5g}%".format(exclusive/total_samples*100).ljust(15))
+            self._lp_log(calltree.PATH_SEPARATOR.join(frames))
+            self._lp_log("\n")
+
+        self._lp_log("\n\n")
+
+    def _report_source_lines(self):
+        """ Print source lines with the most samples over all ranks and their instruction mix """
+
+        source_lines=self.metrics_manager.get_merged_source_lines()
+        total_samples=sum(sum(mix.values()) for mix in source_lines.values())
+        lines=sorted(((sum(mix.values()),line) for line,mix in source_lines.items()
+                      if line!=srcl.UNKNOWN_LINE),key=lambda count_line:(-count_line[0],count_line[1]))
+        if not lines:
+            return
+
+        title="hottest source lines (samples of all ranks):"
+        self._lp_log(title+"\n")
+        self._lp_log("".ljust(len(title),"-"))
+        self._lp_log("\n\n")
+        self._lp_log("  samples".ljust(15))
+        self._lp_log("source line".ljust(60))
+        self._lp_log("instruction mix")
+        self._lp_log("\n")
+        self._lp_log("  ".ljust(160,"-"))
+        self._lp_log("\n")
+
+        for count,line in lines[:MAX_REPORT_SOURCE_LINES]:
+            mix=sorted(source_lines[line].items(),key=lambda asm_count:(-asm_count[1],asm_count[0]))
+            # Beginning of long paths is elided
+            if len(line)>58:
+                line='...'+line[-55:]
+            self._lp_log("  {:.5g}%".format(count/total_samples*100).ljust(15))
+            self._lp_log(line.ljust(60))
+            self._lp_log(", ".join("{} {:.3g}%".format(asm_name,asm_count/count*100)
+                                   for asm_name,asm_count in mix[:MAX_REPORT_LINE_INSTRUCTIONS]))
+            self._lp_log("\n")
+
+        self._lp_log("\n\n")
+
+    def _report_sampling_budget(self):
+        """ Print the sampling plan derived from --sample-budget and the ranks that overshot it """
+
+        plan=self.profilers[1].sampling_plan
+        if not plan:
+            return
+
+        title="sampling budget:"
+        self._lp_log(title+"\n")
+        self._lp_log("".ljust(len(title),"-"))
+        self._lp_log("\n\n")
+        self._lp_log("  frequency: {}Hz, call graph: {}".format(plan.frequency,'yes' if plan.callgraph else 'no'))
+        if plan.rank_budget:
+            self._lp_log(", budget per rank: {} bytes".format(plan.rank_budget))
+        self._lp_log("\n\n")
+
+        # Ranks are sampled on each of their threads, multi-threaded ranks write more than planned
+        overshooting=[]
+        for rank,sample_rate in self.metrics_manager.get_metric_counts('sampling','sample_rate').items():
+            elapsed_time=self.metrics_manager.get_metric_count('hwc','elapsed_time',rank)
+            nb_samples=self.metrics_manager.get_metric_count('sampling','samples',rank)
+            bytes_per_sample=None
+            if nb_samples:
+                bytes_per_sample=self.metrics_manager.get_metric_count('sampling','trace_bytes',rank)/nb_samples
+            projected_size=budget.get_projected_size(plan,sample_rate,elapsed_time,bytes_per_sample)
+            # Rotated ranks overshot even if the projection of their kept samples does not tell it
+            rotated=budget.is_rotated(self.metrics_manager.get_metric_count('sampling','trace_files',rank))
+            if plan.rank_budget and (rotated or projected_size>plan.rank_budget):
+                overshooting.append((projected_size,rank,sample_rate,elapsed_time,bytes_per_sample))
+        if not overshooting:
+            return
+
+        self._lp_log("  rank".ljust(15))
+        self._lp_log("samples/s".ljust(15))
+        self._lp_log("projected bytes".ljust(20))
+        self._lp_log("suggested frequency")
+        self._lp_log("\n")
+        self._lp_log("  ".ljust(160,"-"))
+        self._lp_log("\n")
+        for projected_size,rank,sample_rate,elapsed_time,bytes_per_sample in \
+                sorted(overshooting,reverse=True)[:MAX_REPORT_SAMPLING_RANKS]:
+            self._lp_log("  {}".format(rank).ljust(15))
+            self._lp_log("{:.5g}".format(sample_rate).ljust(15))
+            self._lp_log("{:.5g}".format(projected_size).ljust(20))
+            self._lp_log("{}Hz".format(budget.suggest_frequency(plan,sample_rate,elapsed_time,bytes_per_sample)))
+            self._lp_log("\n")
+        self._lp_log("  Oldest samples of these ranks were dropped by perf record --switch-max-files\n")
+        self._lp_log("\n\n")
+
+    def _write_flame_graphs(self):
+        """ Write flame graphs of each rank and of the whole job, and the differential
+        flame graph asked with --flame-diff """
+
+        if self.profiling_args.get('flame_graph'):
+            print("Writing flame graphs to : {}/flames*.svg".format(self.traces_directory))
+            for rank in sorted(self.metrics_manager.call_trees):
+                flame.write_svg(self.metrics_manager.get_call_tree(rank),
+                                "{}/flames_{}.svg".format(self.traces_directory,rank),
+                                "Flame Graph (rank {})".format(rank))
+
+            # Folded stacks of the job are kept to compare later runs with --flame-diff
+            job_tree=self.metrics_manager.get_merged_call_tree()
+            flame.write_folded(job_tree,"{}/flames.folded".format(self.traces_directory))
+            flame.write_svg(job_tree,"{}/flames.svg".format(self.traces_directory),
+                            "Flame Graph ({} ranks)".format(len(self.metrics_manager.call_trees)))
+
+        if self.profiling_args.get('flame_diff'):
+            specs=self.profiling_args['flame_diff'].split(',')
+            base_tree=self._get_flame_diff_tree(specs[0])
+            target_tree=self._get_flame_diff_tree(specs[1] if len(specs)>1 else None)
+            if base_tree is None or target_tree is None:
+                return
+            svg_path="{}/flames_diff.svg".format(self.traces_directory)
+            print("Writing differential flame graph to : {}".format(svg_path))
+            flame.write_svg(target_tree,svg_path,"Differential Flame Graph ({} vs {})".format(
+                specs[1] if len(specs)>1 else 'job',specs[0]),base_tree)
+
+    def _get_flame_diff_tree(self,spec):
+        """ Call tree of a --flame-diff item: a rank of this run, a folded stacks file or the
+        output directory of another run, the whole job by default """
+
+        if spec is None:
+            return self.metrics_manager.get_merged_call_tree()
+        if spec.isdigit():
+            if int(spec) not in self.metrics_manager.call_trees:
+                print("No call chains for rank {}, skipping differential flame graph".format(spec))
+                return None
+            return self.metrics_manager.get_call_tree(int(spec))
+
+        folded_path=spec
+        if os.path.isdir(spec):
+            folded_path=os.path.join(spec,'flames.folded')
+        try:
+            return flame.read_folded(folded_path)
+        except OSError as e:
+            print("Cannot read folded stacks {} ({}), skipping differential flame graph".format(folded_path,e))
+            return None
+
+    def _report_distribution(self,metric_type):
+        """ Print percentiles, spread, histogram and outlier ranks of each metric over ranks """
+
+        title=metric_type+" metrics distribution over ranks:"
+        self._lp_log(title+"\n")
+        self._lp_log("".ljust(len(title),"-"))
+        self._lp_log("\n\n")
+        self._lp_log("  metric name".ljust(60))
+        for column_name in ["p50","p90","p99","spread"]:
+            self._lp_log(column_name.ljust(15))
+        self._lp_log("histogram".ljust(15))
+        self._lp_log("outlier ranks")
+        self._lp_log("\n")
+        self._lp_log("  ".ljust(160,"-"))
+        self._lp_log("\n")
+
+        for metric_name in self.metrics_manager.get_metric_names_sorted(metric_type):
+            sketch=self.metrics_manager.get_metric_sketch(metric_type,metric_name)
+            metric_unit=repw.get_metric_unit(metric_type,metric_name)
+
+            self._lp_log("  {} ".format(metric_name).ljust(60))
+            for q in [0.5,0.9,0.99]:
+                self._lp_log("{:.5g}{}".format(sketch.quantile(q),metric_unit).ljust(15))
+            self._lp_log("{:.3g}%".format(sketch.spread()).ljust(15))
+            self._lp_log("[{}]".format(_sparkline(sketch.histogram())).ljust(15))
+            self._lp_log(",".join(str(rank) for rank,count in sketch.outliers()))
+            self._lp_log("\n")
+
+        self._lp_log("\n\n")
+
+
+# Metric types of the report, in order
+REPORT_METRIC_TYPES=['hwc','hwc_running','vectorization','asm','sym','sampling']
+
+# Maximum number of rows of the hardware counters time series table
+MAX_REPORT_INTERVALS=30
+
+# Maximum number of call paths reported and of frames shown for each path
+MAX_REPORT_CALL_PATHS=20
+MAX_REPORT_PATH_FRAMES=8
+
+# Maximum number of source lines reported and of instructions shown for each line
+MAX_REPORT_SOURCE_LINES=20
+MAX_REPORT_LINE_INSTRUCTIONS=4
+
+# Maximum number of ranks reported as overshooting their sampling budget
+MAX_REPORT_SAMPLING_RANKS=20
+
+
+def _sparkline(bins):
+    """ Draw histogram bins as one character per bin """
+    levels=" .:-=+*#%@"
+    highest=max(bins)
+    if not highest:
+        return " "*len(bins)
+    return "".join(levels[max(1,(len(levels)-1)*count//highest) if count else 0] for count in bins)
                     
 
 
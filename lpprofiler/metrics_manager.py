@@ -18,50 +18,445 @@
 #                                                                            #
 ##############################################################################
 
-from collections import defaultdict
+from array import array
+from itertools import compress
+import lpprofiler.sketches as sketches
+import lpprofiler.call_tree as calltree
+import math
+import operator
+
+
+# Flags of statistics that must be recomputed from the row before being read
+STALE_MIN=1
+STALE_MAX=2
+
+
+class MetricTable:
+    """ Counts of all metrics of one type stored as a contiguous (name x rank) array.
+    Metric names are interned to row ids, ranks to columns shared by all types.
+    Number of ranks, sum, min and max of each row are updated on every change of a count. """
+
+    def __init__(self,stride=8):
+        # Row of each metric name, names of deleted metrics are removed from this dict
+        self.ids={}
+        self.names=[]
+        # Number of columns reserved per row
+        self.stride=stride
+        self.values=array('d')
+        # 1 where a metric has a count for a rank
+        self.present=bytearray()
+
+        # Running statistics of each row, min and max are kept with their column
+        self.nb_ranks=array('I')
+        self.sums=array('d')
+        self.mins=array('d')
+        self.min_columns=array('i')
+        self.maxs=array('d')
+        self.max_columns=array('i')
+        self.stale=bytearray()
+
+        # Cross-rank quantile sketch of each row, built on demand and dropped when the row changes
+        self.sketches=[]
+
+    def add_row(self,metric_name):
+        metric_id=len(self.names)
+        self.ids[metric_name]=metric_id
+        self.names.append(metric_name)
+        self.values.extend(array('d',bytes(8*self.stride)))
+        self.present.extend(bytes(self.stride))
+        for stat in (self.nb_ranks,self.sums,self.mins,self.maxs):
+            stat.append(0)
+        self.min_columns.append(-1)
+        self.max_columns.append(-1)
+        self.stale.append(0)
+        self.sketches.append(None)
+        return metric_id
+
+    def add(self,metric_id,column,count):
+        """ Add count to a cell """
+        index=metric_id*self.stride+column
+        self.set(metric_id,column,self.values[index]+count)
+
+    def set(self,metric_id,column,value):
+        """ Set a cell and update statistics of its row """
+        index=metric_id*self.stride+column
+        old=self.values[index]
+        self.values[index]=value
+        self.sketches[metric_id]=None
+
+        if not self.present[index]:
+            self.present[index]=1
+            self.nb_ranks[metric_id]+=1
+            self.sums[metric_id]+=value
+            if self.nb_ranks[metric_id]==1:
+                self.mins[metric_id]=self.maxs[metric_id]=value
+                self.min_columns[metric_id]=self.max_columns[metric_id]=column
+                self.stale[metric_id]=0
+                return
+            old=None
+        else:
+            self.sums[metric_id]+=value-old
+
+        stale=self.stale[metric_id]
+        if not stale&STALE_MIN:
+            if column==self.min_columns[metric_id]:
+                # Another rank may become the min when the min increases
+                if value<=old:
+                    self.mins[metric_id]=value
+                else:
+                    stale|=STALE_MIN
+            elif value<self.mins[metric_id] or \
+                 (value==self.mins[metric_id] and column<self.min_columns[metric_id]):
+                self.mins[metric_id]=value
+                self.min_columns[metric_id]=column
+        if not stale&STALE_MAX:
+            if column==self.max_columns[metric_id]:
+                if value>=old:
+                    self.maxs[metric_id]=value
+                else:
+                    stale|=STALE_MAX
+            elif value>self.maxs[metric_id] or \
+                 (value==self.maxs[metric_id] and column<self.max_columns[metric_id]):
+                self.maxs[metric_id]=value
+                self.max_columns[metric_id]=column
+        self.stale[metric_id]=stale
+
+    def set_column(self,column,values):
+        """ Set the cells of all metrics for one column, values holds one count per row.
+        Counts of deleted metrics are ignored. Sums and number of ranks of all rows are
+        updated at once, their min and max are recomputed when they are read. """
+        nb_rows=len(self.names)
+        old_values=self.values[column::self.stride]
+        old_present=self.present[column::self.stride]
+        if len(self.ids)==nb_rows:
+            live=bytearray(b'\x01')*nb_rows
+            new_values=array('d',values)
+        else:
+            live=bytearray(nb_rows)
+            for metric_id in self.ids.values():
+                live[metric_id]=1
+            new_values=array('d',(value if is_live else old_value for value,old_value,is_live
+                                  in zip(values,old_values,live)))
+
+        self.values[column::self.stride]=new_values
+        self.present[column::self.stride]=bytearray(map(operator.or_,live,old_present))
+
+        # Cells without count hold 0 so the difference is the change of the sum in both cases
+        self.sums=array('d',map(operator.add,self.sums,map(operator.sub,new_values,old_values)))
+        self.nb_ranks=array('I',map(operator.add,self.nb_ranks,map(operator.gt,live,old_present)))
+        self.stale=bytearray(stale|STALE_MIN|STALE_MAX if is_live else stale
+                             for stale,is_live in zip(self.stale,live))
+        self.sketches=[None if is_live else sketch for sketch,is_live in zip(self.sketches,live)]
+
+    def clear_row(self,metric_id):
+        """ Reset counts and statistics of a row """
+        start=metric_id*self.stride
+        self.values[start:start+self.stride]=array('d',bytes(8*self.stride))
+        self.present[start:start+self.stride]=bytes(self.stride)
+        self.nb_ranks[metric_id]=0
+        self.sums[metric_id]=0
+        self.min_columns[metric_id]=self.max_columns[metric_id]=-1
+        self.stale[metric_id]=0
+        self.sketches[metric_id]=None
+
+    def _refresh(self,metric_id):
+        """ Recompute min and max of a row, first column wins on ties """
+        start=metric_id*self.stride
+        values=self.values[start:start+self.stride]
+        columns=compress(range(self.stride),self.present[start:start+self.stride])
+        min_column=max_column=next(columns)
+        for column in columns:
+            if values[column]<values[min_column]:
+                min_column=column
+            elif values[column]>values[max_column]:
+                max_column=column
+        self.mins[metric_id]=values[min_column]
+        self.min_columns[metric_id]=min_column
+        self.maxs[metric_id]=values[max_column]
+        self.max_columns[metric_id]=max_column
+        self.stale[metric_id]=0
+
+    def get_min(self,metric_id):
+        """ Return (count,column) of the min of a row or None if it has no count """
+        if not self.nb_ranks[metric_id]:
+            return None
+        if self.stale[metric_id]&STALE_MIN:
+            self._refresh(metric_id)
+        return self.mins[metric_id],self.min_columns[metric_id]
+
+    def get_max(self,metric_id):
+        """ Return (count,column) of the max of a row or None if it has no count """
+        if not self.nb_ranks[metric_id]:
+            return None
+        if self.stale[metric_id]&STALE_MAX:
+            self._refresh(metric_id)
+        return self.maxs[metric_id],self.max_columns[metric_id]
+
+    def resize(self,stride):
+        """ Reserve stride columns per row """
+        values=array('d',bytes(8*stride*len(self.names)))
+        present=bytearray(stride*len(self.names))
+        for metric_id in range(len(self.names)):
+            old=metric_id*self.stride
+            new=metric_id*stride
+            values[new:new+self.stride]=self.values[old:old+self.stride]
+            present[new:new+self.stride]=self.present[old:old+self.stride]
+        self.values=values
+        self.present=present
+        self.stride=stride
+
+    def compact(self):
+        """ Drop rows of deleted metrics """
+        values=array('d')
+        present=bytearray()
+        names=[]
+        ids={}
+        kept=list(self.ids.values())
+        for metric_name,metric_id in self.ids.items():
+            start=metric_id*self.stride
+            ids[metric_name]=len(names)
+            names.append(metric_name)
+            values.extend(self.values[start:start+self.stride])
+            present.extend(self.present[start:start+self.stride])
+        self.values=values
+        self.present=present
+        self.names=names
+        self.ids=ids
+
+        for stat_name in ('nb_ranks','sums','mins','min_columns','maxs','max_columns'):
+            stat=getattr(self,stat_name)
+            setattr(self,stat_name,array(stat.typecode,(stat[metric_id] for metric_id in kept)))
+        self.stale=bytearray(self.stale[metric_id] for metric_id in kept)
+        self.sketches=[self.sketches[metric_id] for metric_id in kept]
+
+    def row(self,metric_id,nb_columns):
+        """ Values and presence mask of a metric for the first nb_columns ranks """
+        start=metric_id*self.stride
+        return self.values[start:start+nb_columns],self.present[start:start+nb_columns]
+
+
+class CounterTimeSeries:
+    """ Counts of hardware counters per interval of one rank, one array per counter.
+    Counts of counters that were not counted during an interval are NaN. """
+
+    def __init__(self):
+        # End of each interval in seconds
+        self.timestamps=array('d')
+        self.counts={}
+        # Percentage of each interval during which the counter was running (multiplexing)
+        self.running={}
+
+    def add_count(self,timestamp,counter,count,running=100.0):
+        if not self.timestamps or timestamp!=self.timestamps[-1]:
+            self.timestamps.append(timestamp)
+            for counter_array in self.counts.values():
+                counter_array.append(float("nan"))
+            for running_array in self.running.values():
+                running_array.append(float("nan"))
+
+        if counter not in self.counts:
+            self.counts[counter]=array('d',[float("nan")])*len(self.timestamps)
+            self.running[counter]=array('d',[float("nan")])*len(self.timestamps)
+
+        # An event counted in several groups is reported several times, the count of
+        # the group that ran the longest is the most accurate.
+        if not math.isnan(self.counts[counter][-1]) and self.running[counter][-1]>=running:
+            return
+        self.counts[counter][-1]=count
+        self.running[counter][-1]=running
+
+    def get_counters(self):
+        return list(self.counts.keys())
+
+    def get_durations(self):
+        """ Duration of each interval in seconds """
+        return array('d',(end-start for start,end in zip([0.0]+list(self.timestamps),self.timestamps)))
+
+    def get_total(self,counter):
+        """ Sum of the counts of a counter over all intervals, None if it was never counted """
+        if counter not in self.counts:
+            return None
+        counts=[count for count in self.counts[counter] if not math.isnan(count)]
+        if not counts:
+            return None
+        return math.fsum(counts)
+
+    def get_min_running(self,counter):
+        """ Lowest percentage of an interval during which counter was running """
+        return min((running for running in self.running.get(counter,[]) if not math.isnan(running)),
+                   default=None)
+
+    def get_grouped_counts(self,counter,step):
+        """ Sum counts of counter over groups of step consecutive intervals """
+        counts=self.counts.get(counter,array('d',[float("nan")])*len(self.timestamps))
+        grouped_counts=array('d')
+        for start in range(0,len(counts),step):
+            group=[count for count in counts[start:start+step] if not math.isnan(count)]
+            grouped_counts.append(math.fsum(group) if group else float("nan"))
+        return grouped_counts
+
 
 class MetricsManager:
 
     def __init__(self):
-        self.metrics_count=defaultdict(lambda : defaultdict(lambda : defaultdict(float)))
-        self.metrics_min={}
-        self.metrics_max={}
-        self.metrics_avg={}
+        # Ranks are interned to columns shared by all metric types
+        self.rank_columns={}
+        self.ranks=[]
+        # One table per metric type
+        self.metric_tables={}
+        # Hardware counters time series of each rank
+        self.time_series={}
+        # Sampled call trees of each rank
+        self.call_trees={}
+        # Samples of each rank per source line and instruction: {file:line: {mnemonic: count}}
+        self.source_lines={}
         
+    def _column(self,rank):
+        column=self.rank_columns.get(rank)
+        if column is None:
+            column=len(self.ranks)
+            self.rank_columns[rank]=column
+            self.ranks.append(rank)
+        return column
+
     def add_metric(self,rank,metric_type,metric_name,count=1):
 
-        self.metrics_count[metric_type][metric_name][rank]+=count
+        column=self._column(rank)
+        table=self.metric_tables.get(metric_type)
+        if table is None:
+            table=self.metric_tables[metric_type]=MetricTable(max(8,len(self.ranks)))
+        if column>=table.stride:
+            table.resize(max(2*table.stride,column+1))
+
+        metric_id=table.ids.get(metric_name)
+        if metric_id is None:
+            metric_id=table.add_row(metric_name)
+
+        table.add(metric_id,column,count)
+
+    def merge(self,other):
+        """ Add counts of another (partial) metrics manager to this one.
+        Metrics are merged in the order they were added to other. """
+        for metric_type,table in other.metric_tables.items():
+            for metric_name,metric_id in table.ids.items():
+                values,present=table.row(metric_id,len(other.ranks))
+                ranks=[other.ranks[column] for column in compress(range(len(other.ranks)),present)]
+
+                # Sketches of disjoint sets of ranks (parallel or distributed workers) are merged
+                # instead of being rebuilt from the merged row.
+                sketch=table.sketches[metric_id]
+                if sketch is not None:
+                    if self._metric_exists(metric_type,metric_name):
+                        own_sketch=self._get_valid_sketch(metric_type,metric_name)
+                        if own_sketch is None or any(self._metric_exists(metric_type,metric_name,rank)
+                                                     for rank in ranks):
+                            sketch=None
+                        else:
+                            own_sketch.merge(sketch)
+                            sketch=own_sketch
+                    else:
+                        sketch=sketches.QuantileSketch()
+                        sketch.merge(table.sketches[metric_id])
+
+                for rank in ranks:
+                    self.add_metric(rank,metric_type,metric_name,values[other.rank_columns[rank]])
+
+                if sketch is not None:
+                    own_table=self.metric_tables[metric_type]
+                    own_table.sketches[own_table.ids[metric_name]]=sketch
+
+        self.time_series.update(other.time_series)
+
+        for rank,call_tree in other.call_trees.items():
+            if rank in self.call_trees:
+                self.call_trees[rank].merge(call_tree)
+            else:
+                self.call_trees[rank]=call_tree
+
+        for rank,source_lines in other.source_lines.items():
+            own_source_lines=self.get_source_lines(rank)
+            for line,mix in source_lines.items():
+                _add_counts(own_source_lines.setdefault(line,{}),mix)
+
+    def set_time_series(self,rank,time_series):
+        self.time_series[rank]=time_series
+
+    def get_time_series(self,rank):
+        """ Return CounterTimeSeries of a rank or None """
+        return self.time_series.get(rank)
+
+    def get_call_tree(self,rank):
+        """ Return call tree of a rank, created empty on first call """
+        call_tree=self.call_trees.get(rank)
+        if call_tree is None:
+            call_tree=self.call_trees[rank]=calltree.CallTree()
+        return call_tree
+
+    def get_merged_call_tree(self,ranks=None):
+        """ Return the call tree of all ranks (or of the given ranks) merged together """
+        merged_tree=calltree.CallTree()
+        if ranks is None:
+            ranks=self.call_trees.keys()
+        for rank in ranks:
+            if rank in self.call_trees:
+                merged_tree.merge(self.call_trees[rank])
+        return merged_tree
+
+    def get_source_lines(self,rank):
+        """ Return {file:line: {mnemonic: count}} of a rank, created empty on first call """
+        return self.source_lines.setdefault(rank,{})
+
+    def get_merged_source_lines(self):
+        """ Return {file:line: {mnemonic: count}} of all ranks """
+        merged_lines={}
+        for source_lines in self.source_lines.values():
+            for line,mix in source_lines.items():
+                _add_counts(merged_lines.setdefault(line,{}),mix)
+        return merged_lines
 
     def remove_metric(self,metric_type,metric_name):
-        if metric_type in self.metrics_count:
-            if metric_name in self.metrics_count[metric_type]:
-                del self.metrics_count[metric_type][metric_name]
+        if metric_type in self.metric_tables:
+            table=self.metric_tables[metric_type]
+            if metric_name in table.ids:
+                table.clear_row(table.ids.pop(metric_name))
         
     def _metric_exists(self,metric_type,metric_name,rank=-1):
-        if not metric_type in self.metrics_count:
-            return False
-        if not metric_name in self.metrics_count[metric_type]:
+        if not metric_type in self.metric_tables:
             return False
-        if rank>=0 and not rank in self.metrics_count[metric_type][metric_name]:
+        if not metric_name in self.metric_tables[metric_type].ids:
             return False
+        if rank>=0:
+            if not rank in self.rank_columns:
+                return False
+            table=self.metric_tables[metric_type]
+            column=self.rank_columns[rank]
+            if column>=table.stride:
+                return False
+            if not table.present[table.ids[metric_name]*table.stride+column]:
+                return False
         
         return True
 
+    def _metric_row(self,metric_type,metric_name):
+        """ Counts and presence mask of a metric over all ranks """
+        table=self.metric_tables[metric_type]
+        return table.row(table.ids[metric_name],min(len(self.ranks),table.stride))
+
     def get_metric_types(self):
-        return list(self.metrics_count.keys())
+        return list(self.metric_tables.keys())
     
     def get_metric_names(self,metric_type):
-        if not metric_type in self.metrics_count:
+        if not metric_type in self.metric_tables:
             return []
         else:
-            return list(self.metrics_count[metric_type].keys())
+            return list(self.metric_tables[metric_type].ids.keys())
 
     def get_metric_names_sorted(self,metric_type):
         """ Get list of names sorted by descending count order """
-        if not metric_type in self.metrics_count:
+        if not metric_type in self.metric_tables:
             return []
         
-        metric_names=list(self.metrics_count[metric_type].keys())
+        metric_names=self.get_metric_names(metric_type)
 
         return sorted(metric_names,
                       key=lambda m_name: self.get_metric_avg(metric_type,m_name),reverse=True)
@@ -72,106 +467,159 @@ class MetricsManager:
 
         if not self._metric_exists(metric_type,metric_name,rank):
             return 0
-        return self.metrics_count[metric_type][metric_name][rank]
+        table=self.metric_tables[metric_type]
+        return table.values[table.ids[metric_name]*table.stride+self.rank_columns[rank]]
+
+    def get_metric_counts(self,metric_type,metric_name):
+        """ Return a dictionnary rank -> count of a metric """
+        if not self._metric_exists(metric_type,metric_name):
+            return {}
+        values,present=self._metric_row(metric_type,metric_name)
+        return {self.ranks[column]:values[column] for column in compress(range(len(values)),present)}
+
+    def get_metric_array(self,metric_type,metric_name,ranks):
+        """ Return counts of a metric for each rank of ranks, NaN for ranks without count """
+        counts=array('d',[float("nan")])*len(ranks)
+        if not self._metric_exists(metric_type,metric_name):
+            return counts
+        table=self.metric_tables[metric_type]
+        start=table.ids[metric_name]*table.stride
+        for irank,rank in enumerate(ranks):
+            column=self.rank_columns.get(rank)
+            if column is not None and column<table.stride and table.present[start+column]:
+                counts[irank]=table.values[start+column]
+        return counts
+
+    def move_metric(self,metric_type,metric_name,new_metric_type):
+        """ Move counts of a metric to another metric type """
+        if not self._metric_exists(metric_type,metric_name):
+            return
+        for rank,count in self.get_metric_counts(metric_type,metric_name).items():
+            self.add_metric(rank,new_metric_type,metric_name,count)
+        self.remove_metric(metric_type,metric_name)
 
     def metric_counts_to_ratios(self,metric_type,rank,adjust=None):
         """
         Change count to ratio of occurence amongst metrics of same types.
         """
-        total_count=0.0
-        for metric_name in self.metrics_count[metric_type]:
-            total_count+=self.metrics_count[metric_type][metric_name][rank]
-            
-        for metric_name in self.metrics_count[metric_type]:
-            if total_count>0:
-                self.metrics_count[metric_type][metric_name][rank]/=total_count
-                self.metrics_count[metric_type][metric_name][rank]*=100
-                if(adjust!=None):
-                    self.metrics_count[metric_type][metric_name][rank]*=adjust
+        if not metric_type in self.metric_tables:
+            return
+        table=self.metric_tables[metric_type]
+        column=self._column(rank)
+        if column>=table.stride:
+            table.resize(max(2*table.stride,column+1))
+
+        # Counts of all metrics for this rank are a strided slice of the table
+        counts=table.values[column::table.stride]
+        total_count=sum(counts)
+
+        if total_count>0:
+            if(adjust!=None):
+                ratios=[count/total_count*100*adjust for count in counts]
+            else:
+                ratios=[count/total_count*100 for count in counts]
+        else:
+            ratios=counts
+
+        # Every metric of this type now has a (possibly null) ratio for this rank
+        table.set_column(column,ratios)
 
                                                                          
 
     def del_metric_low_ratios(self,metric_type,ratio_limit):
         """ Delete metrics with low occurence over all metrics from the same type,
         Usefull to keep only frequent assembly instructions and symbols"""
+        if not metric_type in self.metric_tables:
+            return
+        table=self.metric_tables[metric_type]
         metric_names_to_delete=[]
-        for metric_name in self.metrics_count[metric_type]:
-            todelete=True
-            for rank in self.metrics_count[metric_type][metric_name]:
-                if self.metrics_count[metric_type][metric_name][rank]>ratio_limit:
-                    todelete=False
-                    break
-            if todelete:
+        for metric_name,metric_id in table.ids.items():
+            metric_max=table.get_max(metric_id)
+            if metric_max is None or metric_max[0]<=ratio_limit:
                 metric_names_to_delete.append(metric_name)
-                
+        if not metric_names_to_delete:
+            return
+
+        # Rows of deleted metrics are dropped in a single rebuild of the table
         for metric_name in metric_names_to_delete:
-            del self.metrics_count[metric_type][metric_name]
+            del table.ids[metric_name]
+        table.compact()
         
     
+    def get_metric_sum(self,metric_type,metric_name):
+        """ Sum of the counts of a metric over ranks """
+        if not self._metric_exists(metric_type,metric_name):
+            return 0
+        table=self.metric_tables[metric_type]
+        return table.sums[table.ids[metric_name]]
+
     def get_metric_avg(self,metric_type,metric_name):
 
-        # If already computed return the existent value
-        if metric_type in self.metrics_avg and metric_name in self.metrics_avg[metric_type]:
-            return self.metrics_avg[metric_type][metric_name]
-        elif not self._metric_exists(metric_type,metric_name):
+        if not self._metric_exists(metric_type,metric_name):
             return 0
-        if not metric_type in self.metrics_avg:
-            self.metrics_avg[metric_type]={}
 
-        avg=0
-        nbrank=0
-        for rank,count in self.metrics_count[metric_type][metric_name].items():
-            avg+=count
-            nbrank+=1
+        table=self.metric_tables[metric_type]
+        metric_id=table.ids[metric_name]
+        nbrank=table.nb_ranks[metric_id]
 
         if nbrank!=0:
-            self.metrics_avg[metric_type][metric_name]=avg/nbrank
+            # Counts of ranks without the metric are null
+            return table.sums[metric_id]/nbrank
         else:
-            self.metrics_avg[metric_type][metric_name]=0.0
-            
-        return self.metrics_avg[metric_type][metric_name]
+            return 0.0
         
-    def get_metric_min(self,metric_type,metric_name):
+    def _get_metric_extremum(self,metric_type,metric_name,get_extremum):
+        """ Return (count,rank) of the min or max count of a metric, first rank wins on ties """
+        if not self._metric_exists(metric_type,metric_name):
+            return None
 
-        # If already computed return the existent value
-        if metric_type in self.metrics_min and metric_name in self.metrics_min[metric_type]:
-            return self.metrics_min[metric_type][metric_name]
-        elif not self._metric_exists(metric_type,metric_name):
+        table=self.metric_tables[metric_type]
+        extremum=get_extremum(table,table.ids[metric_name])
+        if extremum is None:
             return None
-        if not metric_type in self.metrics_min:
-            self.metrics_min[metric_type]={}
+        return (extremum[0],self.ranks[extremum[1]])
 
-        
-        min_count=float("inf")
-        min_rank=0
-        for rank,count in self.metrics_count[metric_type][metric_name].items():
-            if count < min_count:
-                min_count=count
-                min_rank=rank
-                
-        self.metrics_min[metric_type][metric_name]=(min_count,min_rank)
-        
-        return self.metrics_min[metric_type][metric_name]
+    def get_metric_min(self,metric_type,metric_name):
+        return self._get_metric_extremum(metric_type,metric_name,MetricTable.get_min)
         
     def get_metric_max(self,metric_type,metric_name):
+        return self._get_metric_extremum(metric_type,metric_name,MetricTable.get_max)
 
-        # If already computed return the existent value
-        if metric_type in self.metrics_max and metric_name in self.metrics_max[metric_type]:
-            return self.metrics_max[metric_type][metric_name]
-        elif not self._metric_exists(metric_type,metric_name):
+    def _get_valid_sketch(self,metric_type,metric_name):
+        """ Return the sketch of a metric if it is up to date, None otherwise """
+        table=self.metric_tables[metric_type]
+        return table.sketches[table.ids[metric_name]]
+
+    def get_metric_sketch(self,metric_type,metric_name):
+        """ Return the quantile sketch of the counts of a metric over ranks or None """
+        if not self._metric_exists(metric_type,metric_name):
             return None
-        if not metric_type in self.metrics_max:
-            self.metrics_max[metric_type]={}
 
-        
-        
-        max_count=-float("inf")
-        max_rank=0
-        for rank,count in self.metrics_count[metric_type][metric_name].items():
-            if count > max_count:
-                max_count=count
-                max_rank=rank
-                
-        self.metrics_max[metric_type][metric_name]=(max_count,max_rank)
-        return self.metrics_max[metric_type][metric_name]
-        
+        table=self.metric_tables[metric_type]
+        metric_id=table.ids[metric_name]
+        if table.sketches[metric_id] is None:
+            sketch=sketches.QuantileSketch()
+            values,present=self._metric_row(metric_type,metric_name)
+            for column in compress(range(len(values)),present):
+                sketch.add(values[column],self.ranks[column])
+            table.sketches[metric_id]=sketch
+        return table.sketches[metric_id]
+
+    def get_metric_quantile(self,metric_type,metric_name,q):
+        """ Return the estimated q quantile (0<=q<=1) of a metric over ranks """
+        sketch=self.get_metric_sketch(metric_type,metric_name)
+        if sketch is None:
+            return None
+        return sketch.quantile(q)
+
+    def get_metric_outliers(self,metric_type,metric_name):
+        """ Return (rank,count) of ranks whose count is far from the counts of other ranks """
+        sketch=self.get_metric_sketch(metric_type,metric_name)
+        if sketch is None:
+            return []
+        return sketch.outliers()
+
+
+def _add_counts(counts,other_counts):
+    for key,count in other_counts.items():
+        counts[key]=counts.get(key,0)+count
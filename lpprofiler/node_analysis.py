@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#  This file is part of the LPprofiler profiling tool.                       #
+#        Copyright (C) 2017  EDF SA                                          #
+#                                                                            #
+#  LPprofiler is free software: you can redistribute it and/or modify        #
+#  it under the terms of the GNU General Public License as published by      #
+#  the Free Software Foundation, either version 3 of the License, or         #
+#  (at your option) any later version.                                       #
+#                                                                            #
+#  LPprofiler is distributed in the hope that it will be useful,             #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of            #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the             #
+#  GNU General Public License for more details.                              #
+#                                                                            #
+#  You should have received a copy of the GNU General Public License         #
+#  along with LPprofiler.  If not, see <http://www.gnu.org/licenses/>.       #
+#                                                                            #
+############################################################################## 
+
+from subprocess import Popen,PIPE
+import lpprofiler.metrics_manager as metm
+import lpprofiler.perf_hwcounters_profiler as php
+import lpprofiler.perf_samples_profiler as psp
+import os, sys, pickle, zlib, socket
+
+# Bump when the content of summaries changes, front-end and nodes must agree on it
+SUMMARY_FORMAT_VERSION=2
+
+# Front-end options forwarded to node analyses
+FORWARDED_OPTIONS=[('decoder','--decoder'),('jobs','--jobs'),
+                   ('cache_dir','--cache-dir'),('cache_size','--cache-size'),
+                   ('sample_budget','--sample-budget'),('duration','--duration')]
+
+
+def build_profilers(metrics_manager,traces_directory,ranks,profiling_args):
+    """ Profilers reading the perf stat and perf record output files of ranks """
+    stats_files=["{}/perf.stats_{}".format(traces_directory,rank) for rank in ranks]
+    data_files=["{}/perf.data_{}".format(traces_directory,rank) for rank in ranks]
+    return [php.PerfHWcountersProfiler(metrics_manager,stats_files,stats_files,profiling_args),
+            psp.PerfSamplesProfiler(metrics_manager,data_files,data_files,profiling_args)]
+
+
+def analyze_node(traces_directory,ranks,profiling_args):
+    """ Count metrics of ranks whose traces are in traces_directory. Counts are not
+    finalized, this is done by the front-end once summaries of all nodes are merged. """
+    metrics_manager=metm.MetricsManager()
+    for profiler in build_profilers(metrics_manager,traces_directory,ranks,profiling_args):
+        profiler.analyze_ranks(profiler.get_rank_files(ranks))
+    return metrics_manager
+
+
+def dumps_summary(metrics_manager):
+    """ Serialize and compress per-rank counts of a metrics manager """
+    return zlib.compress(pickle.dumps((SUMMARY_FORMAT_VERSION,metrics_manager),pickle.HIGHEST_PROTOCOL))
+
+
+def loads_summary(summary):
+    """ Rebuild a metrics manager from dumps_summary() output """
+    try:
+        version,metrics_manager=pickle.loads(zlib.decompress(summary))
+    except (EOFError,ValueError,TypeError,zlib.error,pickle.UnpicklingError) as e:
+        raise ValueError("invalid node summary: {}".format(e))
+    if version!=SUMMARY_FORMAT_VERSION:
+        raise ValueError("node summary version {} is not supported".format(version))
+    return metrics_manager
+
+
+def write_summary(traces_directory,ranks,profiling_args,out=None):
+    """ Analyze ranks and write their summary, to stdout by default """
+    if out is None:
+        out=sys.stdout.buffer
+    out.write(dumps_summary(analyze_node(traces_directory,ranks,profiling_args)))
+    out.flush()
+
+
+def is_local_host(host):
+    hostname=socket.gethostname()
+    return host in ('localhost','127.0.0.1',hostname,hostname.split('.')[0])
+
+
+def get_forwarded_options(profiling_args):
+    """ Command line options of the front-end used by node analyses """
+    options=""
+    for key,option in FORWARDED_OPTIONS:
+        if key in profiling_args:
+            options+=" {} {}".format(option,profiling_args[key])
+    # Sampling of ranks is only measured when they have a sampling budget
+    if "sample_overhead" in profiling_args:
+        options+=" --sample-budget {:g}%".format(profiling_args["sample_overhead"]*100)
+    if profiling_args.get("no_cache"):
+        options+=" --no-cache"
+    if profiling_args.get("source_lines"):
+        options+=" --source-lines"
+    return options
+
+
+def get_node_cmd(host,traces_directory,ranks,profiling_args):
+    """ Command running the analysis of ranks on host """
+    node_cmd="{} --node-analysis -o {} --ranks {}".format(
+        profiling_args.get("lpprof_cmd","lpprof"),os.path.abspath(traces_directory),
+        ','.join(str(rank) for rank in ranks))
+
+    node_cmd+=get_forwarded_options(profiling_args)
+
+    if not is_local_host(host):
+        node_cmd="ssh {} '{}'".format(host,node_cmd)
+
+    return node_cmd
+
+
+def run_node_analyses(hosts_ranks,traces_directory,profiling_args):
+    """ Start the analysis of all hosts at once and yield (host,ranks,metrics_manager) in hosts_ranks
+    order. metrics_manager is None when the analysis failed on host. """
+    node_processes=[]
+    for host,ranks in hosts_ranks.items():
+        node_cmd=get_node_cmd(host,traces_directory,ranks,profiling_args)
+        node_processes.append((host,ranks,Popen(node_cmd,shell=True,stdout=PIPE)))
+
+    for host,ranks,node_process in node_processes:
+        summary,_=node_process.communicate()
+        metrics_manager=None
+        if node_process.returncode==0:
+            try:
+                metrics_manager=loads_summary(summary)
+            except ValueError as e:
+                print("Cannot read summary of {}: {}".format(host,e))
+        yield host,ranks,metrics_manager
@@ -0,0 +1,453 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#  This file is part of the LPprofiler profiling tool.                       #
+#        Copyright (C) 2017  EDF SA                                          #
+#                                                                            #
+#  LPprofiler is free software: you can redistribute it and/or modify        #
+#  it under the terms of the GNU General Public License as published by      #
+#  the Free Software Foundation, either version 3 of the License, or         #
+#  (at your option) any later version.                                       #
+#                                                                            #
+#  LPprofiler is distributed in the hope that it will be useful,             #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of            #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the             #
+#  GNU General Public License for more details.                              #
+#                                                                            #
+#  You should have received a copy of the GNU General Public License         #
+#  along with LPprofiler.  If not, see <http://www.gnu.org/licenses/>.       #
+#                                                                            #
+##############################################################################
+
+from collections import namedtuple
+import bisect, mmap, struct
+
+try:
+    import zstandard
+except ImportError:
+    # Only needed to decode traces recorded with perf record -z
+    zstandard=None
+
+
+PERF_MAGIC=b'PERFILE2'
+
+# Record types (include/uapi/linux/perf_event.h and tools/perf/util/event.h)
+PERF_RECORD_MMAP=1
+PERF_RECORD_COMM=3
+PERF_RECORD_EXIT=4
+PERF_RECORD_FORK=7
+PERF_RECORD_SAMPLE=9
+PERF_RECORD_MMAP2=10
+PERF_RECORD_HEADER_ATTR=64
+PERF_RECORD_HEADER_TRACING_DATA=66
+PERF_RECORD_AUXTRACE=71
+PERF_RECORD_COMPRESSED=81
+
+# Sample types
+PERF_SAMPLE_IP=1<<0
+PERF_SAMPLE_TID=1<<1
+PERF_SAMPLE_TIME=1<<2
+PERF_SAMPLE_ADDR=1<<3
+PERF_SAMPLE_READ=1<<4
+PERF_SAMPLE_CALLCHAIN=1<<5
+PERF_SAMPLE_ID=1<<6
+PERF_SAMPLE_CPU=1<<7
+PERF_SAMPLE_PERIOD=1<<8
+PERF_SAMPLE_STREAM_ID=1<<9
+PERF_SAMPLE_IDENTIFIER=1<<16
+
+# Read formats
+PERF_FORMAT_TOTAL_TIME_ENABLED=1<<0
+PERF_FORMAT_TOTAL_TIME_RUNNING=1<<1
+PERF_FORMAT_ID=1<<2
+PERF_FORMAT_GROUP=1<<3
+PERF_FORMAT_LOST=1<<4
+
+# Attribute flags
+PERF_ATTR_FLAG_FREQ=1<<10
+
+# Sample cpu modes (header misc & PERF_RECORD_MISC_CPUMODE_MASK)
+PERF_RECORD_MISC_CPUMODE_MASK=7
+PERF_RECORD_MISC_KERNEL=1
+PERF_RECORD_MISC_USER=2
+
+# Callchain entries above this value are context markers (PERF_CONTEXT_*), not addresses
+PERF_CONTEXT_MAX=(1<<64)-4095
+PERF_CONTEXT_KERNEL=(1<<64)-128
+PERF_CONTEXT_USER=(1<<64)-512
+
+FILE_HEADER=struct.Struct('<8sQQQQQQQQ')
+EVENT_HEADER=struct.Struct('<IHH')
+ATTR_HEADER=struct.Struct('<IIQQQQQ')
+SECTION=struct.Struct('<QQ')
+MMAP_BODY=struct.Struct('<iiQQQ')
+MMAP2_BODY=struct.Struct('<iiQQQ24sII')
+COMM_BODY=struct.Struct('<ii')
+FORK_BODY=struct.Struct('<iiii')
+U32=struct.Struct('<I')
+U64=struct.Struct('<Q')
+PID_TID=struct.Struct('<ii')
+
+
+PerfEventAttr=namedtuple('PerfEventAttr',['type','config','sample_period','sample_freq',
+                                          'sample_type','read_format','flags','ids'])
+MmapEvent=namedtuple('MmapEvent',['pid','tid','start','length','pgoff','filename'])
+CommEvent=namedtuple('CommEvent',['pid','tid','comm'])
+ForkEvent=namedtuple('ForkEvent',['pid','ppid','tid','ptid'])
+SampleEvent=namedtuple('SampleEvent',['pid','tid','ip','time','period','cpumode','callchain','attr'])
+
+
+class PerfDataError(Exception):
+    """ Raised when a perf.data file cannot be decoded """
+    pass
+
+
+def _decode_attr(buf,offset,ids=()):
+    """ Decode the leading fields of a perf_event_attr """
+    try:
+        attr_type,attr_size,config,period,sample_type,read_format,flags=\
+            ATTR_HEADER.unpack_from(buf,offset)
+    except struct.error:
+        raise PerfDataError("Truncated perf_event_attr")
+    if flags & PERF_ATTR_FLAG_FREQ:
+        return PerfEventAttr(attr_type,config,0,period,sample_type,read_format,flags,tuple(ids)),attr_size
+    return PerfEventAttr(attr_type,config,period,0,sample_type,read_format,flags,tuple(ids)),attr_size
+
+
+def _read_string(buf,start,end):
+    """ Read a NUL terminated string stored in buf[start:end] """
+    raw=bytes(buf[start:end])
+    return raw.split(b'\0',1)[0].decode('utf-8','replace')
+
+
+class PerfRecordDecoder :
+    """ Decode perf records from a buffer according to the perf_event_attr of the trace """
+
+    def __init__(self,attrs=None):
+        self.attrs=[]
+        self.attr_by_id={}
+        self._decompressor=None
+        self._decompressed=b''
+        for attr in attrs or []:
+            self.add_attr(attr)
+
+    def add_attr(self,attr):
+        self.attrs.append(attr)
+        for attr_id in attr.ids:
+            self.attr_by_id[attr_id]=attr
+
+    def _sample_attr(self,body,offset,end):
+        """ Find the attr a sample belongs to, only needed when several events are recorded """
+        attr=self.attrs[0]
+        if len(self.attrs)>1 and attr.sample_type & PERF_SAMPLE_IDENTIFIER:
+            attr=self.attr_by_id.get(U64.unpack_from(body,offset)[0],attr)
+        return attr
+
+    def decode_sample(self,body,offset,end,misc):
+        """ Decode a PERF_RECORD_SAMPLE, fields after the callchain are ignored """
+        if not self.attrs:
+            raise PerfDataError("Sample found before any event attribute")
+        attr=self._sample_attr(body,offset,end)
+        sample_type=attr.sample_type
+
+        ip=pid=tid=time=0
+        period=attr.sample_period
+        callchain=()
+        try:
+            if sample_type & PERF_SAMPLE_IDENTIFIER:
+                offset+=8
+            if sample_type & PERF_SAMPLE_IP:
+                ip=U64.unpack_from(body,offset)[0]
+                offset+=8
+            if sample_type & PERF_SAMPLE_TID:
+                pid,tid=PID_TID.unpack_from(body,offset)
+                offset+=8
+            if sample_type & PERF_SAMPLE_TIME:
+                time=U64.unpack_from(body,offset)[0]
+                offset+=8
+            if sample_type & PERF_SAMPLE_ADDR:
+                offset+=8
+            if sample_type & PERF_SAMPLE_ID:
+                offset+=8
+            if sample_type & PERF_SAMPLE_STREAM_ID:
+                offset+=8
+            if sample_type & PERF_SAMPLE_CPU:
+                offset+=8
+            if sample_type & PERF_SAMPLE_PERIOD:
+                period=U64.unpack_from(body,offset)[0]
+                offset+=8
+            if sample_type & PERF_SAMPLE_READ:
+                offset=self._skip_read_values(body,offset,attr.read_format)
+            if sample_type & PERF_SAMPLE_CALLCHAIN:
+                nr=U64.unpack_from(body,offset)[0]
+                offset+=8
+                if offset+nr*8>end:
+                    raise PerfDataError("Callchain exceeds sample size")
+                callchain=struct.unpack_from('<{}Q'.format(nr),body,offset)
+        except struct.error:
+            raise PerfDataError("Truncated sample record")
+
+        return SampleEvent(pid,tid,ip,time,period,misc & PERF_RECORD_MISC_CPUMODE_MASK,callchain,attr)
+
+    def _skip_read_values(self,body,offset,read_format):
+        """ Return offset after a struct read_format """
+        value_size=8
+        if read_format & PERF_FORMAT_ID:
+            value_size+=8
+        if read_format & PERF_FORMAT_LOST:
+            value_size+=8
+        times_size=0
+        if read_format & PERF_FORMAT_TOTAL_TIME_ENABLED:
+            times_size+=8
+        if read_format & PERF_FORMAT_TOTAL_TIME_RUNNING:
+            times_size+=8
+
+        if read_format & PERF_FORMAT_GROUP:
+            nr=U64.unpack_from(body,offset)[0]
+            return offset+8+times_size+nr*value_size
+        return offset+times_size+value_size
+
+    def decode_records(self,buf,offset,end):
+        """ Yield events decoded from the records stored in buf[offset:end] """
+        while offset+EVENT_HEADER.size<=end:
+            rec_type,misc,size=EVENT_HEADER.unpack_from(buf,offset)
+            if size<EVENT_HEADER.size:
+                raise PerfDataError("Invalid record size at offset {}".format(offset))
+            body=offset+EVENT_HEADER.size
+            rec_end=offset+size
+            if rec_end>end:
+                # Last record of an interrupted recording may be incomplete
+                return
+
+            for event in self.decode_record(rec_type,misc,buf,body,rec_end):
+                yield event
+
+            offset=rec_end
+            # Some records are followed by a payload which is not part of the record size
+            if rec_type==PERF_RECORD_AUXTRACE:
+                try:
+                    offset+=U64.unpack_from(buf,body)[0]
+                except struct.error:
+                    raise PerfDataError("Truncated auxtrace record")
+
+    def decode_record(self,rec_type,misc,buf,body,rec_end):
+        """ Decode a single record, return a list of events """
+        try:
+            return self._decode_record(rec_type,misc,buf,body,rec_end)
+        except struct.error:
+            raise PerfDataError("Truncated record of type {}".format(rec_type))
+
+    def _decode_record(self,rec_type,misc,buf,body,rec_end):
+        if rec_type==PERF_RECORD_SAMPLE:
+            return [self.decode_sample(buf,body,rec_end,misc)]
+        elif rec_type==PERF_RECORD_MMAP2:
+            pid,tid,start,length,pgoff,dev,prot,flags=MMAP2_BODY.unpack_from(buf,body)
+            return [MmapEvent(pid,tid,start,length,pgoff,
+                              _read_string(buf,body+MMAP2_BODY.size,rec_end))]
+        elif rec_type==PERF_RECORD_MMAP:
+            pid,tid,start,length,pgoff=MMAP_BODY.unpack_from(buf,body)
+            return [MmapEvent(pid,tid,start,length,pgoff,
+                              _read_string(buf,body+MMAP_BODY.size,rec_end))]
+        elif rec_type==PERF_RECORD_COMM:
+            pid,tid=COMM_BODY.unpack_from(buf,body)
+            return [CommEvent(pid,tid,_read_string(buf,body+COMM_BODY.size,rec_end))]
+        elif rec_type==PERF_RECORD_FORK:
+            pid,ppid,tid,ptid=FORK_BODY.unpack_from(buf,body)
+            return [ForkEvent(pid,ppid,tid,ptid)]
+        elif rec_type==PERF_RECORD_HEADER_ATTR:
+            attr,attr_size=_decode_attr(buf,body)
+            nids=(rec_end-body-attr_size)//8
+            ids=struct.unpack_from('<{}Q'.format(nids),buf,body+attr_size) if nids>0 else ()
+            self.add_attr(attr._replace(ids=tuple(ids)))
+            return []
+        elif rec_type==PERF_RECORD_COMPRESSED:
+            return list(self._decode_compressed(buf,body,rec_end))
+        return []
+
+    def _decode_compressed(self,buf,body,rec_end):
+        """ Decode records compressed by perf record -z, records may span several
+        compressed records so the decompression stream is kept between calls. """
+        if zstandard is None:
+            raise PerfDataError("Trace is compressed and python zstandard module is not available")
+        if self._decompressor is None:
+            self._decompressor=zstandard.ZstdDecompressor().decompressobj()
+
+        self._decompressed+=self._decompressor.decompress(bytes(buf[body:rec_end]))
+        data=self._decompressed
+        offset=0
+        while offset+EVENT_HEADER.size<=len(data):
+            rec_type,misc,size=EVENT_HEADER.unpack_from(data,offset)
+            if size<EVENT_HEADER.size:
+                raise PerfDataError("Invalid compressed record size")
+            if offset+size>len(data):
+                break
+            for event in self.decode_record(rec_type,misc,data,offset+EVENT_HEADER.size,offset+size):
+                yield event
+            offset+=size
+        self._decompressed=data[offset:]
+
+
+class PerfDataReader :
+    """ Memory mapped reader of perf.data files. Records are decoded in place with
+    struct, without running perf script. """
+
+    def __init__(self,path):
+        self.path=path
+        self._file=open(path,'rb')
+        try:
+            self._map=mmap.mmap(self._file.fileno(),0,access=mmap.ACCESS_READ)
+        except ValueError:
+            self._file.close()
+            raise PerfDataError("{} is empty".format(path))
+        self._buf=memoryview(self._map)
+
+        try:
+            self._read_header()
+        except struct.error:
+            self.close()
+            raise PerfDataError("{} has a truncated header".format(path))
+        except PerfDataError:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        self.close()
+
+    def close(self):
+        if self._buf is not None:
+            self._buf.release()
+            self._buf=None
+            self._map.close()
+            self._file.close()
+
+    def _read_header(self):
+        if len(self._buf)<16:
+            raise PerfDataError("{} is too small to be a perf.data file".format(self.path))
+
+        magic,header_size=struct.unpack_from('<8sQ',self._buf,0)
+        if magic!=PERF_MAGIC:
+            raise PerfDataError("{} is not a little endian perf.data file".format(self.path))
+
+        self.decoder=PerfRecordDecoder()
+
+        # In pipe mode the header is followed by records only, attributes are sent as records
+        if header_size==16:
+            self.pipe_mode=True
+            self.data_offset=16
+            self.data_end=len(self._buf)
+            return
+
+        self.pipe_mode=False
+        (magic,header_size,attr_size,attrs_offset,attrs_size,
+         data_offset,data_size,event_types_offset,event_types_size)=FILE_HEADER.unpack_from(self._buf,0)
+
+        for attr_offset in range(attrs_offset,attrs_offset+attrs_size,attr_size):
+            attr,size=_decode_attr(self._buf,attr_offset)
+            ids_offset,ids_size=SECTION.unpack_from(self._buf,attr_offset+attr_size-SECTION.size)
+            ids=struct.unpack_from('<{}Q'.format(ids_size//8),self._buf,ids_offset)
+            self.decoder.add_attr(attr._replace(ids=tuple(ids)))
+
+        self.data_offset=data_offset
+        # Data size is only written when perf record ends cleanly
+        if data_size:
+            self.data_end=min(data_offset+data_size,len(self._buf))
+        else:
+            self.data_end=len(self._buf)
+
+    @property
+    def attrs(self):
+        return self.decoder.attrs
+
+    def iter_events(self):
+        """ Yield MmapEvent, CommEvent, ForkEvent and SampleEvent in file order """
+        return self.decoder.decode_records(self._buf,self.data_offset,self.data_end)
+
+
+def iter_stream_events(stream):
+    """ Yield events read from a perf.data stream produced by perf record -o - """
+    header=stream.read(16)
+    if len(header)<16:
+        return
+    magic,header_size=struct.unpack('<8sQ',header)
+    if magic!=PERF_MAGIC or header_size!=16:
+        raise PerfDataError("Stream is not a perf.data pipe")
+
+    decoder=PerfRecordDecoder()
+    while True:
+        raw_header=stream.read(EVENT_HEADER.size)
+        if len(raw_header)<EVENT_HEADER.size:
+            return
+        rec_type,misc,size=EVENT_HEADER.unpack(raw_header)
+        if size<EVENT_HEADER.size:
+            raise PerfDataError("Invalid record size in stream")
+        body=stream.read(size-EVENT_HEADER.size)
+        if len(body)<size-EVENT_HEADER.size:
+            return
+        record=raw_header+body
+
+        for event in decoder.decode_record(rec_type,misc,record,EVENT_HEADER.size,size):
+            yield event
+
+        # Payloads following a record are not part of its size
+        try:
+            if rec_type==PERF_RECORD_HEADER_TRACING_DATA:
+                stream.read(U32.unpack_from(record,EVENT_HEADER.size)[0])
+            elif rec_type==PERF_RECORD_AUXTRACE:
+                stream.read(U64.unpack_from(record,EVENT_HEADER.size)[0])
+        except struct.error:
+            raise PerfDataError("Truncated record of type {} in stream".format(rec_type))
+
+
+class AddressMaps :
+    """ Track binaries mapped in the address space of each process from mmap events
+    and resolve sample addresses against mappings live at sample time. """
+
+    # Kernel mappings are recorded with pid -1 and shared by all processes
+    KERNEL_PID=-1
+
+    def __init__(self):
+        # pid -> (sorted start addresses, [(start,end,pgoff,filename)])
+        self.maps={}
+
+    def _pid_maps(self,pid):
+        if pid not in self.maps:
+            self.maps[pid]=([],[])
+        return self.maps[pid]
+
+    def add(self,mmap_event):
+        """ Add a mapping, replacing mappings it overlaps """
+        starts,entries=self._pid_maps(mmap_event.pid)
+        start=mmap_event.start
+        end=start+mmap_event.length
+
+        # Remove overlapped mappings, a new mmap over an old range replaces it
+        idx=bisect.bisect_left(starts,start)
+        if idx>0 and entries[idx-1][1]>start:
+            idx-=1
+        last=idx
+        while last<len(entries) and entries[last][0]<end:
+            last+=1
+        del starts[idx:last]
+        del entries[idx:last]
+
+        starts.insert(idx,start)
+        entries.insert(idx,(start,end,mmap_event.pgoff,mmap_event.filename))
+
+    def fork(self,fork_event):
+        """ A forked process inherits the mappings of its parent """
+        if fork_event.pid!=fork_event.ppid and fork_event.ppid in self.maps:
+            starts,entries=self.maps[fork_event.ppid]
+            self.maps[fork_event.pid]=(list(starts),list(entries))
+
+    def find(self,pid,address):
+        """ Return (start,end,pgoff,filename) of the mapping containing address or None """
+        for map_pid in (pid,self.KERNEL_PID):
+            if map_pid not in self.maps:
+                continue
+            starts,entries=self.maps[map_pid]
+            idx=bisect.bisect_right(starts,address)-1
+            if idx>=0 and address<entries[idx][1]:
+                return entries[idx]
+        return None
@@ -19,7 +19,104 @@
 ##############################################################################
 import lpprofiler.profiler as prof
 import lpprofiler.metrics_manager as metm
-import sys, re, os
+import lpprofiler.derived_metrics as dermet
+import lpprofiler.cpu_events as cpuev
+import sys, re, os, math
+
+# Field separator of perf stat -x output. Counts may be printed with a decimal comma
+# depending on the locale, a semicolon keeps fields unambiguous.
+CSV_SEPARATOR=';'
+
+# Default perf stat -I interval in milliseconds
+DEFAULT_INTERVAL=1000
+
+NOT_COUNTED_VALUES=('<not counted>','<not supported>')
+
+# Derived metrics shown for each interval in the report
+INTERVAL_METRICS=['ins-per-cycle','GHz','CPUs-utilized']
+
+# Raw counters only used to compute derived metrics, they are kept out of the report
+# as hwc_raw metrics.
+RAW_COUNTERS=['instructions','dTLBmiss_cycles','iTLBmiss_cycles','TLBgroup_cycles']
+
+
+def _to_float(field):
+    return float(field.strip().replace(',','.'))
+
+def _is_count(field):
+    try:
+        _to_float(field)
+    except ValueError:
+        return field.strip() in NOT_COUNTED_VALUES
+    return True
+
+
+def parse_perf_stat_csv(stats_file):
+    """ Read the output of perf stat -x with or without -I into a CounterTimeSeries """
+    with open(stats_file,'r') as sf:
+        return parse_perf_stat_lines(sf)
+
+
+def parse_perf_stat_lines(lines,time_series=None):
+    """ Add counts of perf stat -x output lines to time_series (a new CounterTimeSeries by default) """
+    if time_series is None:
+        time_series=metm.CounterTimeSeries()
+
+    for line in lines:
+        line=line.strip()
+        if not line or line.startswith('#'):
+            continue
+
+        fields=line.split(CSV_SEPARATOR)
+        if len(fields)<3:
+            continue
+
+        # In interval mode lines start with a timestamp: <time>;<count>;<unit>;<event>;...
+        # otherwise with the count: <count>;<unit>;<event>;<run time>;<% running>;...
+        if _is_count(fields[1]):
+            timestamp=_to_float(fields[0])
+            fields=fields[1:]
+        else:
+            timestamp=0.0
+
+        if len(fields)<3 or fields[0].strip() in NOT_COUNTED_VALUES:
+            continue
+        try:
+            count=_to_float(fields[0])
+        except ValueError:
+            continue
+
+        running=100.0
+        if len(fields)>4 and fields[4].strip():
+            running=_to_float(fields[4])
+
+        # Modifiers added by perf (ex: cycles:u) are not part of the counter name
+        counter=fields[2].strip().split(':')[0]
+        time_series.add_count(timestamp,counter,count,running)
+
+    return time_series
+
+
+def interval_metrics(time_series,step=1,registry=None):
+    """ Return end timestamps and derived metrics of each group of step consecutive intervals """
+    if registry is None:
+        registry=dermet.DerivedMetricsRegistry()
+
+    columns={counter:time_series.get_grouped_counts(counter,step) for counter in time_series.get_counters()}
+    durations=time_series.get_durations()
+    columns['elapsed_time']=[math.fsum(durations[start:start+step])
+                             for start in range(0,len(durations),step)]
+
+    timestamps=[time_series.timestamps[min(start+step,len(time_series.timestamps))-1]
+                for start in range(0,len(time_series.timestamps),step)]
+    derived_columns=registry.evaluate_columns(columns)
+
+    metrics={}
+    for metric_name in INTERVAL_METRICS:
+        values=derived_columns.get(metric_name,[float("nan")]*len(timestamps))
+        metrics[metric_name]=[None if math.isnan(value) else value for value in values]
+
+    return timestamps,metrics
 
 
 class PerfHWcountersProfiler(prof.Profiler) :
@@ -29,99 +126,63 @@ class PerfHWcountersProfiler(prof.Profiler) :
         
         prof.Profiler.__init__(self,metrics_manager,trace_files,output_files,profiling_args)
 
+        self.interval=self.profiling_args.get("interval",DEFAULT_INTERVAL)
+
+        # Counted events depend on the selected profiles and on the CPU model
+        cpu_info=cpuev.read_cpuinfo(self.profiling_args.get("cpuinfo",cpuev.DEFAULT_CPUINFO))
+        self.counter_set=cpuev.CounterSet(cpu_info,self.profiling_args.get("counter_profiles",['default']))
+
+        # Derived metrics formulas, users can add their own
+        self.derived_metrics=dermet.DerivedMetricsRegistry()
+        for metric_name,expression in self.counter_set.formulas:
+            self.derived_metrics.add_formula(metric_name,expression)
+        if self.profiling_args.get("metrics_file"):
+            self.derived_metrics.load_file(self.profiling_args["metrics_file"])
+
     
     def get_profile_cmd(self,pid=-1,rank=-1):
         """ Hardware counters profiling command """
         # Add a delay of 100 milliseconds to avoid counting 'perf record' launching hw counters stats.
-        counters=[]
-        counters.append("instructions")
-        counters.append("cycles")
-        counters.append("cpu-clock")
-        counters.append("task-clock")
-        counters.append("cpu/event=0x08,umask=0x10,name=dTLBmiss_cycles/")
-        counters.append("cpu/event=0x85,umask=0x10,name=iTLBmiss_cycles/")
+        counters=self.counter_set.get_event_option()
+
+        # Counts are written as CSV for each interval so that their evolution can be followed
+        stat_options="-x \\{} -I {}".format(CSV_SEPARATOR,self.interval)
 
         if pid>=0 and rank>=0:
-            return "perf stat --pid={} -e {} -D 100 -o {} ".format(pid,','.join(counters),os.path.abspath(self.trace_files[rank]))
+            return "perf stat {} --pid={} -e {} -D 100 -o {} ".format(stat_options,pid,counters,os.path.abspath(self.trace_files[rank]))
         else:
-            return "perf stat -e {} -D 100 -o {} ".format(','.join(counters),os.path.abspath(self.trace_files[0]))
+            return "perf stat {} -e {} -D 100 -o {} ".format(stat_options,counters,os.path.abspath(self.trace_files[0]))
 
 
     
-    def analyze(self,ranks=None):
-        """ Sum hardware counters over evry output file and compute the mean. """
-        irank=0
+    def analyze_ranks(self,rank_files):
+        """ Read hardware counters of each (stats_file,rank) and compute derived metrics """
         metric_type="hwc"        
-        for stats_file in self.output_files:
-
-            if(ranks):
-                rank=ranks[irank]
-            else:
-                rank=irank
-            
-            with open(stats_file,'r') as sf:
-                for line in sf:
-                    splitted_line=line.rstrip().split()
-                    # Convert , to . to be sure floats are well formatted
-                    str_count=""
-                    for idx,substring in enumerate(splitted_line):
-                        try:
-                            float(substring.replace(',', '.'))
-                        except:
-                            metric_name=substring.strip()
-                            if metric_name=="task-clock":
-                                self.metrics_manager.add_metric(rank,metric_type,"CPUs-utilized",float(splitted_line[idx+3].replace(',', '.')))
-                            if metric_name=="cycles":
-                                self.metrics_manager.add_metric(rank,metric_type,"GHz",float(splitted_line[idx+2].replace(',', '.')))
-
-                            break
-                        else:
-                            str_count+=substring.replace(',', '.')
-                            
-                    if str_count:
-                        local_count=float(str_count)
-
-                        if "time elapsed" in line:
-                            metric_name="elapsed_time"
-
-                        self.metrics_manager.add_metric(rank,metric_type,metric_name,local_count)
-
-
-                    """
-                    # This version works with perf stat -x but does not provide Ghz and cpu-utilized
-                    splitted_line=line.rstrip().split("//")
-                    if len(splitted_line)==2:
-                        # Convert , to . to be sure floats are well formatted
-                        try :
-                            local_count=float(splitted_line[0].replace(',', '.'))
-                        except ValueError:
-                            print("Cannot convert hardware counter {} to float.".format(splitted_line[1]))
-                            print("Program may be too short (no value) or counter is not valid.")
-                            exit
-
-                        metric_name=splitted_line[1]
-                        self.metrics_manager.add_metric(rank,metric_type,metric_name,local_count)
-                    """
-            # Derivated metrics
-            ins=float(self.metrics_manager.get_metric_count(metric_type,'instructions',rank))
-            cycles=float(self.metrics_manager.get_metric_count(metric_type,'cycles',rank))
-            if ins>0 and cycles>0:
-                self.metrics_manager.add_metric(
-                    rank,metric_type,'ins-per-cycle',ins/cycles)
-
-            itlb_miss=float(self.metrics_manager.get_metric_count(metric_type,'dTLBmiss_cycles',rank))
-            dtlb_miss=float(self.metrics_manager.get_metric_count(metric_type,'iTLBmiss_cycles',rank))
-
-            if ins>0 and itlb_miss>0 and dtlb_miss>0:
-                self.metrics_manager.add_metric(
-                    rank,metric_type,'cycles spent due to TLBmiss (%)',
-                    (itlb_miss+dtlb_miss)/cycles)
-                
-            irank+=1
-        self.metrics_manager.remove_metric(metric_type,'instructions')
-        self.metrics_manager.remove_metric(metric_type,'dTLBmiss_cycles')
-        self.metrics_manager.remove_metric(metric_type,'iTLBmiss_cycles')
+        for stats_file,rank in rank_files:
 
+            time_series=parse_perf_stat_csv(stats_file)
+            self.metrics_manager.set_time_series(rank,time_series)
 
-        
-            
+            for counter in time_series.get_counters():
+                total=time_series.get_total(counter)
+                if total is not None:
+                    self.metrics_manager.add_metric(rank,metric_type,counter,total)
+
+            # Interval timestamps are relative to the start of counting
+            if time_series.timestamps and time_series.timestamps[-1]>0:
+                self.metrics_manager.add_metric(rank,metric_type,'elapsed_time',time_series.timestamps[-1])
+
+            # Multiplexed counters are scaled by perf, keep how long they were really counted
+            for counter in time_series.get_counters():
+                min_running=time_series.get_min_running(counter)
+                if min_running is not None and min_running<100:
+                    self.metrics_manager.add_metric(rank,'hwc_running',counter,min_running)
+
+    def finalize(self,ranks):
+        """ Compute derived metrics over all ranks once raw counts are known """
+        metric_type="hwc"        
+        self.derived_metrics.evaluate(self.metrics_manager,metric_type,ranks,[metric_type,'hwc_raw'])
+
+        # Raw counters stay available for later formulas
+        for counter in RAW_COUNTERS+self.counter_set.raw_events:
+            self.metrics_manager.move_metric(metric_type,counter,'hwc_raw')
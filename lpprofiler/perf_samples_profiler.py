@@ -18,11 +18,45 @@
 #                                                                            #
 ############################################################################## 
 
-from subprocess import Popen,PIPE
+from subprocess import Popen,PIPE,DEVNULL
 import lpprofiler.profiler as prof
 import lpprofiler.metrics_manager as metpm
+import lpprofiler.disassembler as disasm
+import lpprofiler.disassembly_cache as discache
+import lpprofiler.perf_data_reader as perf_data
+import lpprofiler.source_lines as srcl
+import lpprofiler.isa_classifier as isacl
+import lpprofiler.cpu_events as cpuev
+import lpprofiler.sampling_budget as budget
+import lpprofiler.live_analyzer as live
 import sys, re, os, io
 import operator
+import multiprocessing
+import multiprocessing.util
+
+PERF_SCRIPT_LINE_RE=re.compile(r"\s+(\w+)\s(.*)\s\((.*)\)\s+")
+
+
+# Profiler of an analysis worker process, shared by all the ranks the worker analyzes
+_worker_profiler=None
+
+def _init_worker(profiling_args):
+    """ Analysis worker initialization: disassembly tables, cache handle and microarchitecture
+    of the worker profiler are reused for all its ranks """
+    global _worker_profiler
+    _worker_profiler=PerfSamplesProfiler(metpm.MetricsManager(),[],[],profiling_args)
+    # Helper processes are stopped when the pool is closed and the worker exits
+    multiprocessing.util.Finalize(_worker_profiler,_worker_profiler.close,exitpriority=10)
+
+def _analyze_rank_partial(worker_args):
+    """ Analysis worker: analyze samples of one rank into a new metrics manager """
+    output_file,rank=worker_args
+
+    partial_metrics=metpm.MetricsManager()
+    _worker_profiler.metrics_manager=partial_metrics
+    _worker_profiler._analyze_rank(output_file,rank)
+
+    return partial_metrics
 
         
 class PerfSamplesProfiler(prof.Profiler) :
@@ -37,138 +71,488 @@ class PerfSamplesProfiler(prof.Profiler) :
         else:
             self.frequency="99"
 
+        # Frequency and call graph mode derived from a data or overhead budget of the job
+        self.sampling_plan=None
+        if self.profiling_args.get("sample_budget") or self.profiling_args.get("sample_overhead"):
+            # Analysis workers only get the output file of their rank, not the whole job
+            self.sampling_plan=budget.plan_sampling(self.profiling_args.get("nb_ranks",len(self.output_files)),
+                                                    self.profiling_args.get("duration",budget.DEFAULT_DURATION),
+                                                    self.profiling_args.get("sample_budget"),
+                                                    self.profiling_args.get("sample_overhead"))
+            self.frequency=str(self.sampling_plan.frequency)
+
         # This dictionnary fasten assembly instruction decoding from address by
         # keeping assembly instructions for adress that have already been decoded.
         self.known_assembly_dic = {}
 
+        # Disassembly tables are kept between lpprof runs in a persistent cache
+        # shared by all lpprof processes of the user.
+        disassembly_cache=None
+        if not self.profiling_args.get("no_cache"):
+            disassembly_cache=discache.DisassemblyCache(
+                self.profiling_args.get("cache_dir"),
+                self.profiling_args.get("cache_size",discache.DEFAULT_CACHE_SIZE))
+
+        # Each binary is disassembled once, samples are then resolved from in-memory tables
+        self.disassembler = disasm.Disassembler(disassembly_cache)
+
         # Store starting addresses of binaries mapped into the virtual addres space of the main process
         self.binary_mapping = {}
 
+        # Symbols resolved from binaries when samples are decoded without perf script
+        self.known_symbol_dic = {}
+
+        # Binaries found on the analysis host and whether they need to be vma adjusted,
+        # None for binaries that are not found (samples from kallsyms, deleted binaries).
+        self.known_binaries = {}
+
+        # Source lines of sampled addresses are resolved once a rank is decoded, from the
+        # samples of each (binary,address,instruction) of the rank.
+        self.source_line_resolver = None
+        if self.profiling_args.get("source_lines"):
+            self.source_line_resolver = srcl.SourceLineResolver(disassembly_cache)
+        self.address_counts = {}
+
+        # Samples of each instruction form (isa,mnemonic,register class) of the rank being
+        # analyzed, forms are classified once to compute vectorization metrics.
+        uarch=cpuev.get_microarchitecture(cpuev.read_cpuinfo(
+            self.profiling_args.get("cpuinfo",cpuev.DEFAULT_CPUINFO)))
+        self.isa_classifier = isacl.IsaClassifier(
+            cpuev.SVE_VECTOR_BITS.get(uarch,isacl.DEFAULT_SVE_VECTOR_BITS))
+        self.form_counts = {}
+        # Number of samples of the rank being analyzed and times of its first and last one
+        self.sampled = [0,0,0]
+
+        # Mappings and instruction counts of each rank analyzed chunk by chunk (live mode)
+        self.chunk_states = {}
+
+    def close(self):
+        """ Stop helper processes """
+        if self.source_line_resolver:
+            self.source_line_resolver.close()
+
         
+    def _records_callchains(self):
+        """ True if lpprof records call chains (perf record -g) """
+        return not self.sampling_plan or self.sampling_plan.callgraph
+
+    def _has_callchains(self,output_file):
+        """ True if samples of output_file have call chains (PERF_SAMPLE_CALLCHAIN in their
+        event attributes). Files whose header cannot be read were recorded by lpprof with
+        its own record options. """
+        try:
+            with perf_data.PerfDataReader(output_file) as reader:
+                attrs=reader.attrs
+        except (perf_data.PerfDataError,OSError):
+            attrs=None
+        if not attrs:
+            return self._records_callchains()
+        return any(attr.sample_type&perf_data.PERF_SAMPLE_CALLCHAIN for attr in attrs)
+
     def get_profile_cmd(self,pid=-1,rank=-1):
         """ Assembly instructions profiling command """
+        record_options="-g" if self._records_callchains() else ""
+        if self.profiling_args.get("live"):
+            # perf.data is rotated into timestamped chunks analyzed while the job runs
+            record_options+=" --switch-output={}s".format(self.profiling_args["live"])
+        elif self.sampling_plan and self.sampling_plan.rank_budget:
+            # Ranks overshooting their budget only keep their most recent samples
+            record_options+=" --switch-output={}B --switch-max-files={}".format(
+                max(self.sampling_plan.rank_budget//budget.NB_ROTATED_FILES,1),budget.NB_ROTATED_FILES)
+        record_options=record_options.strip()
+        if "stage_dir" in self.profiling_args:
+            # Staged traces are archived in the traces directory, zstd keeps them small
+            record_options+=" -z"
         if pid>=0 and rank>=0:
-            return "perf record -g --pid={} -F {} -o {} ".format(pid,self.frequency,os.path.abspath(self.trace_files[rank]))
+            return "perf record {} --pid={} -F {} -o {} ".format(record_options,pid,self.frequency,os.path.abspath(self.trace_files[rank]))
         else:
-            return "perf record -g -F {} -o {} ".format(self.frequency,os.path.abspath(self.trace_files[0]))
+            return "perf record {} -F {} -o {} ".format(record_options,self.frequency,os.path.abspath(self.trace_files[0]))
 
     def analyze(self,ranks=None):
         """ Count assembly instructions and symbols """
         self._analyze_perf_samples(ranks)
-                
-        if "flame_graph" in self.profiling_args:
-            print("Build flame Graph")
-            self._build_flame_graph()
-
-    def _read_mmap_table(self,output_file):
-        """ Fill a dictionary with binary mappings read from perf samples """
-
-        perf_cmd="perf script -i {} --show-mmap-events | grep -i 'PERF\_RECORD\_MMAP'".format(output_file)
 
-        perf_process=Popen(perf_cmd,shell=True, stdout=PIPE,stderr=PIPE)            
-        stdout,stderr=perf_process.communicate()
-        raw_mmap=io.StringIO(stdout.decode('utf-8'))
+    def _read_mmap_line(self,mapline):
+        """ Update binary mappings with a PERF_RECORD_MMAP(2) event line of perf script """
 
-        # Reset binary mapping
-        self.binary_mapping={}
-
-        for mapline in raw_mmap:
-            if 'PERF_RECORD_MMAP' in mapline:
-                binary=mapline.split(' ')[-1].rstrip()
-                m = re.match(r"^.*\[(\w+)\(",mapline)
-                start_address=m.group(1)
-                self.binary_mapping[binary]=start_address                    
+        binary=mapline.split(' ')[-1].rstrip()
+        m = re.search(r"\[(\w+)\((\w+)\) @ (\w+)",mapline)
+        if not m:
+            return
+        # Binary load address is the mapping start minus the file offset of the mapping
+        start_address=int(m.group(1),16)-int(m.group(3),0)
+        self.binary_mapping[binary]=hex(start_address)
 
-    def _get_perf_script_output(self,output_file,perf_options="-G -f ip,sym,dso"):
-        """ Call perf script and analyze profiling output files"""
-        perf_output=''
+    def _iter_perf_script_output(self,output_file,perf_options="-f ip,sym,dso"):
+        """ Call perf script on a profiling output file and yield its output line by line """
         
         perf_cmd="perf script -i {} {}".format(output_file,perf_options)
 
-        perf_process=Popen(perf_cmd,shell=True, stdout=PIPE,stderr=PIPE)
-        stdout,stderr=perf_process.communicate()
-        perf_output+=stdout.decode('utf-8')
-
-        return perf_output
+        return self._iter_cmd_output(perf_cmd)
 
-    def _analyze_perf_script_output_line(self,line,rank):
+    def _iter_cmd_output(self,cmd):
+        """ Yield output lines of a shell command as they are produced, the whole output
+        is never held in memory. """
 
-        m=re.match(r"\s+(\w+)\s(.*)\s\((.*)\)\s+",line)
-        # Perf script output may contain empty lines
-        if not m :
-            return
-        
-        eip=m.group(1)
-        sym=m.group(2)+' @ '+m.group(3).split('/')[-1]
-        binary_path=m.group(3)
-        asm_name='unknown'
+        cmd_process=Popen(cmd,shell=True,stdout=PIPE,stderr=DEVNULL)
+        try:
+            for line in io.TextIOWrapper(cmd_process.stdout,encoding='utf-8',errors='replace'):
+                yield line
+        finally:
+            # Consumer may stop early, do not leave a blocked writer behind
+            if cmd_process.poll() is None:
+                cmd_process.kill()
+            cmd_process.wait()
+
+    def _analyze_perf_script_callchain(self,frame_lines,rank):
+        """ Count a sample given as perf script (eip,sym,dso) frames, sampled frame first """
+
+        eip,sym,binary_path=frame_lines[0]
+        self.sampled[0]+=1
+        frames=[self._count_sample(rank,eip,binary_path,sym)]
+        frames.extend(self._get_frame(binary_path,caller_eip,caller_sym)
+                      for caller_eip,caller_sym,binary_path in frame_lines[1:])
+        self._count_callchain(rank,frames)
+
+    def _get_start_address(self,binary_path,load_address=None):
+        """ Load address used to resolve addresses of binary_path, None if the binary is not found.
+        load_address is the base of the mapping holding the address when it is known, the
+        same binary may be mapped at another base by each process of the rank. """
 
         # Address from kallsyms won't be analyzed
-        if os.path.exists(binary_path):
-            if (binary_path+eip) in self.known_assembly_dic:
-                asm_name=self.known_assembly_dic[binary_path+eip] 
+        if binary_path not in self.known_binaries:
+            # Shared libraries and PIE executables need to be vma adjusted, other executables
+            # are mapped at their link address.
+            if os.path.exists(binary_path):
+                self.known_binaries[binary_path]=('.ko' in binary_path or
+                                                  disasm.is_position_independent(binary_path))
+            else:
+                self.known_binaries[binary_path]=None
+
+        if self.known_binaries[binary_path] is None:
+            return None
+        if load_address is not None and self.known_binaries[binary_path]:
+            return hex(load_address)
+        if (binary_path in self.binary_mapping) and self.known_binaries[binary_path]:
+            return self.binary_mapping[binary_path]
+        return '0x0'
+
+    def _get_frame(self,binary_path,eip,sym=None,load_address=None):
+        """ Call tree frame (symbol @ binary) of an address, symbol is resolved from binary when not given """
+        if sym is None:
+            start_address=self._get_start_address(binary_path,load_address)
+            if start_address is not None:
+                sym=self.get_sym(binary_path,eip,start_address)
+        if sym is None:
+            sym='[unknown]'
+        return sym+' @ '+binary_path.split('/')[-1]
+
+    def _count_callchain(self,rank,frames):
+        """ Add a sampled call chain, given from the sampled frame to the outermost caller,
+        to the call tree of rank """
+        frames.reverse()
+        self.metrics_manager.get_call_tree(rank).add_path(frames)
+
+    def _count_sample(self,rank,eip,binary_path,sym=None,load_address=None):
+        """ Count assembly instruction and symbol of a sample given its instruction pointer
+        and binary path. Symbol is resolved from binary when not given.
+        Return the symbol counted (symbol @ binary). """
+
+        asm_form=disasm.UNKNOWN_FORM
+
+        start_address=self._get_start_address(binary_path,load_address)
+        if start_address is not None:
+            # The same address may hold another instruction if the binary has been remapped
+            if (binary_path+eip+start_address) in self.known_assembly_dic:
+                asm_form=self.known_assembly_dic[binary_path+eip+start_address] 
+            else:
+                asm_form=self.get_asm_form(binary_path,eip,start_address)
+
+            if sym is None:
+                sym=self.get_sym(binary_path,eip,start_address)
+
+        asm_name=asm_form[1]
+        self.form_counts[asm_form]=self.form_counts.get(asm_form,0)+1
+
+        if self.source_line_resolver:
+            if start_address is None:
+                address_key=(None,0,asm_name)
             else:
-                start_address='0x0'
-                if (binary_path in self.binary_mapping) and\
-                   ('.so' in binary_path or '.ko' in binary_path): 
-                    # check for .so or .ko cause main binary do not need to be vma adjusted
-                    start_address=self.binary_mapping[binary_path]
-                            
-                asm_name=self.get_asm_ins(binary_path,eip,start_address)
-                self.known_assembly_dic[binary_path+eip]=asm_name
+                address_key=(binary_path,int(eip,16)-int(start_address,16),asm_name)
+            self.address_counts[address_key]=self.address_counts.get(address_key,0)+1
+
+        if sym is None:
+            sym='[unknown]'
+        sym=sym+' @ '+binary_path.split('/')[-1]
             
         # Count instruction
         self.metrics_manager.add_metric(rank,'asm',asm_name,1)
         
         # Count symbols
         self.metrics_manager.add_metric(rank,'sym',sym,1)
-        
-        
-    
-    def _analyze_perf_samples(self,ranks=None):
-        """ Count each assembly instruction occurence found in perf samples and store them
-        in a dictionnary."""
 
-        # Each output_file is considered as a different rank
-        irank=0
-        for output_file in self.output_files:
+        return sym
+
+    def _get_binary_path(self,pid,address,address_maps,kernel=False):
+        """ Binary mapped at address in the address space of pid and its load address
+        (mapping start minus file offset), None when there is no mapping """
+        if kernel:
+            return '[kernel.kallsyms]',None
+        mapping=address_maps.find(pid,address)
+        if mapping is None:
+            return '[unknown]',None
+        start,end,pgoff,filename=mapping
+        return filename,start-pgoff
+
+    def _analyze_native_sample(self,sample,address_maps,rank):
+        """ Count a sample decoded from perf.data """
+
+        kernel=sample.cpumode==perf_data.PERF_RECORD_MISC_KERNEL
+        binary_path,load_address=self._get_binary_path(sample.pid,sample.ip,address_maps,kernel)
+        frames=[self._count_sample(rank,'{:x}'.format(sample.ip),binary_path,load_address=load_address)]
+
+        # Call chain starts with the sampled address, context markers tell whether
+        # the next addresses are kernel or user space ones.
+        first_address=True
+        for address in sample.callchain:
+            if address>=perf_data.PERF_CONTEXT_MAX:
+                kernel=address==perf_data.PERF_CONTEXT_KERNEL
+                continue
+            if first_address:
+                first_address=False
+                if address==sample.ip:
+                    continue
+            # Callers addresses are return addresses, the call instruction is just before
+            binary_path,load_address=self._get_binary_path(sample.pid,address,address_maps,kernel)
+            frames.append(self._get_frame(binary_path,'{:x}'.format(address-1),load_address=load_address))
+
+        self._count_callchain(rank,frames)
+
+    def _count_sample_time(self,time):
+        if not self.sampled[0]:
+            self.sampled[1]=time
+        self.sampled[0]+=1
+        self.sampled[2]=time
+
+    def _analyze_rank_native(self,output_file,rank,address_maps=None):
+        """ Count assembly instructions and symbols reading perf.data directly, without perf script """
+
+        if address_maps is None:
+            address_maps=perf_data.AddressMaps()
+
+        with perf_data.PerfDataReader(output_file) as reader:
+            for event in reader.iter_events():
+                event_type=type(event)
+                if event_type is perf_data.SampleEvent:
+                    self._count_sample_time(event.time)
+                    self._analyze_native_sample(event,address_maps,rank)
+                elif event_type is perf_data.MmapEvent:
+                    # Mappings are updated as they arrive, samples are resolved against live mappings
+                    address_maps.add(event)
+                    self.binary_mapping[event.filename]=hex(event.start-event.pgoff)
+                elif event_type is perf_data.ForkEvent:
+                    address_maps.fork(event)
+
+    def _analyze_rank_perf_script(self,output_file,rank):
+        """ Count assembly instructions and symbols parsing perf script output """
+
+        """ Get binary mappings, instruction pointer and dynamic shared object location from samples """
+        # A single perf script pass interleaves mmap events and samples: mappings are updated
+        # as they arrive and each sample is resolved against the mappings live at that moment.
+        perf_lines=self._iter_perf_script_output(output_file,"--show-mmap-events -f ip,sym,dso")
+
+        # Frames of a sample call chain are printed one per line, sampled frame first,
+        # and call chains are separated by empty lines. Traces recorded without call
+        # chains have one line per sample and no empty lines.
+        has_callchains=self._has_callchains(output_file)
+        frame_lines=[]
+        # Parse each line as perf script produces it to sum symbols and assembly instructions occurences
+        for line in perf_lines:
+            if 'PERF_RECORD_MMAP' in line:
+                self._read_mmap_line(line)
+                continue
 
-            if ranks:
-                rank=ranks[irank]
+            m=PERF_SCRIPT_LINE_RE.match(line)
+            if m:
+                if has_callchains:
+                    frame_lines.append(m.groups())
+                else:
+                    self._analyze_perf_script_callchain([m.groups()],rank)
+            elif frame_lines and not line.strip():
+                self._analyze_perf_script_callchain(frame_lines,rank)
+                frame_lines=[]
+
+        if frame_lines:
+            self._analyze_perf_script_callchain(frame_lines,rank)
+
+    def _analyze_rank(self,output_file,rank):
+        """ Count assembly instructions and symbols found in the samples of one rank """
+
+        trace_files=live.get_chunks(output_file)
+        if trace_files and not os.path.exists(output_file):
+            # perf.data was rotated by perf record --switch-output, chunks are analyzed in order
+            for chunk_file in trace_files:
+                self.analyze_chunk(chunk_file,rank)
+            self.finish_chunks(rank)
+        else:
+            self._analyze_rank_file(output_file,rank)
+            trace_files=[output_file]
+
+        if self.sampling_plan:
+            self._count_sampling(rank,trace_files)
+
+    def _count_sampling(self,rank,trace_files):
+        """ Size and number of samples of rank traces, used to check the sampling budget.
+        Traces rotated by perf record only hold the most recent samples, the time covered
+        by these samples (in seconds, from perf.data timestamps) gives their real rate. """
+        self.metrics_manager.add_metric(rank,'sampling','trace_bytes',
+                                        sum(os.path.getsize(trace_file) for trace_file in trace_files))
+        self.metrics_manager.add_metric(rank,'sampling','trace_files',len(trace_files))
+        nb_samples,first_time,last_time=self.sampled
+        self.metrics_manager.add_metric(rank,'sampling','samples',nb_samples)
+        if nb_samples>1 and last_time>first_time:
+            self.metrics_manager.add_metric(rank,'sampling','sampled_time',(last_time-first_time)/1e9)
+
+    def _analyze_rank_file(self,output_file,rank):
+        """ Count assembly instructions and symbols found in the perf.data file of one rank """
+
+        # Reset binary mapping
+        self.binary_mapping={}
+        self.address_counts={}
+        self.form_counts={}
+        self.sampled=[0,0,0]
+
+        decoder=self.profiling_args.get("decoder","auto")
+        if decoder=="perf":
+            self._analyze_rank_perf_script(output_file,rank)
+        else:
+            # Counts are only kept once the whole file has been decoded so that
+            # perf script can take over when the native reader fails.
+            rank_metrics=metpm.MetricsManager()
+            metrics_manager=self.metrics_manager
+            self.metrics_manager=rank_metrics
+            try:
+                self._analyze_rank_native(output_file,rank)
+            except (perf_data.PerfDataError,OSError) as e:
+                if decoder=="native":
+                    raise
+                print("Cannot decode {} ({}), using perf script".format(output_file,e))
+                rank_metrics=None
+            finally:
+                self.metrics_manager=metrics_manager
+
+            if rank_metrics is None:
+                self.binary_mapping={}
+                self.address_counts={}
+                self.form_counts={}
+                self.sampled=[0,0,0]
+                self._analyze_rank_perf_script(output_file,rank)
             else:
-                rank=irank
+                self.metrics_manager.merge(rank_metrics)
+
+        # Extract vectorization information
+        self._analyze_vectorization(rank)
+
+        if self.source_line_resolver:
+            self._analyze_source_lines(rank)
+
+    def _analyze_source_lines(self,rank):
+        """ Count samples of each source line and instruction, the addresses of each binary
+        are resolved in one batch """
+
+        binaries_addresses={}
+        for binary_path,address,asm_name in self.address_counts:
+            if binary_path is not None:
+                binaries_addresses.setdefault(binary_path,[]).append(address)
+        binaries_lines={binary_path:self.source_line_resolver.resolve(binary_path,addresses)
+                        for binary_path,addresses in binaries_addresses.items()}
+
+        source_lines=self.metrics_manager.get_source_lines(rank)
+        for (binary_path,address,asm_name),count in self.address_counts.items():
+            line=None
+            if binary_path is not None:
+                line=binaries_lines[binary_path][address]
+            # Samples without source line are kept to compute the share of each line
+            if line is None:
+                line=srcl.UNKNOWN_LINE
+            mix=source_lines.setdefault(line,{})
+            mix[asm_name]=mix.get(asm_name,0)+count
+
+        self.address_counts={}
+
+    def analyze_chunk(self,chunk_file,rank):
+        """ Count samples of a perf record --switch-output chunk of rank. Binaries mapped before
+        a chunk starts are only found in previous chunks, mappings are kept between chunks of a rank. """
+
+        if rank not in self.chunk_states:
+            self.chunk_states[rank]=(perf_data.AddressMaps(),{},{},{},[0,0,0])
+        address_maps,self.binary_mapping,self.form_counts,self.address_counts,self.sampled=self.chunk_states[rank]
 
-            asm_name="unknown"
-  
-            """ Read binary mappings from samples """
-            self._read_mmap_table(output_file)
+        try:
+            self._analyze_rank_native(chunk_file,rank,address_maps)
+        except (perf_data.PerfDataError,OSError) as e:
+            # perf script cannot be used instead, it would miss mappings of previous chunks
+            print("Cannot decode {} ({}), skipping it".format(chunk_file,e))
+
+    def finish_chunks(self,rank):
+        """ Compute metrics of rank once all its chunks are analyzed """
+        if rank not in self.chunk_states:
+            return
+        address_maps,self.binary_mapping,self.form_counts,self.address_counts,self.sampled=self.chunk_states.pop(rank)
 
-            """ Get instruction pointer and dynamic shared object location from samples """        
-            perf_script_output = io.StringIO(self._get_perf_script_output(output_file,"-G -f ip,sym,dso"))
-            # Parse each line to sum symbols and assembly instructions occurences
-            for line in perf_script_output:
-                self._analyze_perf_script_output_line(line,rank)
+        self._analyze_vectorization(rank)
 
-            # Extract vectorization information
-            self._analyze_vectorization(rank)
+        if self.source_line_resolver:
+            self._analyze_source_lines(rank)
 
-            
-            irank+=1
+    def _analyze_perf_samples(self,ranks=None):
+        """ Count each assembly instruction occurence found in perf samples and store them
+        in a dictionnary."""
+        rank_files=self.get_rank_files(ranks)
+        self.analyze_ranks(rank_files)
+        self.finalize([rank for output_file,rank in rank_files])
+
+    def analyze_ranks(self,rank_files):
+        """ Count assembly instructions and symbols of each (output_file,rank) """
+
+        jobs=int(self.profiling_args.get("jobs",1))
+        if jobs>1 and len(rank_files)>1:
+            # Each worker analyzes one rank at a time into its own metrics manager, partial
+            # results are merged in rank order to get the same report as serial analysis.
+            worker_profiling_args=dict(self.profiling_args,
+                                       nb_ranks=self.profiling_args.get("nb_ranks",len(self.output_files)))
+            pool=multiprocessing.Pool(min(jobs,len(rank_files)),
+                                      initializer=_init_worker,initargs=(worker_profiling_args,))
+            try:
+                for partial_metrics in pool.imap(_analyze_rank_partial,rank_files):
+                    self.metrics_manager.merge(partial_metrics)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            try:
+                for output_file,rank in rank_files:
+                    self._analyze_rank(output_file,rank)
+            finally:
+                self.close()
+
+    def finalize(self,ranks):
+        """ Change counts to ratios once counts of all ranks are known """
+
+        for rank in ranks:
+            if self.sampling_plan:
+                # Rate over the time covered by the kept samples, the whole run when it is not known
+                sampled_time=(self.metrics_manager.get_metric_count('sampling','sampled_time',rank) or
+                              self.metrics_manager.get_metric_count('hwc','elapsed_time',rank))
+                if sampled_time:
+                    self.metrics_manager.add_metric(rank,'sampling','sample_rate',
+                        self.metrics_manager.get_metric_count('sampling','samples',rank)/sampled_time)
 
-        irank=0
-        for output_file in self.output_files:
-            
-            if ranks:
-                rank=ranks[irank]
-            else:
-                rank=irank
-            
             # Change count to ratios
             self.metrics_manager.metric_counts_to_ratios('asm',rank)
             cpu_utilization=self.metrics_manager.get_metric_count('hwc','CPUs-utilized',rank)
             self.metrics_manager.metric_counts_to_ratios('sym',rank,adjust=cpu_utilization)
             self.metrics_manager.add_metric(rank,'sym','CPUs-idle',(1-cpu_utilization)*100)
-            irank+=1
             
         # Remove all assembly instructions and symbols with low occurence
         self.metrics_manager.del_metric_low_ratios('sym',1)
@@ -176,106 +560,82 @@ class PerfSamplesProfiler(prof.Profiler) :
             
 
 
-    def _build_flame_graph(self):
-        """ Build Flame Graph from perf samples """
-
-        for output_file in self.output_files:
-            flame_cmd="perf script -i {} | stackcollapse-perf.pl | flamegraph.pl > {}/flames.svg".format(output_file,os.path.dirname(output_file))
-
-            flame_process=Popen(flame_cmd,shell=True, stdout=PIPE,stderr=PIPE)            
-            stdout,stderr=flame_process.communicate()
-
-            #if stderr:
-            #    print("Error generating FlameGraph : {} ".format(stderr.decode('utf-8')))
-   
-        
     def get_asm_ins(self,binary_path,eip_address,start_address="0x0"):
         """ Get assembler instruction from instruction pointer and binary path """
-        
-        # Objdump to disassemble the binary matching eip
+        return self.get_asm_form(binary_path,eip_address,start_address)[1]
 
+    def get_asm_form(self,binary_path,eip_address,start_address="0x0"):
+        """ Get (isa,mnemonic,register class) of an instruction from instruction pointer and binary path """
+        
         adjusted_eip_address=int(eip_address,16)-int(start_address,16)
 
-        objdump_cmd='objdump -d --prefix-addresses --start-address={} \
-        --stop-address={} {}'.format(
-            hex(adjusted_eip_address),hex(adjusted_eip_address+1),binary_path)
-        
-        objdump_process=Popen(objdump_cmd,shell=True, stdout=PIPE,stderr=PIPE)
-        stdout,stderr=objdump_process.communicate()
-        objdump_output=stdout.decode('utf-8')
+        # Binary is disassembled on first call only, next calls are simple table lookups
+        assembly_form=self.disassembler.get_asm_form(binary_path,adjusted_eip_address)
 
-        # Get objdump line containing the eip address
-        regexp=r''+hex(adjusted_eip_address)[2:]+'.*'
-        try:
-            first_line_matching_address=re.findall(regexp,objdump_output)[0]
-        except:
-            return 'unknown'
+        self.known_assembly_dic[binary_path+eip_address+start_address]=assembly_form
+    
+        return assembly_form
 
-        # Extract assembly instruction and add result to a dictionnary to avoid recomputing it later
-        assembly_instruction=first_line_matching_address.split()[2].rstrip()
 
-        self.known_assembly_dic[binary_path+eip_address]=assembly_instruction
-    
-        return assembly_instruction
 
+    def get_sym(self,binary_path,eip_address,start_address="0x0"):
+        """ Get symbol name from instruction pointer and binary path """
 
+        adjusted_eip_address=int(eip_address,16)-int(start_address,16)
 
-    def _analyze_vectorization(self,rank):
+        if (binary_path+eip_address+start_address) in self.known_symbol_dic:
+            return self.known_symbol_dic[binary_path+eip_address+start_address]
 
-        """ Extract vectorization informations from asm symbols """
-        
-        # Compute vectorization related metrics
-        total_sampled_ins=0
-        flop_ins=0
-        flop_scalar_ins=0
-        sse_pd_ins=0
-        avx_ins=0
-        avx2_ins=0
+        sym=self.disassembler.get_table(binary_path).lookup_sym(adjusted_eip_address)
 
-        
-#       for asm_name in self.assembly_instructions_counts:
-        for asm_name in self.metrics_manager.get_metric_names('asm'):
-            current_count=self.metrics_manager.get_metric_count('asm',asm_name,rank)
-            if not current_count:
-                continue
+        self.known_symbol_dic[binary_path+eip_address+start_address]=sym
 
-            total_sampled_ins+=current_count
-                    
-            # Handle x86_asm assembly
-            # TODO handle non x86 assembly
-
-            flop_ops=('add','mul','sub','div','sqrt')
-            if any (op in asm_name for op in flop_ops):
-                if asm_name.endswith("pd"):
-                    flop_ins+=current_count
-                    sse_pd_ins+=current_count
-                elif asm_name.endswith("sd"):
-                    flop_scalar_ins+=current_count
-                    flop_ins+=current_count
-                else:
-                    continue
+        return sym
+
+    def _analyze_vectorization(self,rank):
+
+        """ Extract vectorization informations from the instructions sampled in the rank """
+
+        total_sampled_ins=0
+        fp_ins=0
+        simd_int_ins=0
+        fma_ins=0
+        flops=0
+        vector_bits=0
+        fp_widths={}
+        fp_elements={}
+
+        for form,count in self.form_counts.items():
+            total_sampled_ins+=count
+            instruction_class=self.isa_classifier.classify(*form)
+            if instruction_class.category=='simd_int':
+                simd_int_ins+=count
+            elif instruction_class.category=='fp':
+                fp_ins+=count
+                flops+=instruction_class.flops*count
+                vector_bits+=instruction_class.vector_bits*count
+                if instruction_class.fma:
+                    fma_ins+=count
+                # Scalar instructions work on a single element
+                width='scalar'
+                if instruction_class.vector_bits>instruction_class.element_bits:
+                    width='vec{}'.format(instruction_class.vector_bits)
+                fp_widths[width]=fp_widths.get(width,0)+count
+                fp_elements[instruction_class.element]=fp_elements.get(instruction_class.element,0)+count
+
+        if not total_sampled_ins:
+            return
 
-                if (asm_name.startswith("vfmadd") or
-                    asm_name.startswith("vfnmadd")):
-                    avx2_ins+=current_count
-                    if asm_name.endswith("pd"):
-                        sse_pd_ins-=current_count
-                    if asm_name.endswith("sd"):
-                        flop_scalar_ins-=current_count
-                elif asm_name.startswith("v"):
-                    avx_ins+=current_count
-                    if asm_name.endswith("pd"):
-                        sse_pd_ins-=current_count
-                    if asm_name.endswith("sd"):
-                        flop_scalar_ins-=current_count
-
-        if(flop_ins):
-            metric_type='vectorization'
-            self.metrics_manager.add_metric(rank,metric_type,"flop_scalar_prop",
-                                            (flop_scalar_ins/flop_ins)*100)
-            self.metrics_manager.add_metric(rank,metric_type,"sse_pd_prop",
-                                            (sse_pd_ins/flop_ins)*100)
-            self.metrics_manager.add_metric(rank,metric_type,"avx_prop",
-                                            (avx_ins/flop_ins)*100)
-            self.metrics_manager.add_metric(rank,metric_type,"avx2_prop",
-                                            (avx2_ins/flop_ins)*100)
+        metric_type='vectorization'
+        self.metrics_manager.add_metric(rank,metric_type,"fp_ins_prop",fp_ins/total_sampled_ins*100)
+        self.metrics_manager.add_metric(rank,metric_type,"simd_int_ins_prop",simd_int_ins/total_sampled_ins*100)
+        self.metrics_manager.add_metric(rank,metric_type,"flop_per_ins",flops/total_sampled_ins)
+
+        if fp_ins:
+            # Proportions of floating point instructions
+            for width,count in fp_widths.items():
+                self.metrics_manager.add_metric(rank,metric_type,"fp_{}_prop".format(width),count/fp_ins*100)
+            for element,count in fp_elements.items():
+                self.metrics_manager.add_metric(rank,metric_type,"fp_{}_prop".format(element),count/fp_ins*100)
+            self.metrics_manager.add_metric(rank,metric_type,"fma_prop",fma_ins/fp_ins*100)
+            self.metrics_manager.add_metric(rank,metric_type,"effective_vector_bits",vector_bits/fp_ins)
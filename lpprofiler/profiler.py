@@ -45,6 +45,27 @@ class Profiler :
         """ Return profiling command """
         return ""
 
-    def analyze(self):
+    def get_rank_files(self,ranks=None):
+        """ Return (output_file,rank) of each output file, each output file is considered as a different rank """
+        rank_files=[]
+        for irank,output_file in enumerate(self.output_files):
+            if ranks:
+                rank_files.append((output_file,ranks[irank]))
+            else:
+                rank_files.append((output_file,irank))
+        return rank_files
+
+    def analyze(self,ranks=None):
         """ Standard analyze method """
+        rank_files=self.get_rank_files(ranks)
+        self.analyze_ranks(rank_files)
+        self.finalize([rank for output_file,rank in rank_files])
+
+    def analyze_ranks(self,rank_files):
+        """ Count metrics of each (output_file,rank), counts of different ranks are independent
+        so that ranks can be analyzed on different hosts and merged afterwards. """
+        pass
+
+    def finalize(self,ranks):
+        """ Compute metrics that need the counts of all ranks """
         pass
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#  This file is part of the LPprofiler profiling tool.                       #
+#        Copyright (C) 2017  EDF SA                                          #
+#                                                                            #
+#  LPprofiler is free software: you can redistribute it and/or modify        #
+#  it under the terms of the GNU General Public License as published by      #
+#  the Free Software Foundation, either version 3 of the License, or         #
+#  (at your option) any later version.                                       #
+#                                                                            #
+#  LPprofiler is distributed in the hope that it will be useful,             #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of            #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the             #
+#  GNU General Public License for more details.                              #
+#                                                                            #
+#  You should have received a copy of the GNU General Public License         #
+#  along with LPprofiler.  If not, see <http://www.gnu.org/licenses/>.       #
+#                                                                            #
+############################################################################## 
+
+from collections import OrderedDict
+import os, selectors, socket, time
+
+# Tasks may register before the server listens, they retry for this long
+CONNECT_TIMEOUT=60
+CONNECT_RETRY_INTERVAL=0.2
+
+MAX_REGISTRATION_SIZE=1024
+
+# Registration stops when no task registered for this long (ex: a task failed before registering)
+REGISTRATION_TIMEOUT=600
+
+
+def parse_address(address):
+    """ (family,address) of a rendezvous address: fd:<listening socket fd>, unix:<path> or <host>:<port> """
+    if address.startswith('fd:'):
+        return None,int(address[3:])
+    if address.startswith('unix:'):
+        return socket.AF_UNIX,address[5:]
+    host,sep,port=address.rpartition(':')
+    if not sep:
+        raise ValueError("invalid rendezvous address {}".format(address))
+    return socket.AF_INET,(host,int(port))
+
+
+def format_registration(rank,host,pid,local_tasks):
+    """ Line sent by a task to the rendezvous server """
+    return "{} {} {} {}\n".format(rank,host,pid,local_tasks)
+
+
+def parse_registration(line):
+    """ (rank,host,pid,local_tasks) of a registration line, None if it is invalid """
+    fields=line.split()
+    if len(fields)!=4:
+        return None
+    try:
+        return int(fields[0]),fields[1],int(fields[2]),int(fields[3])
+    except ValueError:
+        return None
+
+
+def register(address,rank,host,pid,local_tasks,timeout=CONNECT_TIMEOUT):
+    """ Register a task to the rendezvous server at address """
+    family,sockaddr=parse_address(address)
+    deadline=time.time()+timeout
+    while True:
+        sock=socket.socket(family,socket.SOCK_STREAM)
+        try:
+            sock.connect(sockaddr)
+            sock.sendall(format_registration(rank,host,pid,local_tasks).encode())
+            return
+        except (ConnectionRefusedError,FileNotFoundError):
+            if time.time()>deadline:
+                raise
+        finally:
+            sock.close()
+        time.sleep(CONNECT_RETRY_INTERVAL)
+
+
+class RendezvousServer :
+    """ Tasks of a job register their rank, host and pid with one connection each. Hosts are
+    yielded as soon as all their tasks registered so that they can be profiled without
+    waiting for the whole job. """
+
+    def __init__(self,address):
+        family,sockaddr=parse_address(address)
+        if family is None:
+            # Listening socket created by the launcher (spank plugin) before tasks start
+            self.sock=socket.socket(fileno=sockaddr)
+        else:
+            self.sock=socket.socket(family,socket.SOCK_STREAM)
+            if family==socket.AF_UNIX and os.path.exists(sockaddr):
+                os.remove(sockaddr)
+            if family==socket.AF_INET:
+                self.sock.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEADDR,1)
+            self.sock.bind(sockaddr)
+            self.sock.listen(socket.SOMAXCONN)
+        self.sock.setblocking(False)
+
+        # host -> (number of tasks of the host,{rank:pid})
+        self.hosts=OrderedDict()
+
+    @property
+    def address(self):
+        """ Address tasks register to """
+        sockname=self.sock.getsockname()
+        if self.sock.family==socket.AF_UNIX:
+            return 'unix:'+sockname
+        return '{}:{}'.format(*sockname[:2])
+
+    def get_nb_registered(self):
+        return sum(len(ranks_pids) for local_tasks,ranks_pids in self.hosts.values())
+
+    def _add(self,registration):
+        """ Record a registration, return the host if all its tasks are registered """
+        rank,host,pid,local_tasks=registration
+        host_tasks=self.hosts.setdefault(host,(local_tasks,{}))
+        if rank in host_tasks[1]:
+            return None
+        host_tasks[1][rank]=pid
+        if len(host_tasks[1])==host_tasks[0]:
+            return host
+        return None
+
+    def iter_hosts(self,nb_tasks,timeout=None):
+        """ Yield (host,{rank:pid}) of each host once all its tasks registered, until nb_tasks
+        tasks registered or no task registered for timeout seconds """
+        selector=selectors.DefaultSelector()
+        selector.register(self.sock,selectors.EVENT_READ)
+        buffers={}
+        try:
+            while self.get_nb_registered()<nb_tasks:
+                events=selector.select(timeout)
+                if not events:
+                    print("Rendezvous timeout: {} of {} tasks registered".format(self.get_nb_registered(),nb_tasks))
+                    # Registered tasks of incomplete hosts are still profiled
+                    for host,(local_tasks,ranks_pids) in self.hosts.items():
+                        if len(ranks_pids)<local_tasks:
+                            yield host,ranks_pids
+                    break
+                for key,mask in events:
+                    if key.fileobj is self.sock:
+                        try:
+                            conn,peer=self.sock.accept()
+                        except BlockingIOError:
+                            continue
+                        conn.setblocking(False)
+                        buffers[conn]=b''
+                        selector.register(conn,selectors.EVENT_READ)
+                        continue
+
+                    conn=key.fileobj
+                    try:
+                        data=conn.recv(MAX_REGISTRATION_SIZE)
+                    except BlockingIOError:
+                        continue
+                    except OSError:
+                        data=b''
+                    buffers[conn]+=data
+                    if data and b'\n' not in buffers[conn] and len(buffers[conn])<MAX_REGISTRATION_SIZE:
+                        continue
+
+                    selector.unregister(conn)
+                    conn.close()
+                    registration=parse_registration(buffers.pop(conn).decode(errors='replace'))
+                    if registration is None:
+                        continue
+                    host=self._add(registration)
+                    if host:
+                        yield host,self.hosts[host][1]
+        finally:
+            for conn in buffers:
+                conn.close()
+            selector.close()
+
+    def close(self):
+        if self.sock.family==socket.AF_UNIX:
+            try:
+                os.remove(self.sock.getsockname())
+            except OSError:
+                pass
+        self.sock.close()
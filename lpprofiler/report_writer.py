@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#  This file is part of the LPprofiler profiling tool.                       #
+#        Copyright (C) 2017  EDF SA                                          #
+#                                                                            #
+#  LPprofiler is free software: you can redistribute it and/or modify        #
+#  it under the terms of the GNU General Public License as published by      #
+#  the Free Software Foundation, either version 3 of the License, or         #
+#  (at your option) any later version.                                       #
+#                                                                            #
+#  LPprofiler is distributed in the hope that it will be useful,             #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of            #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the             #
+#  GNU General Public License for more details.                              #
+#                                                                            #
+#  You should have received a copy of the GNU General Public License         #
+#  along with LPprofiler.  If not, see <http://www.gnu.org/licenses/>.       #
+#                                                                            #
+############################################################################## 
+
+from array import array
+import os, sys, csv, json, struct
+
+REPORT_NAME='LPprof_perf_report'
+
+# Report is streamed through one buffered handle instead of one open() per cell
+REPORT_BUFFER_SIZE=1024*1024
+
+REPORT_FORMATS=['text','json','csv','columnar']
+# Columnar report is small and is what lpprof compare reads
+DEFAULT_REPORT_FORMATS=['text','columnar']
+REPORT_SUFFIXES={'text':'','json':'.json','csv':'.csv','columnar':'.lpcol'}
+
+# Columnar dump: magic, version and header length, a JSON header (ranks and metrics),
+# then the counts of each metric for each rank as little endian doubles, NaN without count
+COLUMNAR_MAGIC=b'LPCOL\0\0\0'
+COLUMNAR_VERSION=1
+COLUMNAR_HEADER=struct.Struct('<8sII')
+
+
+def get_report_path(traces_directory,report_format='text'):
+    return os.path.join(traces_directory,REPORT_NAME+REPORT_SUFFIXES[report_format])
+
+
+def get_metric_unit(metric_type,metric_name):
+    """ Unit shown after values of a metric """
+    if metric_type in ['asm','sym','hwc_running']:
+        return '%'
+    # Vectorization metrics are proportions except the vector width (bits) and flop per instruction
+    if metric_type=='vectorization' and metric_name.endswith('_prop'):
+        return '%'
+    return ''
+
+
+class TextReport :
+    """ Text report written through one buffered handle. It is appended to the
+    messages written in the report before the analysis. """
+
+    def __init__(self,report_path,buffer_size=REPORT_BUFFER_SIZE):
+        self.report_file=open(report_path,'a',buffering=buffer_size)
+
+    def write(self,msg):
+        if msg:
+            self.report_file.write(msg)
+
+    def close(self):
+        self.report_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        self.close()
+
+
+class _AtomicFile :
+    """ File written under a temporary name then renamed, dashboards polling the
+    output directory never read a partial export """
+
+    def __init__(self,path,mode='w',**kwargs):
+        self.path=path
+        self.tmp_path=path+'.tmp'
+        self.f=open(self.tmp_path,mode,buffering=REPORT_BUFFER_SIZE,**kwargs)
+
+    def __enter__(self):
+        return self.f
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        self.f.close()
+        if exc_type is None:
+            os.replace(self.tmp_path,self.path)
+        else:
+            os.remove(self.tmp_path)
+
+
+def iter_metrics(metrics_manager,metric_types):
+    """ Yield (metric_type,metric_name) in the order of the text report """
+    for metric_type in metric_types:
+        for metric_name in metrics_manager.get_metric_names_sorted(metric_type):
+            yield metric_type,metric_name
+
+
+def get_report_data(metrics_manager,metric_types,nb_call_paths=20):
+    """ Content of the report as JSON serializable objects: statistics over ranks and
+    count of each rank of every metric, and call paths with the most samples """
+    metrics=[]
+    for metric_type,metric_name in iter_metrics(metrics_manager,metric_types):
+        min_count,min_rank=metrics_manager.get_metric_min(metric_type,metric_name)
+        max_count,max_rank=metrics_manager.get_metric_max(metric_type,metric_name)
+        metrics.append({'type':metric_type,
+                        'name':metric_name,
+                        'unit':get_metric_unit(metric_type,metric_name),
+                        'min':min_count,'min_rank':min_rank,
+                        'max':max_count,'max_rank':max_rank,
+                        'avg':metrics_manager.get_metric_avg(metric_type,metric_name),
+                        'counts':{str(rank):count for rank,count
+                                  in sorted(metrics_manager.get_metric_counts(metric_type,metric_name).items())}})
+
+    call_tree=metrics_manager.get_merged_call_tree()
+    total_samples=call_tree.get_total()
+    call_paths=[]
+    if total_samples:
+        call_paths=[{'frames':frames,'inclusive':inclusive/total_samples*100,'exclusive':exclusive/total_samples*100}
+                    for frames,inclusive,exclusive in call_tree.get_top_paths(nb_call_paths)]
+
+    return {'ranks':sorted(metrics_manager.ranks),'metrics':metrics,'call_paths':call_paths}
+
+
+def write_json(metrics_manager,json_path,metric_types,nb_call_paths=20):
+    with _AtomicFile(json_path) as f:
+        json.dump(get_report_data(metrics_manager,metric_types,nb_call_paths),f)
+
+
+def write_csv(metrics_manager,csv_path,metric_types):
+    """ One row per metric and rank, the long format expected by most dashboards """
+    with _AtomicFile(csv_path,newline='') as f:
+        writer=csv.writer(f)
+        writer.writerow(['metric_type','metric_name','unit','rank','count'])
+        for metric_type,metric_name in iter_metrics(metrics_manager,metric_types):
+            unit=get_metric_unit(metric_type,metric_name)
+            for rank,count in sorted(metrics_manager.get_metric_counts(metric_type,metric_name).items()):
+                writer.writerow([metric_type,metric_name,unit,rank,repr(count)])
+
+
+def write_columnar(metrics_manager,columnar_path,metric_types):
+    """ Counts of all ranks of each metric as one contiguous array of doubles """
+    ranks=sorted(metrics_manager.ranks)
+    metrics=list(iter_metrics(metrics_manager,metric_types))
+    header=json.dumps({'ranks':ranks,'metrics':metrics}).encode('utf-8')
+    with _AtomicFile(columnar_path,'wb') as f:
+        f.write(COLUMNAR_HEADER.pack(COLUMNAR_MAGIC,COLUMNAR_VERSION,len(header)))
+        f.write(header)
+        for metric_type,metric_name in metrics:
+            counts=metrics_manager.get_metric_array(metric_type,metric_name,ranks)
+            if sys.byteorder!='little':
+                counts.byteswap()
+            counts.tofile(f)
+
+
+def read_columnar(columnar_path):
+    """ Return ranks and a dict (metric_type,metric_name) -> array of counts per rank
+    of a file written by write_columnar """
+    with open(columnar_path,'rb') as f:
+        magic,version,header_size=COLUMNAR_HEADER.unpack(f.read(COLUMNAR_HEADER.size))
+        if magic!=COLUMNAR_MAGIC or version!=COLUMNAR_VERSION:
+            raise ValueError("{} is not a columnar report of version {}".format(columnar_path,COLUMNAR_VERSION))
+        header=json.loads(f.read(header_size).decode('utf-8'))
+        ranks=header['ranks']
+        metrics={}
+        for metric_type,metric_name in header['metrics']:
+            counts=array('d')
+            counts.fromfile(f,len(ranks))
+            if sys.byteorder!='little':
+                counts.byteswap()
+            metrics[(metric_type,metric_name)]=counts
+    return ranks,metrics
+
+
+def write_reports(metrics_manager,traces_directory,report_formats,metric_types,nb_call_paths=20):
+    """ Write machine readable exports of the report, the text report is written by LpProfiler """
+    if 'json' in report_formats:
+        write_json(metrics_manager,get_report_path(traces_directory,'json'),metric_types,nb_call_paths)
+    if 'csv' in report_formats:
+        write_csv(metrics_manager,get_report_path(traces_directory,'csv'),metric_types)
+    if 'columnar' in report_formats:
+        write_columnar(metrics_manager,get_report_path(traces_directory,'columnar'),metric_types)
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#  This file is part of the LPprofiler profiling tool.                       #
+#        Copyright (C) 2017  EDF SA                                          #
+#                                                                            #
+#  LPprofiler is free software: you can redistribute it and/or modify        #
+#  it under the terms of the GNU General Public License as published by      #
+#  the Free Software Foundation, either version 3 of the License, or         #
+#  (at your option) any later version.                                       #
+#                                                                            #
+#  LPprofiler is distributed in the hope that it will be useful,             #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of            #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the             #
+#  GNU General Public License for more details.                              #
+#                                                                            #
+#  You should have received a copy of the GNU General Public License         #
+#  along with LPprofiler.  If not, see <http://www.gnu.org/licenses/>.       #
+#                                                                            #
+############################################################################## 
+
+from collections import namedtuple
+import lpprofiler.report_writer as repw
+import os, sys, json, math
+
+COMPARED_METRIC_TYPES=['hwc','vectorization','asm','sym']
+
+# A change is significant when it is this many times larger than its noise
+SIGNIFICANCE_THRESHOLD=3.0
+
+# Smallest noise assumed for a metric, relative to its value. Runs of a single rank or of
+# perfectly balanced ranks have no spread, changes below this are still not reported.
+MIN_RELATIVE_NOISE=0.01
+
+# Metrics counted in percent of samples, and smallest average of such a metric found in one run
+# only for it to be reported. Rare symbols come and go between runs as sampling catches them.
+SHARE_METRIC_TYPES=['asm','sym']
+MIN_APPEARED_SHARE=1.0
+
+# Maximum number of rows of each section of the comparison
+MAX_COMPARE_ROWS=30
+
+MetricDelta=namedtuple('MetricDelta',['metric_type','metric_name','base_avg','target_avg','delta','relative','score'])
+
+
+def load_run(run_directory):
+    """ Per-rank counts of each metric of a run: dict (metric_type,metric_name) -> list of
+    counts of the ranks having one. Read from the columnar report or from the JSON report. """
+    columnar_path=repw.get_report_path(run_directory,'columnar')
+    if os.path.exists(columnar_path):
+        ranks,metrics=repw.read_columnar(columnar_path)
+        return {metric:[count for count in counts if not math.isnan(count)] for metric,counts in metrics.items()}
+
+    json_path=repw.get_report_path(run_directory,'json')
+    if os.path.exists(json_path):
+        with open(json_path) as f:
+            report=json.load(f)
+        return {(metric['type'],metric['name']):list(metric['counts'].values()) for metric in report['metrics']}
+
+    raise ValueError("no columnar or json report in {} (run lpprof with --report-formats text,columnar)".format(
+        run_directory))
+
+
+def _mean_var(counts):
+    mean=sum(counts)/len(counts)
+    if len(counts)<2:
+        return mean,0.0
+    return mean,sum((count-mean)**2 for count in counts)/(len(counts)-1)
+
+
+def compare_metric(metric_type,metric_name,base_counts,target_counts):
+    """ Difference of the average over ranks of a metric between two runs. Its score is the
+    difference divided by the standard error given by the spread of the ranks of each run. """
+    base_avg,base_var=_mean_var(base_counts)
+    target_avg,target_var=_mean_var(target_counts)
+    delta=target_avg-base_avg
+
+    noise=math.sqrt(base_var/len(base_counts)+target_var/len(target_counts))
+    noise=max(noise,MIN_RELATIVE_NOISE*max(abs(base_avg),abs(target_avg)))
+    if noise:
+        score=abs(delta)/noise
+    else:
+        score=0.0
+    if base_avg:
+        relative=delta/abs(base_avg)*100
+    else:
+        relative=math.copysign(float("inf"),delta) if delta else 0.0
+
+    return MetricDelta(metric_type,metric_name,base_avg,target_avg,delta,relative,score)
+
+
+def is_significant_presence(metric_type,metric_name,counts,threshold=SIGNIFICANCE_THRESHOLD):
+    """ True if a metric found in one run only is worth reporting: shares of samples must
+    reach MIN_APPEARED_SHARE, other metrics must differ significantly from zero """
+    if metric_type in SHARE_METRIC_TYPES:
+        return sum(counts)/len(counts)>=MIN_APPEARED_SHARE
+    return compare_metric(metric_type,metric_name,[0.0],counts).score>=threshold
+
+
+def compare_runs(base_metrics,target_metrics,metric_types=COMPARED_METRIC_TYPES,threshold=SIGNIFICANCE_THRESHOLD):
+    """ Return significant changes of metrics found in both runs, most significant first,
+    and significant metrics only found in the base run (disappeared) or in the target run
+    (appeared) as (metric_type,metric_name,avg) sorted by decreasing average """
+    changes=[]
+    disappeared=[]
+    appeared=[]
+    for metric in sorted(set(base_metrics)|set(target_metrics)):
+        metric_type,metric_name=metric
+        if metric_type not in metric_types:
+            continue
+        base_counts=base_metrics.get(metric)
+        target_counts=target_metrics.get(metric)
+        if base_counts and target_counts:
+            metric_delta=compare_metric(metric_type,metric_name,base_counts,target_counts)
+            if metric_delta.score>=threshold:
+                changes.append(metric_delta)
+        elif base_counts:
+            if is_significant_presence(metric_type,metric_name,base_counts,threshold):
+                disappeared.append((metric_type,metric_name,sum(base_counts)/len(base_counts)))
+        elif target_counts:
+            if is_significant_presence(metric_type,metric_name,target_counts,threshold):
+                appeared.append((metric_type,metric_name,sum(target_counts)/len(target_counts)))
+
+    changes.sort(key=lambda metric_delta:(-metric_delta.score,metric_delta.metric_type,metric_delta.metric_name))
+    appeared.sort(key=lambda metric:(-metric[2],metric[0],metric[1]))
+    disappeared.sort(key=lambda metric:(-metric[2],metric[0],metric[1]))
+    return changes,appeared,disappeared
+
+
+def _write_title(out,title):
+    out.write(title+"\n")
+    out.write("".ljust(len(title),"-"))
+    out.write("\n\n")
+
+
+def write_comparison(base_directory,target_directory,out=None,threshold=SIGNIFICANCE_THRESHOLD):
+    """ Write the comparison of two runs, to stdout by default. Return the number of
+    significant changes, appeared and disappeared metrics. """
+    if out is None:
+        out=sys.stdout
+    changes,appeared,disappeared=compare_runs(load_run(base_directory),load_run(target_directory),
+                                              threshold=threshold)
+
+    out.write("lpprof comparison of {} (base) and {} (target)\n\n".format(base_directory,target_directory))
+
+    _write_title(out,"significant changes (most significant first):")
+    out.write("  metric name".ljust(60))
+    out.write("base avg".ljust(15))
+    out.write("target avg".ljust(15))
+    out.write("change".ljust(15))
+    out.write("significance")
+    out.write("\n")
+    out.write("  ".ljust(160,"-"))
+    out.write("\n")
+    for metric_delta in changes[:MAX_COMPARE_ROWS]:
+        metric_unit=repw.get_metric_unit(metric_delta.metric_type,metric_delta.metric_name)
+        out.write("  {} {} ".format(metric_delta.metric_type,metric_delta.metric_name).ljust(60))
+        out.write("{:.5g}{}".format(metric_delta.base_avg,metric_unit).ljust(15))
+        out.write("{:.5g}{}".format(metric_delta.target_avg,metric_unit).ljust(15))
+        out.write("{:+.3g}%".format(metric_delta.relative).ljust(15))
+        out.write("{:.3g}x noise".format(metric_delta.score))
+        out.write("\n")
+    if len(changes)>MAX_COMPARE_ROWS:
+        out.write("  ... {} more\n".format(len(changes)-MAX_COMPARE_ROWS))
+    out.write("\n\n")
+
+    for title,metrics in [("appeared in target run:",appeared),("disappeared from target run:",disappeared)]:
+        if not metrics:
+            continue
+        _write_title(out,title)
+        for metric_type,metric_name,avg in metrics[:MAX_COMPARE_ROWS]:
+            out.write("  {} {} ".format(metric_type,metric_name).ljust(60))
+            out.write("{:.5g}{}".format(avg,repw.get_metric_unit(metric_type,metric_name)))
+            out.write("\n")
+        if len(metrics)>MAX_COMPARE_ROWS:
+            out.write("  ... {} more\n".format(len(metrics)-MAX_COMPARE_ROWS))
+        out.write("\n\n")
+
+    return len(changes)+len(appeared)+len(disappeared)
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#  This file is part of the LPprofiler profiling tool.                       #
+#        Copyright (C) 2017  EDF SA                                          #
+#                                                                            #
+#  LPprofiler is free software: you can redistribute it and/or modify        #
+#  it under the terms of the GNU General Public License as published by      #
+#  the Free Software Foundation, either version 3 of the License, or         #
+#  (at your option) any later version.                                       #
+#                                                                            #
+#  LPprofiler is distributed in the hope that it will be useful,             #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of            #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the             #
+#  GNU General Public License for more details.                              #
+#                                                                            #
+#  You should have received a copy of the GNU General Public License         #
+#  along with LPprofiler.  If not, see <http://www.gnu.org/licenses/>.       #
+#                                                                            #
+############################################################################## 
+
+from collections import namedtuple
+
+# Average size in perf.data of a sample without and with a frame pointer call chain
+BYTES_PER_SAMPLE=64
+BYTES_PER_CALLCHAIN_SAMPLE=512
+
+# Average time spent by the kernel to take one sample with a call chain
+SECONDS_PER_SAMPLE=20e-6
+
+MIN_FREQUENCY=1
+MAX_FREQUENCY=4999
+
+# Below this frequency samples without call chains are preferred, flat profiles
+# need more samples than call trees to be accurate
+MIN_CALLGRAPH_FREQUENCY=49
+
+# Expected duration of the job when none is given
+DEFAULT_DURATION=3600
+
+# Each rank perf.data is rotated over this many files whose total is its budget,
+# perf record keeps only the most recent files when a rank overshoots
+NB_ROTATED_FILES=4
+
+SamplingPlan=namedtuple('SamplingPlan',['frequency','callgraph','rank_budget'])
+
+
+def get_sample_size(callgraph):
+    if callgraph:
+        return BYTES_PER_CALLCHAIN_SAMPLE
+    return BYTES_PER_SAMPLE
+
+
+def _clamp_frequency(frequency):
+    # Rounded first so that float error does not drop an exact frequency by one
+    return int(round(min(max(frequency,MIN_FREQUENCY),MAX_FREQUENCY),6))
+
+
+def plan_sampling(nb_ranks,duration=DEFAULT_DURATION,budget=None,overhead=None):
+    """ Sampling frequency and call graph mode of each rank so that a job of nb_ranks ranks
+    running duration seconds writes at most budget bytes of samples and spends at most
+    overhead (a fraction) of its time sampling """
+    nb_ranks=max(nb_ranks,1)
+    callgraph=True
+    frequency=MAX_FREQUENCY
+    rank_budget=None
+
+    if overhead:
+        frequency=overhead/SECONDS_PER_SAMPLE
+
+    if budget:
+        rank_budget=budget//nb_ranks
+        budget_frequency=rank_budget/(duration*BYTES_PER_CALLCHAIN_SAMPLE)
+        if budget_frequency<MIN_CALLGRAPH_FREQUENCY:
+            callgraph=False
+            budget_frequency=rank_budget/(duration*BYTES_PER_SAMPLE)
+        frequency=min(frequency,budget_frequency)
+
+    return SamplingPlan(_clamp_frequency(frequency),callgraph,rank_budget)
+
+
+def get_projected_size(plan,sample_rate,duration,bytes_per_sample=None):
+    """ Size of the samples of a rank measured at sample_rate samples per second over duration seconds.
+    Multi-threaded ranks are sampled at the planned frequency on each thread. bytes_per_sample is
+    the size of a sample measured in the traces, the planned average size by default. """
+    if not bytes_per_sample:
+        bytes_per_sample=get_sample_size(plan.callgraph)
+    return sample_rate*duration*bytes_per_sample
+
+
+def is_rotated(nb_trace_files):
+    """ True if perf record dropped the oldest samples of a rank that overshot its budget """
+    return nb_trace_files>=NB_ROTATED_FILES
+
+
+def suggest_frequency(plan,sample_rate,duration,bytes_per_sample=None):
+    """ Frequency that would have kept a rank measured at sample_rate within its budget """
+    projected_size=get_projected_size(plan,sample_rate,duration,bytes_per_sample)
+    if not plan.rank_budget or not projected_size:
+        return plan.frequency
+    return _clamp_frequency(plan.frequency*plan.rank_budget/projected_size)
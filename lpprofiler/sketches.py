@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#  This file is part of the LPprofiler profiling tool.                       #
+#        Copyright (C) 2017  EDF SA                                          #
+#                                                                            #
+#  LPprofiler is free software: you can redistribute it and/or modify        #
+#  it under the terms of the GNU General Public License as published by      #
+#  the Free Software Foundation, either version 3 of the License, or         #
+#  (at your option) any later version.                                       #
+#                                                                            #
+#  LPprofiler is distributed in the hope that it will be useful,             #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of            #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the             #
+#  GNU General Public License for more details.                              #
+#                                                                            #
+#  You should have received a copy of the GNU General Public License         #
+#  along with LPprofiler.  If not, see <http://www.gnu.org/licenses/>.       #
+#                                                                            #
+############################################################################## 
+
+import math, heapq
+
+DEFAULT_RELATIVE_ACCURACY=0.01
+DEFAULT_MAX_BUCKETS=2048
+DEFAULT_NB_EXTREMES=5
+
+
+class QuantileSketch :
+    """ Mergeable streaming sketch of a distribution of values (one value per rank).
+    Values are counted in logarithmic buckets so that any quantile is known with a bounded
+    relative error whatever the number of values. The lowest and highest values are
+    kept with their rank to find outlier ranks. """
+
+    def __init__(self,relative_accuracy=DEFAULT_RELATIVE_ACCURACY,max_buckets=DEFAULT_MAX_BUCKETS,
+                 nb_extremes=DEFAULT_NB_EXTREMES):
+        self.relative_accuracy=relative_accuracy
+        self.gamma=(1+relative_accuracy)/(1-relative_accuracy)
+        self.log_gamma=math.log(self.gamma)
+        self.max_buckets=max_buckets
+        self.nb_extremes=nb_extremes
+
+        # Bucket index -> number of values, for positive values and absolute negative values
+        self.positive_buckets={}
+        self.negative_buckets={}
+        self.zero_count=0
+        self.count=0
+        self.sum=0.0
+        self.min=float("inf")
+        self.max=-float("inf")
+
+        # (value,rank) heaps of the lowest and highest values
+        self.lowest=[]
+        self.highest=[]
+
+    def _index(self,value):
+        return math.ceil(math.log(value)/self.log_gamma)
+
+    def _value(self,index):
+        """ Value in the middle of bucket index, at most relative_accuracy away from its values """
+        return 2*self.gamma**index/(self.gamma+1)
+
+    def _collapse(self,buckets):
+        """ Merge lowest buckets to keep at most max_buckets buckets """
+        if len(buckets)<=self.max_buckets:
+            return
+        indexes=sorted(buckets)
+        nb_collapsed=len(indexes)-self.max_buckets+1
+        collapsed_count=sum(buckets.pop(index) for index in indexes[:nb_collapsed])
+        buckets[indexes[nb_collapsed]]=buckets.get(indexes[nb_collapsed],0)+collapsed_count
+
+    def add(self,value,rank=None,count=1):
+        """ Add count occurences of value, rank is used to report outliers """
+        if value>0:
+            index=self._index(value)
+            self.positive_buckets[index]=self.positive_buckets.get(index,0)+count
+            self._collapse(self.positive_buckets)
+        elif value<0:
+            index=self._index(-value)
+            self.negative_buckets[index]=self.negative_buckets.get(index,0)+count
+            self._collapse(self.negative_buckets)
+        else:
+            self.zero_count+=count
+
+        self.count+=count
+        self.sum+=value*count
+        self.min=min(self.min,value)
+        self.max=max(self.max,value)
+
+        if rank is not None and self.nb_extremes:
+            self._push_extreme(self.lowest,(-value,rank))
+            self._push_extreme(self.highest,(value,rank))
+
+    def _push_extreme(self,heap,item):
+        if len(heap)<self.nb_extremes:
+            heapq.heappush(heap,item)
+        elif item>heap[0]:
+            heapq.heapreplace(heap,item)
+
+    def merge(self,other):
+        """ Add values of another sketch with the same relative accuracy """
+        if other.gamma!=self.gamma:
+            raise ValueError("cannot merge sketches of different accuracies")
+        for buckets,other_buckets in ((self.positive_buckets,other.positive_buckets),
+                                      (self.negative_buckets,other.negative_buckets)):
+            for index,count in other_buckets.items():
+                buckets[index]=buckets.get(index,0)+count
+            self._collapse(buckets)
+        self.zero_count+=other.zero_count
+        self.count+=other.count
+        self.sum+=other.sum
+        self.min=min(self.min,other.min)
+        self.max=max(self.max,other.max)
+        for item in other.lowest:
+            self._push_extreme(self.lowest,item)
+        for item in other.highest:
+            self._push_extreme(self.highest,item)
+
+    def _iter_buckets(self):
+        """ Yield (value,count) of buckets in ascending value order """
+        for index in sorted(self.negative_buckets,reverse=True):
+            yield -self._value(index),self.negative_buckets[index]
+        if self.zero_count:
+            yield 0.0,self.zero_count
+        for index in sorted(self.positive_buckets):
+            yield self._value(index),self.positive_buckets[index]
+
+    def quantile(self,q):
+        """ Estimate the q quantile (0<=q<=1) of the values, None if the sketch is empty """
+        if not self.count:
+            return None
+        rank=q*(self.count-1)
+        cumulated_count=0
+        for value,count in self._iter_buckets():
+            cumulated_count+=count
+            if cumulated_count>rank:
+                # Estimates never lie outside of the exact range of values
+                return min(max(value,self.min),self.max)
+        return self.max
+
+    def avg(self):
+        if not self.count:
+            return None
+        return self.sum/self.count
+
+    def spread(self):
+        """ Interdecile range relative to the median (%), 0 when all ranks have the same value """
+        p50=self.quantile(0.5)
+        if not p50:
+            return 0.0
+        return (self.quantile(0.9)-self.quantile(0.1))/abs(p50)*100
+
+    def outliers(self):
+        """ Return (rank,value) of kept extreme values outside of the Tukey fences
+        (1.5 interquartile range away from the quartiles), furthest first """
+        if self.count<4:
+            return []
+        q1=self.quantile(0.25)
+        q3=self.quantile(0.75)
+        # Differences smaller than the sketch accuracy are not significant
+        margin=max(1.5*(q3-q1),2*self.relative_accuracy*max(abs(q1),abs(q3)))
+        low_fence=q1-margin
+        high_fence=q3+margin
+
+        outliers=[(value-high_fence,rank,value) for value,rank in self.highest if value>high_fence]
+        outliers+=[(low_fence+value,rank,-value) for value,rank in self.lowest if -value<low_fence]
+        return [(rank,value) for distance,rank,value in sorted(outliers,reverse=True)]
+
+    def histogram(self,nb_bins=10):
+        """ Number of values in nb_bins bins of same width between min and max """
+        bins=[0]*nb_bins
+        if not self.count:
+            return bins
+        width=(self.max-self.min)/nb_bins
+        for value,count in self._iter_buckets():
+            if width>0:
+                ibin=min(int((value-self.min)/width),nb_bins-1)
+            else:
+                ibin=0
+            bins[max(ibin,0)]+=count
+        return bins
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#  This file is part of the LPprofiler profiling tool.                       #
+#        Copyright (C) 2017  EDF SA                                          #
+#                                                                            #
+#  LPprofiler is free software: you can redistribute it and/or modify        #
+#  it under the terms of the GNU General Public License as published by      #
+#  the Free Software Foundation, either version 3 of the License, or         #
+#  (at your option) any later version.                                       #
+#                                                                            #
+#  LPprofiler is distributed in the hope that it will be useful,             #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of            #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the             #
+#  GNU General Public License for more details.                              #
+#                                                                            #
+#  You should have received a copy of the GNU General Public License         #
+#  along with LPprofiler.  If not, see <http://www.gnu.org/licenses/>.       #
+#                                                                            #
+############################################################################## 
+
+from subprocess import Popen,PIPE,DEVNULL
+import lpprofiler.disassembly_cache as discache
+import re
+
+# Addresses written to addr2line before reading its answers, small enough for
+# the answers to fit in the pipe buffer so that neither process blocks on the other.
+BATCH_SIZE=128
+
+UNKNOWN_LINE='??'
+
+DISCRIMINATOR_RE=re.compile(r" \(discriminator \d+\)$")
+
+
+class Addr2lineWorker :
+    """ Long-lived addr2line process of one binary, fed with batches of addresses """
+
+    def __init__(self,binary_path):
+        self.process=Popen(['addr2line','-e',binary_path],stdin=PIPE,stdout=PIPE,stderr=DEVNULL,
+                           universal_newlines=True,bufsize=1)
+
+    def resolve(self,addresses):
+        """ Return the file:line of each address, None for addresses without debug information """
+        lines=[]
+        for start in range(0,len(addresses),BATCH_SIZE):
+            batch=addresses[start:start+BATCH_SIZE]
+            self.process.stdin.write("".join("{:x}\n".format(address) for address in batch))
+            self.process.stdin.flush()
+            # addr2line answers one line per address, in order
+            for address in batch:
+                line=DISCRIMINATOR_RE.sub('',self.process.stdout.readline().rstrip('\n'))
+                if not line or line.startswith('??'):
+                    line=None
+                lines.append(line)
+        return lines
+
+    def close(self):
+        self.process.stdin.close()
+        self.process.wait()
+        self.process.stdout.close()
+
+
+class SourceLineResolver :
+    """ Resolve binary relative addresses to source file:line with one addr2line worker
+    per binary. Lines already resolved are kept in the persistent disassembly cache. """
+
+    def __init__(self,cache=None):
+        self.cache=cache
+        self.workers={}
+        # binary path -> {address: file:line or None}
+        self.lines={}
+        self.cache_keys={}
+
+    def _load(self,binary_path):
+        """ Get lines of binary_path known from the persistent cache """
+        self.lines[binary_path]={}
+        self.cache_keys[binary_path]=None
+        if not self.cache:
+            return
+        try:
+            self.cache_keys[binary_path]='lines-'+discache.get_binary_key(binary_path)
+        except OSError:
+            return
+        state=self.cache.load(self.cache_keys[binary_path])
+        if state is not None:
+            self.lines[binary_path]=state
+
+    def resolve(self,binary_path,addresses):
+        """ Return {address: file:line or None} of addresses of binary_path """
+        if binary_path not in self.lines:
+            self._load(binary_path)
+        binary_lines=self.lines[binary_path]
+
+        new_addresses=sorted(set(address for address in addresses if address not in binary_lines))
+        if new_addresses:
+            try:
+                if binary_path not in self.workers:
+                    self.workers[binary_path]=Addr2lineWorker(binary_path)
+                new_lines=self.workers[binary_path].resolve(new_addresses)
+            except OSError:
+                # addr2line is not available or died, addresses stay unresolved
+                new_lines=[None]*len(new_addresses)
+            binary_lines.update(zip(new_addresses,new_lines))
+            if self.cache and self.cache_keys[binary_path]:
+                self.cache.store(self.cache_keys[binary_path],binary_lines)
+
+        return {address:binary_lines[address] for address in addresses}
+
+    def close(self):
+        """ Stop addr2line workers """
+        for worker in self.workers.values():
+            try:
+                worker.close()
+            except OSError:
+                pass
+        self.workers={}
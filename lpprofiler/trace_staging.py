@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#  This file is part of the LPprofiler profiling tool.                       #
+#        Copyright (C) 2017  EDF SA                                          #
+#                                                                            #
+#  LPprofiler is free software: you can redistribute it and/or modify        #
+#  it under the terms of the GNU General Public License as published by      #
+#  the Free Software Foundation, either version 3 of the License, or         #
+#  (at your option) any later version.                                       #
+#                                                                            #
+#  LPprofiler is distributed in the hope that it will be useful,             #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of            #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the             #
+#  GNU General Public License for more details.                              #
+#                                                                            #
+#  You should have received a copy of the GNU General Public License         #
+#  along with LPprofiler.  If not, see <http://www.gnu.org/licenses/>.       #
+#                                                                            #
+############################################################################## 
+
+import lpprofiler.node_analysis as nodan
+import lpprofiler.live_analyzer as live
+import os, tarfile, tempfile
+
+# Node-local directories tried in order when no staging directory is given
+DEFAULT_STAGE_ENV='TMPDIR'
+DEFAULT_STAGE_ROOT='/dev/shm'
+
+SUMMARY_NAME='perf.summary_{}'
+ARCHIVE_NAME='perf.traces_{}.tar.gz'
+
+
+def get_stage_directory(traces_directory,profiling_args):
+    """ Node-local directory where ranks write their traces before they are collected
+    in traces_directory. Its name is the one of traces_directory so that jobs sharing
+    a node do not mix their traces. """
+    stage_root=profiling_args.get('stage_dir') or os.environ.get(DEFAULT_STAGE_ENV) or DEFAULT_STAGE_ROOT
+    return os.path.join(os.path.abspath(stage_root),'lpprof_'+os.path.basename(os.path.abspath(traces_directory)))
+
+
+def get_staged_cmd(run_cmd,stage_directory,traces_directory,rank,profiling_args):
+    """ Shell command creating the staging directory, running run_cmd then collecting traces
+    of rank once it exits. Exit status of run_cmd is kept. """
+    collect_cmd="{} --collect {} -o {} --ranks {}".format(
+        profiling_args.get("lpprof_cmd","lpprof"),stage_directory,os.path.abspath(traces_directory),rank)
+    collect_cmd+=nodan.get_forwarded_options(profiling_args)
+    return "mkdir -p {}; {}; status=$?; {}; exit $status".format(stage_directory,run_cmd,collect_cmd)
+
+
+def _write_atomic(path,data):
+    """ Readers of the job directory never see a partial file """
+    fd,tmp_path=tempfile.mkstemp(dir=os.path.dirname(path),prefix='.tmp_')
+    try:
+        with os.fdopen(fd,'wb') as f:
+            f.write(data)
+        os.replace(tmp_path,path)
+    except OSError:
+        os.remove(tmp_path)
+        raise
+
+
+def collect_ranks(stage_directory,traces_directory,ranks,profiling_args):
+    """ Analyze staged traces of ranks, write their summary and an archive of their traces
+    in traces_directory, then remove them from the staging directory """
+    for rank in ranks:
+        data_file="{}/perf.data_{}".format(stage_directory,rank)
+        staged_files=[path for path in ("{}/perf.stats_{}".format(stage_directory,rank),data_file)
+                      if os.path.exists(path)]
+        # perf.data is rotated into chunks when the rank has a sampling budget
+        staged_files+=live.get_chunks(data_file)
+        if not staged_files:
+            print("No staged traces for rank {} in {}".format(rank,stage_directory))
+            continue
+
+        metrics_manager=nodan.analyze_node(stage_directory,[rank],profiling_args)
+        _write_atomic(os.path.join(traces_directory,SUMMARY_NAME.format(rank)),
+                      nodan.dumps_summary(metrics_manager))
+
+        # perf.data is already compressed by perf record -z, a fast level is enough
+        archive_path=os.path.join(traces_directory,ARCHIVE_NAME.format(rank))
+        with tarfile.open(archive_path+'.tmp','w:gz',compresslevel=1) as archive:
+            for staged_file in staged_files:
+                archive.add(staged_file,arcname=os.path.basename(staged_file))
+        os.replace(archive_path+'.tmp',archive_path)
+
+        for staged_file in staged_files:
+            os.remove(staged_file)
+
+    # Other ranks of the node may still be writing in the staging directory
+    try:
+        os.rmdir(stage_directory)
+    except OSError:
+        pass
+
+
+def read_summary(traces_directory,rank):
+    """ Metrics manager of the summary collected for rank, None if it is missing or invalid """
+    summary_path=os.path.join(traces_directory,SUMMARY_NAME.format(rank))
+    try:
+        with open(summary_path,'rb') as f:
+            return nodan.loads_summary(f.read())
+    except OSError:
+        print("No summary collected for rank {}".format(rank))
+    except ValueError as e:
+        print("Cannot read summary of rank {}: {}".format(rank,e))
+    return None
@@ -37,6 +37,16 @@ setup(name='lpprof',
       license='GPLv3',
       platforms=['GNU/Linux'],
       url='https://github.com/edf-hpc/LPprofiler',
-      scripts=['bin/lpprof','tests/tests_samples_profiler'],
+      scripts=['bin/lpprof','tests/tests_samples_profiler','tests/tests_perf_data_reader',
+               'tests/tests_node_analysis','tests/tests_sketches',
+               'tests/tests_hwcounters_profiler','tests/tests_cpu_events',
+               'tests/tests_call_tree','tests/tests_flame_graph','tests/tests_source_lines',
+               'tests/tests_isa_classifier','tests/tests_live_analyzer',
+               'tests/tests_trace_staging','tests/tests_host_agent',
+               'tests/tests_rendezvous','tests/tests_sampling_budget',
+               'tests/tests_report_writer','tests/tests_run_comparator',
+               'tests/tests_metrics_manager','tests/tests_disassembler',
+               'tests/tests_disassembly_cache',
+               'tests/bench_analysis'],
       packages=['lpprofiler']
   )
@@ -15,6 +15,8 @@
 #include <linux/limits.h>
 #include <stdio.h>
 #include <math.h>
+#include <sys/socket.h>
+#include <netinet/in.h>
 #include "lpprof.h"
 
 /*
@@ -76,301 +78,194 @@ struct spank_option spank_options[] =
 
 
 
-int slurm_spank_task_exit(spank_t sp, int ac, char **av)
+/*
+ * srun side: start the lpprof rendezvous server before tasks are launched.
+ * Tasks register to it with their rank, host and pid, lpprof profiles each
+ * host as soon as all its tasks registered.
+ */
+int slurm_spank_local_user_init(spank_t sp, int ac, char **av)
 {
 
   if(frequency==FREQUENCY_NOT_SET){
     return(0);
   }
 
-  unsigned int taskid=0;
-  spank_get_item (sp, S_TASK_GLOBAL_ID, &taskid);
+  uint32_t job_id=0;
+  uint32_t nbtasks=0;
+  spank_get_item (sp, S_JOB_ID, &job_id);
+  spank_get_item (sp, S_JOB_TOTAL_TASK_COUNT, &nbtasks);
 
-    
-  if((spank_context() != S_CTX_REMOTE)||(taskid!=0))
-    return(0);
-
-  
-  char output_dir[PATH_MAX];
-  char slurm_submit_dir[PATH_MAX];
-  char slurm_job_id [SLURM_ENVSIZE];
-  char pid_dir[PATH_MAX];
-  slurm_getenv(sp,slurm_submit_dir,"SLURM_SUBMIT_DIR");
-  slurm_getenv(sp,slurm_job_id,"SLURM_JOB_ID");
+  // Check writing rate
+  int size_sample=30;
+  int nb_prof_ranks=nbtasks;
+  if (rank_list)
+    nb_prof_ranks=count_ranks(rank_list);
 
-  snprintf(output_dir,PATH_MAX,"%s/perf_%s",slurm_submit_dir,slurm_job_id);
-  snprintf(pid_dir,PATH_MAX,"%s/perf_%s/lpprof_pid",slurm_submit_dir,slurm_job_id);
+  float writing_rate=(((float)frequency*nb_prof_ranks*size_sample*60)/1000000);
 
-  if (chdir(output_dir)){
-    slurm_error("Cannot chdir to %s : %m ",output_dir);
-    return (0);
-  }  
+  if (writing_rate>100){
+    slurm_error("Collecting samples at %dHz on %d ranks would lead to write samples at %dMo per minute. Please retry with lower profiling frequency or with less ranks",frequency,nb_prof_ranks,(int)writing_rate);
+    return(-1);
+  }
 
-  // Make a file to signal that job is done to perf processes
-  FILE* jobfile=fopen("job_done","w");
-  fclose(jobfile);
+  char cwd[PATH_MAX];
+  if (getcwd(cwd,PATH_MAX)==NULL){
+    slurm_error("Cannot get current directory : %m ");
+    return (-1);
+  }
+  snprintf(output_dir,PATH_MAX,"%s/perf_%u",cwd,job_id);
 
-  if (chdir(pid_dir)){
-    slurm_error("Cannot chdir to %s : %m ",pid_dir);
-    return (0);
-  }  
+  struct stat st = {0};
+  // Make lpprof outputdir if it does not already exist
+  if ((stat(output_dir, &st) == -1)) {
+    if (mkdir(output_dir,S_IXUSR|S_IWUSR|S_IRUSR)){
+      if(errno!=EEXIST){
+	slurm_error("Cannot mkdir %s : %m ",output_dir);
+	return (-1);
+      }
+    }
+  }
 
+  // Listen before tasks are launched so that no registration is refused
+  int port=0;
+  int listen_fd=listen_rendezvous(&port);
+  if (listen_fd<0){
+    slurm_error("Cannot listen for lpprof rendezvous : %m ");
+    return (-1);
+  }
 
-  // Get lpprof pid
-  char *s_pid=malloc(1024*sizeof(char));
-  strcpy(s_pid,"");
-  read_pids(&s_pid,1);
-  int lpprof_pid=atoi(s_pid);
+  char s_port[64];
+  snprintf(s_port,64,"%d",port);
+  if (spank_setenv(sp,RENDEZVOUS_PORT_ENV,s_port,1)!=ESPANK_SUCCESS){
+    slurm_error("Cannot set %s",RENDEZVOUS_PORT_ENV);
+    close(listen_fd);
+    return (-1);
+  }
 
-  // Wait for lpprof process to end
-  struct stat sts;
-  char proc_pid_file[1024];    
-  snprintf(proc_pid_file,1024,"/proc/%s",s_pid);
-  
-  while (!(stat(proc_pid_file, &sts) == -1 && errno == ENOENT)) {
-    usleep(10);
+  if (_exec_lpprof(frequency,nbtasks,listen_fd)){
+    slurm_error("Error with srun --lpprof spank plugin option : %m ");
+    close(listen_fd);
+    return (-1);
   }
 
+  close(listen_fd);
+  return (0);
+}
+
+
+/*
+ * srun side: signal the end of the job to lpprof agents and wait for the
+ * report to be written.
+ */
+int slurm_spank_exit(spank_t sp, int ac, char **av)
+{
+
+  if((spank_context() != S_CTX_LOCAL)||(lpprof_pid<=0))
+    return(0);
+
   if (chdir(output_dir)){
     slurm_error("Cannot chdir to %s : %m ",output_dir);
     return (0);
-  }  
+  }
+
+  // Make a file to signal that job is done to perf processes
+  FILE* jobfile=fopen("job_done","w");
+  if (jobfile)
+    fclose(jobfile);
+
+  // Wait for lpprof process to end
+  int status;
+  waitpid(lpprof_pid,&status,0);
+  lpprof_pid=-1;
 
   if (remove("job_done")){
     slurm_error("Cannot remove job_done : %m ");
   }
 
-  free(s_pid);
-  
   return(0);
 }
 
 
+/*
+ * Task side: register rank, host and pid to the rendezvous server.
+ */
 int slurm_spank_task_init (spank_t sp, int ac, char **av)
 {
 
   if(frequency==FREQUENCY_NOT_SET){
     return(0);
   }
-  
+
   unsigned int taskid=0;
-  unsigned int nbtasks=0;
-  int ismaster=0;
-  char slurm_submit_dir[PATH_MAX];
-  char slurm_job_id [SLURM_ENVSIZE];
-  char slurm_env_path [SLURM_ENVSIZE];
+  unsigned int local_tasks=0;
   char slurm_nodename [SLURM_ENVSIZE];
   char slurm_step_num_tasks [SLURM_ENVSIZE];
-  
-  slurm_getenv(sp,slurm_submit_dir,"SLURM_SUBMIT_DIR");
-  slurm_getenv(sp,slurm_job_id,"SLURM_JOB_ID");
-  slurm_getenv(sp,slurm_env_path,"PATH");
-  slurm_getenv(sp,slurm_nodename,"SLURMD_NODENAME");
+  char launch_node [SLURM_ENVSIZE];
+  char rendezvous_port [SLURM_ENVSIZE];
 
   // If NUM_TASKS is not set current process is the parent slurmstepd process
   // that should not be profiled.
   if(slurm_getenv(sp,slurm_step_num_tasks,"SLURM_STEP_NUM_TASKS"))
     return (0);
 
-  spank_get_item (sp, S_TASK_GLOBAL_ID, &taskid);
-  spank_get_item (sp, S_JOB_TOTAL_TASK_COUNT,&nbtasks);
-
-
-  // Check writing rate
-  if(taskid==0){
-    int size_sample=30;
-    int nb_prof_ranks=nbtasks;
-    if (rank_list)
-      nb_prof_ranks=count_ranks(rank_list);
-    
-    float writing_rate=(((float)frequency*nb_prof_ranks*size_sample*60)/1000000);
-
-    if (writing_rate>100){
-      slurm_error("Collecting samples at %dHz on %d ranks would lead to write samples at %dMo per minute. Please retry with lower profiling frequency or with less ranks",frequency,nb_prof_ranks,writing_rate);
-      return(-1);
-    }
-  }
-  
-  
-  // Initialize a pid_list
-  char *pid_list=NULL;
-  pid_list=malloc(sizeof(char)*nbtasks*HOSTPID_MXSZ);
-  strcpy(pid_list,"");
-
-  
-  // Init directory and pid_list
-  if (_init_lpprof_dir(taskid,nbtasks,slurm_submit_dir,slurm_job_id,slurm_env_path,slurm_nodename,&pid_list)){
-      slurm_error("Error with srun --lpprof spank plugin option : %m ");
-      return (-1);
-  }
-      
-  // Execute lpprof profiler from first pid
-  if(taskid==0){
-    if(_exec_lpprof(sp,frequency,slurm_submit_dir,slurm_job_id,slurm_env_path,pid_list)){
-      slurm_error("Error with srun --lpprof spank plugin option : %m ");
-      return (-1);
-    }
-  }
-  
-  free(pid_list);
-
-  
-  return (0);
-}
-
-
-static int _init_lpprof_dir(unsigned int taskid,
-			    unsigned int nbtasks,
-			    const char* slurm_submit_dir,
-			    const char* slurm_job_id,
-			    const char* slurm_env_path,
-			    const char* slurm_nodename,
-			    char** pid_list){
-
-  char output_dir[PATH_MAX];
-  char pid_dir[PATH_MAX];
-  int pid=getpid();
-
-  snprintf(output_dir,PATH_MAX,"%s/perf_%s",slurm_submit_dir,slurm_job_id);
-  snprintf(pid_dir,PATH_MAX,"%s/perf_%s/pids",slurm_submit_dir,slurm_job_id);
-
-  if (chdir(slurm_submit_dir)){
-    slurm_error("Cannot chdir to %s : %m ",slurm_submit_dir);
-    return (-1);
-  }
-  struct stat st = {0};
-  // Make lpprof outputdir if it does not already exist
-  if ((stat(output_dir, &st) == -1)) {
-    if (mkdir(output_dir,S_IXUSR|S_IWUSR|S_IRUSR)){
-      if(errno!=EEXIST){
-	slurm_error("Cannot mkdir %s : %m ",output_dir);
-	return (-1);
-      }
-    }
-  }
-  if (chdir(output_dir)){
-    slurm_error("Cannot chdir to %s : %m ",output_dir);
-    return (-1);
-  }
-
-  // Make lpprof pid dir
-  if ((stat(pid_dir, &st) == -1)) {
-    if (mkdir(pid_dir,S_IXUSR|S_IWUSR|S_IRUSR)){
-      if(errno!=EEXIST){
-	slurm_error("Cannot mkdir %s : %m ",pid_dir);
-	return (-1);
-      }
-    }
-  }
-  
-  if (chdir(pid_dir)){
-    slurm_error("Cannot chdir to %s : %m ",pid_dir);
-    return (-1);
+  if(slurm_getenv(sp,launch_node,"SLURM_LAUNCH_NODE_IPADDR")||
+     slurm_getenv(sp,rendezvous_port,RENDEZVOUS_PORT_ENV)){
+    slurm_error("lpprof rendezvous address is not set, task is not profiled");
+    return (0);
   }
-  
-
-  write_pidhost_file(pid,slurm_nodename,taskid);
-
-  // Wait for all pids to be written
-  int nbpid_files_written=0;
-
+  slurm_getenv(sp,slurm_nodename,"SLURMD_NODENAME");
 
-  if (taskid==0){
-    while(nbpid_files_written!=nbtasks){
-      usleep(1000);
-      nbpid_files_written=count_pid_files();
-    }
-    
-  }
-  
-  if (taskid==0){
-    if (nbpid_files_written==nbtasks){
-      read_pids(pid_list,nbtasks);
-    }
-  }
+  spank_get_item (sp, S_TASK_GLOBAL_ID, &taskid);
+  spank_get_item (sp, S_JOB_LOCAL_TASK_COUNT, &local_tasks);
 
-  // Change current dir back to output dir
-  if (chdir(slurm_submit_dir)){
-    slurm_error("Cannot chdir to %s : %m ",output_dir);
-    return (-1);
+  if (register_task(launch_node,atoi(rendezvous_port),taskid,slurm_nodename,getpid(),local_tasks)){
+    slurm_error("Cannot register task %u to lpprof rendezvous %s:%s : %m ",taskid,launch_node,rendezvous_port);
   }
 
-  return(0);
-    
+  return (0);
 }
 
 
-static int _exec_lpprof(const spank_t sp,int frequency,
-			const char* slurm_submit_dir,
-			const char* slurm_job_id,
-			const char* slurm_env_path,
-			char* pid_list){
+static int _exec_lpprof(int frequency,
+			unsigned int nbtasks,
+			int listen_fd){
 
-  pid_t lpprof_pid=fork();
-  
+  pid_t pid=fork();
 
-  switch (lpprof_pid) {
+  switch (pid) {
   case -1:
     slurm_error("lpprof fork : %m ");
     return(-1);
   case 0:
     {
-      char output_dir[PATH_MAX];
-      char pid_dir[PATH_MAX];
-      struct stat st = {0};
-      snprintf(output_dir,PATH_MAX,"%s/perf_%s",slurm_submit_dir,slurm_job_id);
-      
       if (chdir(output_dir)){
-	slurm_error("Cannot chdir to %s : %m ",pid_dir);
-	return (-1);
+	slurm_error("Cannot chdir to %s : %m ",output_dir);
+	exit(1);
       }
 
       char s_frequency[1024];
+      char s_ntasks[64];
+      char s_rendezvous[64];
       snprintf(s_frequency, 1024, "%d", frequency);
-      setenv("PATH", slurm_env_path, 1);
+      snprintf(s_ntasks, 64, "%u", nbtasks);
+      // Listening socket is inherited by lpprof
+      snprintf(s_rendezvous, 64, "fd:%d", listen_fd);
 
       if(rank_list){
-	execvp("lpprof" ,(char *[]){"lpprof","--pids",pid_list,"--frequency",s_frequency, 
-	      "--ranks",rank_list,"-o",output_dir, NULL});
+	execvp("lpprof" ,(char *[]){"lpprof","--rendezvous",s_rendezvous,"--ntasks",s_ntasks,
+	      "--frequency",s_frequency,"--ranks",rank_list,"-o",output_dir, NULL});
       }else{
-	execvp("lpprof" ,(char *[]){"lpprof","--pids",pid_list,"--frequency",s_frequency, 
-	      "-o",output_dir, NULL});
+	execvp("lpprof" ,(char *[]){"lpprof","--rendezvous",s_rendezvous,"--ntasks",s_ntasks,
+	      "--frequency",s_frequency,"-o",output_dir, NULL});
       }
-    
+
       slurm_error("execv : %m ");
-      return(-1);
+      exit(1);
     }
-    
-  default:
-    {
-      char pid_dir[PATH_MAX];
-      struct stat st = {0};
-      snprintf(pid_dir,PATH_MAX,"%s/perf_%s/lpprof_pid",slurm_submit_dir,slurm_job_id);
-
-      // Make lpprof pid dir
-      if (stat(pid_dir, &st) == -1) {
-	if (mkdir(pid_dir,S_IXUSR|S_IWUSR|S_IRUSR)){
-	  slurm_error("Cannot mkdir %s : %m ",pid_dir);
-	  return (-1);
-	}
-      }
-      
-      if (chdir(pid_dir)){
-	slurm_error("Cannot chdir to %s : %m ",pid_dir);
-	return (-1);
-      }
 
-      // Write lpprof process pid
-      write_pid_file(lpprof_pid);
-
-      if (chdir(slurm_submit_dir)){
-	slurm_error("Cannot chdir to %s : %m ",pid_dir);
-	return (-1);
-      }
-
-      return(0);
-    }
+  default:
+    lpprof_pid=pid;
+    return(0);
   }
 
 }
-
@@ -6,28 +6,22 @@
 
 #include <stdlib.h>
 #include <string.h>
+#include <linux/limits.h>
 #include "lpprof_util.h"
 
 static int frequency=FREQUENCY_NOT_SET;
 static char* rank_list=NULL;
 
-static int _exec_lpprof(spank_t sp,int frequency,
-			const char* slurm_submit_dir,
-			const char* slurm_job_id,
-			const char* slurm_env_path,
-			char* pid_list);
+// lpprof process started by srun and its output directory
+static pid_t lpprof_pid=-1;
+static char output_dir[PATH_MAX];
+
+static int _exec_lpprof(int frequency,
+			unsigned int nbtasks,
+			int listen_fd);
 
 static int _lpprof_opt_process (int val,
 				const char *optarg,
 				int remote);
 
-
-static int _init_lpprof_dir(unsigned int taskid,
-			    unsigned int nbtasks,
-			    const char* slurm_submit_dir,
-			    const char* slurm_job_id,
-			    const char* slurm_env_path,
-			    const char* slurm_nodename,
-			    char** pid_list);
-
 #endif // LPPROF_H_
@@ -1,5 +1,8 @@
 #include "lpprof_util.h"
-#include <dirent.h>
+#include <sys/socket.h>
+#include <netinet/in.h>
+#include <arpa/inet.h>
+#include <netdb.h>
 #include <stdio.h>
 #include <string.h>
 #include <unistd.h>
@@ -19,54 +22,6 @@ int slurm_getenv(spank_t sp,char* value,char* env_varname){
   return(0);
 }
 
-int write_pid_file(pid_t pid){
-  // Make a file named with current task pid
-  char s_pid[64];   // 64 digits for pid should be enought
-  snprintf(s_pid, 64, "%d",pid);
-  FILE* pidfile=fopen(s_pid,"w");
-  fclose(pidfile);
-
-}
-
-int write_pidhost_file(pid_t pid,const char* hostname,unsigned int taskid){
-  // Make a file named with current task pid, hostname and taskid
-  char s_host_pid[HOSTPID_MXSZ];
-  snprintf(s_host_pid, HOSTPID_MXSZ, "%d:%s:%d",taskid,hostname,pid);
-  FILE* pidfile=fopen(s_host_pid,"w");
-  fclose(pidfile);
-}
-
-
-
-
-
-int count_pid_files(){
-
-  int count=0;
-  int len_entry=0;
-  DIR * dir=NULL;
-  struct dirent * buf=NULL, * de=NULL;
-
-  
-  if ((dir = opendir("."))
-      && (len_entry = offsetof(struct dirent, d_name) + fpathconf(dirfd(dir), _PC_NAME_MAX) + 1)
-      && (buf = (struct dirent *) malloc(len_entry)))
-    {
-      while (readdir_r(dir, buf, &de) == 0 && de)
-	{
-	  if (de->d_type == DT_REG)
-	    {
-	      count+=1;
-	    }
-	}
-    }
-  
-  free(buf);
-  closedir(dir);
-
-  return count;
-}
-
 int count_ranks(const char* rank_list){
   int istr;
   int current_rank=-1;
@@ -110,35 +65,61 @@ int count_ranks(const char* rank_list){
 }
 
 
-int read_pids(char** pid_list,int nbpids){
-
-  int first=1;
-  int len_entry=0;
-  DIR * dir=NULL;
-  struct dirent * buf=NULL, * de=NULL;
-  int ipid=0;
-      
-  if ((dir = opendir("."))
-      && (len_entry = offsetof(struct dirent, d_name) + fpathconf(dirfd(dir), _PC_NAME_MAX) + 1)
-      && (buf = (struct dirent *) malloc(len_entry)))
-    {
-      while (readdir_r(dir, buf, &de) == 0 && de)
-	{
-	  if (de->d_type == DT_REG)
-	    {
-	      strncat(*pid_list,de->d_name,HOSTPID_MXSZ);
-	      if (ipid!=nbpids-1)
-		strcat(*pid_list,",");
-	      ipid+=1;
-	    }
-	}
-    }
-  else{
+int listen_rendezvous(int* port){
+  // Listen on any address, the port is chosen by the system
+  struct sockaddr_in addr;
+  socklen_t addr_len=sizeof(addr);
+  int fd=socket(AF_INET,SOCK_STREAM,0);
+  if (fd<0)
+    return(-1);
+
+  memset(&addr,0,sizeof(addr));
+  addr.sin_family=AF_INET;
+  addr.sin_addr.s_addr=htonl(INADDR_ANY);
+  addr.sin_port=0;
+
+  if (bind(fd,(struct sockaddr*)&addr,sizeof(addr))
+      || listen(fd,SOMAXCONN)
+      || getsockname(fd,(struct sockaddr*)&addr,&addr_len)){
+    close(fd);
     return(-1);
   }
 
-  free(buf);
+  *port=ntohs(addr.sin_port);
+  return(fd);
+}
+
 
-  return(0);
+int register_task(const char* host,int port,unsigned int taskid,const char* hostname,pid_t pid,unsigned int local_tasks){
+  // Send "<rank> <host> <pid> <local tasks>" to the rendezvous server
+  char registration[HOSTPID_MXSZ+SLURM_ENVSIZE];
+  char s_port[64];
+  struct addrinfo hints,*addrs=NULL;
+  int len=snprintf(registration,sizeof(registration),"%u %s %d %u\n",taskid,hostname,pid,local_tasks);
+
+  memset(&hints,0,sizeof(hints));
+  hints.ai_family=AF_UNSPEC;
+  hints.ai_socktype=SOCK_STREAM;
+  snprintf(s_port,64,"%d",port);
+  if (getaddrinfo(host,s_port,&hints,&addrs))
+    return(-1);
+
+  // lpprof may not have accepted connections yet
+  int itry;
+  int registered=0;
+  for (itry=0;itry<RENDEZVOUS_TIMEOUT*10 && !registered;itry++){
+    int fd=socket(addrs->ai_family,addrs->ai_socktype,addrs->ai_protocol);
+    if (fd>=0){
+      if (connect(fd,addrs->ai_addr,addrs->ai_addrlen)==0
+	  && write(fd,registration,len)==len){
+	registered=1;
+      }
+      close(fd);
+    }
+    if (!registered)
+      usleep(100000);
+  }
 
+  freeaddrinfo(addrs);
+  return(registered ? 0 : -1);
 }
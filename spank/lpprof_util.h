@@ -10,11 +10,13 @@
 #define FREQUENCY_NOT_SET -1
 #define SLURM_ENVSIZE 8192
 #define HOSTPID_MXSZ 128
+#define RENDEZVOUS_PORT_ENV "LPPROF_RENDEZVOUS_PORT"
+// Tasks retry to register for this many seconds
+#define RENDEZVOUS_TIMEOUT 60
 
 int slurm_getenv(spank_t sp,char* value,char* env_varname);
-int write_pid_file(pid_t pid);
-int write_pidhost_file(pid_t pid,const char* hostname,unsigned int taskid);
-int count_pid_files();
-int read_pids(char** pid_list,int nbpids);
+int count_ranks(const char* rank_list);
+int listen_rendezvous(int* port);
+int register_task(const char* host,int port,unsigned int taskid,const char* hostname,pid_t pid,unsigned int local_tasks);
 
 #endif // LPPROF_UTIL_H_